@@ -7,6 +7,7 @@ from ankisyncd.config import load_from_env
 from ankisyncd import logging
 from ankisyncd.sync_app import SyncApp
 from ankisyncd.server import run_server
+from ankisyncd.prefork import run_prefork_server
 
 logger = logging.get_logger("ankisyncd")
 
@@ -23,8 +24,13 @@ def main():
     config = load_from_file(sys.argv)
     load_from_env(config)
 
+    if config.get("server_mode") == "prefork":
+        # every worker process creates its own SyncApp
+        run_prefork_server(config, config["host"], int(config["port"]))
+        return
+
     ankiserver = SyncApp(config)
-    run_server(ankiserver, config["host"], int(config["port"]))
+    run_server(ankiserver, config["host"], int(config["port"]), config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+"""Admission control for operations that use a lot of memory or I/O.
+
+Full uploads and downloads and media zips acquire their estimated cost from a
+WeightedSemaphore shared by the whole process, so that only as many of them
+run at once as the budget allows. Cheap operations never touch it."""
+import collections
+import threading
+
+
+class _Waiter:
+    def __init__(self, weight):
+        self.weight = weight
+        self.event = threading.Event()
+
+
+class WeightedSemaphore:
+    """A semaphore whose holders each take 'weight' units out of 'capacity'.
+
+    Waiters are served in FIFO order: a waiter that doesn't fit yet blocks the
+    ones behind it, so large operations can't be starved by a stream of small
+    ones. Weights larger than 'capacity' are treated as 'capacity', i.e. such
+    an operation runs alone."""
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.available = capacity
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def in_use(self):
+        return self.capacity - self.available
+
+    def acquire(self, weight, timeout=None, max_waiting=None):
+        """Take 'weight' units, waiting at most 'timeout' seconds for them,
+        unless 'max_waiting' others are waiting already. Returns whether they
+        were taken."""
+        weight = min(weight, self.capacity)
+        with self._lock:
+            if not self._waiters and weight <= self.available:
+                self.available -= weight
+                return True
+            if max_waiting is not None and len(self._waiters) >= max_waiting:
+                return False
+            waiter = _Waiter(weight)
+            self._waiters.append(waiter)
+
+        if waiter.event.wait(timeout):
+            return True
+        with self._lock:
+            # may have been woken up between the timeout and taking the lock
+            if waiter.event.is_set():
+                return True
+            self._waiters.remove(waiter)
+            # whoever was behind us may fit now
+            self._wake()
+        return False
+
+    def release(self, weight):
+        """Give back 'weight' units taken by acquire()."""
+        weight = min(weight, self.capacity)
+        with self._lock:
+            self.available += weight
+            self._wake()
+
+    def _wake(self):
+        while self._waiters and self._waiters[0].weight <= self.available:
+            waiter = self._waiters.popleft()
+            self.available -= waiter.weight
+            waiter.event.set()
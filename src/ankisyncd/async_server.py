@@ -0,0 +1,279 @@
+import asyncio
+import http.client
+import io
+import logging
+import socket
+import sys
+import tempfile
+import threading
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.util import FileWrapper
+
+logger = logging.getLogger(__name__)
+
+# request bodies larger than this are buffered in a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+# bodies are copied from the socket in blocks of at most this many bytes
+BLOCK_SIZE = 64 * 1024
+
+
+class BadRequest(Exception):
+    status = "400 Bad Request"
+
+
+class PayloadTooLarge(BadRequest):
+    status = "413 Payload Too Large"
+
+
+class AsyncWSGIServer:
+    """Serves a WSGI application from an asyncio event loop.
+
+    The event loop only reads requests and writes responses, so idle or slow
+    connections cost a coroutine rather than a thread. Once a request has been
+    fully received, the application is called on a bounded pool of threads,
+    where SyncApp parses it, authenticates it and hands collection work to the
+    ThreadingCollectionWrapper of the user. The event loop itself never blocks
+    on collection work.
+
+    The interface mirrors socketserver's serve_forever(), shutdown() and
+    server_close() so it can be used the same way as the other servers.
+
+    Request bodies larger than max_body_size bytes, if set, are answered with
+    413 Payload Too Large without being read.
+    """
+
+    server_version = "ankisyncd"
+
+    def __init__(
+        self,
+        host,
+        port,
+        app,
+        pool_size=16,
+        backlog=64,
+        request_timeout=None,
+        max_body_size=None,
+    ):
+        self.app = app
+        self.request_timeout = request_timeout
+        self.max_body_size = max_body_size
+        self.socket = socket.create_server((host or "", port), backlog=backlog)
+        self.server_address = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="ankisyncd.http"
+        )
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        """Stop serve_forever(), may be called from any thread."""
+        self._ready.wait()
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def server_close(self):
+        self.socket.close()
+        self._executor.shutdown(wait=True)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._handle, sock=self.socket)
+        self._ready.set()
+        async with server:
+            await self._stopped.wait()
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.request_timeout)
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            environ = await self._read_request(reader, peer)
+            if environ is None:
+                return
+            await self._respond(writer, environ)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            logger.info("%s connection timed out or closed early", peer and peer[0])
+        except ConnectionError:
+            pass
+        except BadRequest as e:
+            logger.info("%s %s", peer and peer[0], e.status)
+            writer.write(
+                "HTTP/1.1 {}\r\nContent-Length: 0\r\n"
+                "Connection: close\r\n\r\n".format(e.status).encode("latin-1")
+            )
+            try:
+                await self._read(writer.drain())
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+        except Exception:
+            logger.exception("Error handling request from %s", peer and peer[0])
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader, peer):
+        request_line = await self._read(reader.readline())
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            return None
+
+        lines = []
+        while len(lines) <= MAX_HEADERS:
+            line = await self._read(reader.readline())
+            lines.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        headers = http.client.parse_headers(io.BytesIO(b"".join(lines)))
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            if headers.get("Transfer-Encoding", "").lower() == "chunked":
+                await self._read_chunked(reader, body)
+            else:
+                try:
+                    length = int(headers.get("Content-Length") or 0)
+                except ValueError:
+                    raise BadRequest()
+                self._check_size(length)
+                await self._copy(reader, body, length)
+        except BaseException:
+            body.close()
+            raise
+        length = body.tell()
+        body.seek(0)
+
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(length),
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": str(self.server_address[1]),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0] if peer else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for key, value in headers.items():
+            key = key.upper().replace("-", "_")
+            # the body has been decoded, so don't let the app decode it again
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH", "TRANSFER_ENCODING"):
+                continue
+            environ["HTTP_" + key] = value
+        return environ
+
+    def _check_size(self, size):
+        if self.max_body_size is not None and size > self.max_body_size:
+            raise PayloadTooLarge()
+
+    async def _copy(self, reader, body, size):
+        """Copy 'size' bytes from 'reader' to 'body', BLOCK_SIZE at a time."""
+        remaining = size
+        while remaining > 0:
+            block = await self._read(reader.read(min(remaining, BLOCK_SIZE)))
+            if not block:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            body.write(block)
+            remaining -= len(block)
+
+    async def _read_chunked(self, reader, body):
+        total = 0
+        while True:
+            size_line = await self._read(reader.readline())
+            try:
+                size = int(size_line.split(b";", 1)[0], 16)
+            except ValueError:
+                raise BadRequest()
+            if size == 0:
+                # skip trailers
+                while (await self._read(reader.readline())).strip():
+                    pass
+                return
+            total += size
+            self._check_size(total)
+            await self._copy(reader, body, size)
+            await self._read(reader.readexactly(2))
+
+    async def _respond(self, writer, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return lambda data: None
+
+        def call_app():
+            try:
+                return self.app(environ, start_response)
+            finally:
+                environ["wsgi.input"].close()
+
+        try:
+            result = await self._loop.run_in_executor(self._executor, call_app)
+        except Exception:
+            logger.exception("Error calling %s", environ["PATH_INFO"])
+            response = {"status": "500 Internal Server Error", "headers": []}
+            result = []
+
+        try:
+            logger.info(
+                '%s "%s %s" %s',
+                environ["REMOTE_ADDR"],
+                environ["REQUEST_METHOD"],
+                environ["PATH_INFO"],
+                response["status"].split(" ", 1)[0],
+            )
+
+            head = ["HTTP/1.1 {}".format(response["status"])]
+            names = set()
+            for name, value in response["headers"]:
+                names.add(name.lower())
+                head.append("{}: {}".format(name, value))
+            if "content-length" not in names and isinstance(result, (list, tuple)):
+                head.append("Content-Length: {}".format(sum(map(len, result))))
+            head.append("Server: {}".format(self.server_version))
+            head.append("Connection: close")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+            if isinstance(result, (list, tuple)):
+                for block in result:
+                    writer.write(block)
+                    await self._read(writer.drain())
+            elif isinstance(result, FileWrapper):
+                await self._read(writer.drain())
+                # os.sendfile() if possible, reading blocks from the file if not
+                await self._loop.sendfile(writer.transport, result.filelike)
+            else:
+                # e.g. a file, don't read it on the event loop
+                blocks = iter(result)
+                while True:
+                    block = await self._loop.run_in_executor(
+                        self._executor, next, blocks, None
+                    )
+                    if block is None:
+                        break
+                    writer.write(block)
+                    await self._read(writer.drain())
+        finally:
+            if hasattr(result, "close"):
+                result.close()
@@ -1,4 +1,5 @@
 import os
+import threading
 
 from ankisyncd.collection.wrapper import CollectionWrapper
 
@@ -11,18 +12,22 @@ class CollectionManager:
     def __init__(self, config):
         self.collections = {}
         self.config = config
+        self._lock = threading.Lock()
 
     def get_collection(self, path, setup_new_collection=None):
         """Gets a CollectionWrapper for the given path."""
 
         path = os.path.realpath(path)
 
-        try:
-            col = self.collections[path]
-        except KeyError:
-            col = self.collections[path] = self.collection_wrapper(
-                self.config, path, setup_new_collection
-            )
+        # requests for the same user may arrive on several threads at once,
+        # make sure only one wrapper is ever created per path
+        with self._lock:
+            try:
+                col = self.collections[path]
+            except KeyError:
+                col = self.collections[path] = self.collection_wrapper(
+                    self.config, path, setup_new_collection
+                )
 
         return col
 
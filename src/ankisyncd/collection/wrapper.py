@@ -2,6 +2,8 @@ import os
 import anki.storage
 
 import ankisyncd.media
+from ankisyncd.indexes import ensure_indexes
+from ankisyncd.sqlite_profile import apply_pragmas, get_pragmas
 
 
 class CollectionWrapper:
@@ -15,10 +17,13 @@ class CollectionWrapper:
     interacting with the collection.
     """
 
-    def __init__(self, _config, path, setup_new_collection=None):
+    def __init__(self, config, path, setup_new_collection=None):
         self.path = os.path.realpath(path)
         self.username = os.path.basename(os.path.dirname(self.path))
         self.setup_new_collection = setup_new_collection
+        self.pragmas = get_pragmas(config)
+        # the ankisyncd.sync.IncomingSync being applied to the collection
+        self.applying = None
         self.__col = None
 
     def __del__(self):
@@ -61,13 +66,35 @@ class CollectionWrapper:
 
     def _get_collection(self):
         col = anki.storage.Collection(self.path, server=True)
+        self._setup_collection(col)
 
         # Ugly hack, replace default media manager with our custom one
         col.media.close()
-        col.media = ankisyncd.media.ServerMediaManager(col)
+        col.media = ankisyncd.media.ServerMediaManager(col, pragmas=self.pragmas)
 
         return col
 
+    def _setup_collection(self, col):
+        """Apply the sqlite profile to 'col', just opened, and add the
+        indexes it lacks."""
+        # some pragmas can't be changed within the transaction anki opens,
+        # and the indexes are better committed on their own
+        col.save(trx=False)
+        apply_pragmas(col.db, self.pragmas)
+        ensure_indexes(col.db)
+        col.db.begin()
+
+    def reopen(self, col):
+        """Reopen 'col', this wrapper's collection, after it was closed to
+        replace or copy its file, as a full sync does."""
+        # closing it committed whatever was applied
+        self.applying = None
+        col.reopen()
+        # an uploaded collection may well lack the indexes
+        self._setup_collection(col)
+        # the media manager is ours already, and applies them itself
+        col.media.connect()
+
     def open(self):
         """Open the collection, or create it if it doesn't exist."""
         if self.__col is None:
@@ -83,6 +110,7 @@ class CollectionWrapper:
 
         self.__col.close()
         self.__col = None
+        self.applying = None
 
     def opened(self):
         """Returns True if the collection is open, False otherwise."""
@@ -1 +1,20 @@
 from webob.exc import HTTPBadRequest as BadRequestException
+from webob.exc import HTTPRequestEntityTooLarge as PayloadTooLargeException
+from webob.exc import HTTPServiceUnavailable
+
+# seconds clients are asked to wait before retrying when the server is busy
+RETRY_AFTER = 10
+
+
+class ServerBusyException(HTTPServiceUnavailable):
+    """The server can't take the request right now. The client is asked to
+    retry after 'retry_after' seconds."""
+
+    def __init__(self, retry_after=RETRY_AFTER, **kw):
+        super().__init__(**kw)
+        self.retry_after = retry_after
+
+
+class CollectionBusyException(ServerBusyException):
+    """A collection couldn't take any more work, or took too long to finish
+    it."""
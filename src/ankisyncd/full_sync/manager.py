@@ -1,10 +1,13 @@
+import os
 import shutil
+import tempfile
 from sqlite3 import dbapi2 as sqlite
 
 from anki.db import DB
 from anki.collection import Collection
 
 from ankisyncd.exceptions import BadRequestException
+from ankisyncd.responses import FileResponse
 
 
 class FullSyncManager:
@@ -17,19 +20,25 @@ class FullSyncManager:
                 "Integrity check failed for uploaded collection database file."
             )
 
-    def upload(self, col: Collection, data: bytes, session) -> str:
+    def upload(self, col: Collection, data, session) -> str:
         """
         Uploads a sqlite database from the client to the sync server.
 
         :param anki.collection.Collectio col:
-        :param bytes data: The binary sqlite database from the client.
+        :param data: The binary sqlite database from the client, as bytes or
+                     a file object.
         :param .sync_app.SyncUserSession session: The current session.
         """
         # Verify integrity of the received database file before replacing our
         # existing db.
         temp_db_path = session.get_collection_path() + ".tmp"
         with open(temp_db_path, "wb") as f:
-            f.write(data)
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+                # free the spooled upload before checking and copying it
+                data.close()
 
         try:
             with DB(temp_db_path) as test_db:
@@ -44,31 +53,33 @@ class FullSyncManager:
         try:
             shutil.copyfile(temp_db_path, session.get_collection_path())
         finally:
-            col.reopen()
-            # Reopen the media database
-            col.media.connect()
+            session.get_thread().reopen(col)
 
         return "OK"
 
-    def download(self, col: Collection, session) -> bytes:
+    def download(self, col: Collection, session) -> FileResponse:
         """Download the binary database.
 
         Performs a downgrade to database schema 11 before sending the database
-        to the client.
+        to the client. The database is copied to a temporary file, which is
+        then sent, so that the collection can be reopened right away.
 
         :param anki.collection.Collection col:
         :param .sync_app.SyncUserSession session:
 
-        :return bytes: the binary sqlite3 database
+        :return FileResponse: a response with the binary sqlite3 database
         """
         col.close(downgrade=True)
         db_path = session.get_collection_path()
+        snapshot = tempfile.TemporaryFile(dir=os.path.dirname(db_path))
         try:
-            with open(db_path, "rb") as tmp:
-                data = tmp.read()
+            with open(db_path, "rb") as f:
+                shutil.copyfileobj(f, snapshot)
+        except Exception:
+            snapshot.close()
+            raise
         finally:
-            col.reopen()
-            # Reopen the media database
-            col.media.connect()
+            session.get_thread().reopen(col)
 
-        return data
+        snapshot.seek(0)
+        return FileResponse(snapshot)
@@ -0,0 +1,128 @@
+"""Indexes the sync queries need, and checking they're used.
+
+Every incremental sync selects the rows of cards, notes, revlog and graves
+changed since the client's last sync, by usn. Collections created by anki
+have indexes on those usn columns, but older or repaired collections may
+not, and without them each of those queries reads the whole table.
+'ensure_indexes' adds any that are missing when a collection is opened, or
+reopened after a full upload replaced it, and 'query_plans' reports how
+sqlite runs each sync query, for 'ankisyncctl explain'."""
+import sqlite3
+import urllib.request
+
+from ankisyncd import logging
+from ankisyncd.sync import CHUNK_COLUMNS
+
+logger = logging.get_logger(__name__)
+
+# (table, column, name of the index created if there's none on column)
+REQUIRED_INDEXES = (
+    ("graves", "usn", "ix_graves_usn"),
+    ("cards", "usn", "ix_cards_usn"),
+    ("notes", "usn", "ix_notes_usn"),
+    ("revlog", "usn", "ix_revlog_usn"),
+)
+
+# tables which mustn't be read whole by a sync query
+LARGE_TABLES = ("cards", "notes", "revlog", "graves")
+
+
+def _sync_queries():
+    """(description, sql) of the queries a sync runs on every collection, as
+    the server runs them, i.e. with 'usn >= minUsn' as Syncer.usnLim()."""
+    queries = [
+        ("removed", "select oid, type from graves where usn >= 0"),
+        ("sanityCheck graves", "select null from graves where usn = -1"),
+        ("newerRows", "select rid from sync_rows join cards on id = rid and usn >= 0"),
+    ]
+    for table in ("revlog", "cards", "notes"):
+        columns = CHUNK_COLUMNS[table].replace("?", "0")
+        # the ranges of Syncer.queryTable()
+        for lim in ("usn = 0 and id > 0", "usn > 0", "usn = -1 and id > 0"):
+            queries.append(
+                (
+                    "chunk " + table,
+                    "select %s from %s where usn >= 0 and %s order by usn, id "
+                    "limit 1" % (columns, table, lim),
+                )
+            )
+        queries += [
+            (
+                "markSent " + table,
+                "update %s set usn = 1 where usn = -1 and usn >= 0 and id > 0" % table,
+            ),
+            ("sanityCheck " + table, "select null from %s where usn = -1" % table),
+        ]
+    return queries
+
+
+SYNC_QUERIES = _sync_queries()
+
+
+def index_columns(db, table):
+    """The leading column of each index on 'table'."""
+    columns = set()
+    for _, name, *_ in db.all("pragma index_list(%s)" % table):
+        info = db.all("pragma index_info(%s)" % name)
+        if info:
+            columns.add(info[0][2])
+    return columns
+
+
+def ensure_indexes(db):
+    """Create the REQUIRED_INDEXES missing from 'db', and return their names.
+
+    Raises RuntimeError if one couldn't be created."""
+    created = []
+    for table, column, name in REQUIRED_INDEXES:
+        if column in index_columns(db, table):
+            continue
+        logger.info("Creating index {} on {}({})".format(name, table, column))
+        db.execute("create index if not exists %s on %s (%s)" % (name, table, column))
+        if column not in index_columns(db, table):
+            raise RuntimeError("Could not create index {}".format(name))
+        created.append(name)
+    return created
+
+
+class ReadOnlyDB:
+    """A read-only connection to the database at 'path', with the all() and
+    execute() of anki's DB, for looking at a collection the server may have
+    open. sqlite's locks still apply, so reads may wait up to 'timeout'
+    seconds for a sync writing to it."""
+
+    def __init__(self, path, timeout=5):
+        uri = "file:{}?mode=ro".format(urllib.request.pathname2url(path))
+        self._db = sqlite3.connect(uri, uri=True, timeout=timeout)
+
+    def all(self, sql, *args):
+        return self._db.execute(sql, args).fetchall()
+
+    def execute(self, sql, *args):
+        return self._db.execute(sql, args)
+
+    def close(self):
+        self._db.close()
+
+
+def query_plans(db):
+    """The (description, sql, plan) of each of SYNC_QUERIES on 'db', the plan
+    being the details of EXPLAIN QUERY PLAN."""
+    # the temp table newerRows joins
+    db.execute("create temp table if not exists sync_rows (rid int, rmod int)")
+    return [
+        (description, sql, [row[3] for row in db.all("explain query plan " + sql)])
+        for description, sql in SYNC_QUERIES
+    ]
+
+
+def full_scans(plan):
+    """The steps of 'plan' that read a whole table of LARGE_TABLES."""
+    # e.g. "SCAN TABLE cards" or "SCAN cards USING INDEX ...", as a scan of
+    # an index reads all of it too
+    return [
+        step
+        for step in plan
+        if step.startswith("SCAN ")
+        and set(step.split(" USING")[0].split()) & set(LARGE_TABLES)
+    ]
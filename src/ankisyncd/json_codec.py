@@ -0,0 +1,35 @@
+"""JSON encoding and decoding of sync payloads.
+
+orjson is used when it is installed, the standard library's json module
+otherwise. Both produce compact UTF-8 encoded bytes, which decode to the same
+values, but they aren't always identical: floats in exponent notation are
+written differently (orjson's 1e16 is 1e+16 for json), and orjson writes NaN
+and infinities as null where json writes NaN and Infinity, which aren't valid
+JSON."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+if orjson is not None:
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers that don't fit in 64 bits
+            return _json_dumps(obj)
+
+    # accepts str, bytes and bytearray, and raises a ValueError subclass
+    loads = orjson.loads
+
+else:
+    dumps = _json_dumps
+    loads = json.loads
@@ -7,16 +7,34 @@ import re
 import os
 import os.path
 
+from sqlite3 import dbapi2 as sqlite
+
 import anki.db
 from anki.media import MediaManager
 
+from ankisyncd.sqlite_profile import apply_pragmas
+
 logger = logging.getLogger("ankisyncd.media")
 
 
+class _DB(anki.db.DB):
+    """anki.db.DB usable from whichever worker thread runs the collection's
+    calls. They never run at the same time."""
+
+    def __init__(self, path, timeout=0):
+        # as in anki.db.DB.__init__()
+        self._db = sqlite.connect(path, timeout=timeout, check_same_thread=False)
+        self._db.text_factory = self._textFactory
+        self._path = path
+        self.echo = os.environ.get("DBECHO")
+        self.mod = False
+
+
 class ServerMediaManager(MediaManager):
-    def __init__(self, col, server=True):
+    def __init__(self, col, server=True, pragmas=()):
         super().__init__(col, server)
         self._dir = re.sub(r"(?i)\.(anki2)$", ".media", col.path)
+        self.pragmas = pragmas
         self.connect()
 
     def addMedia(self, media_to_add):
@@ -34,7 +52,8 @@ class ServerMediaManager(MediaManager):
     def connect(self):
         path = self.dir() + ".server.db"
         create = not os.path.exists(path)
-        self._db = anki.db.DB(path)
+        self._db = _DB(path)
+        apply_pragmas(self._db, self.pragmas)
         if create:
             self._db.executescript(
                 """CREATE TABLE media (
@@ -0,0 +1,304 @@
+"""Metrics about the sync server, rendered in the Prometheus text format.
+
+Metrics are registered in the module-level REGISTRY when they are created,
+and SyncApp serves REGISTRY.render() at metrics_url."""
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in labels
+        )
+    )
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append(
+                    "{}{} {}".format(name, _format_labels(labels), _format_value(value))
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _add_label(line, label):
+    """Add the formatted 'label' (name="value") to the sample 'line'."""
+    end = len(line.split("{", 1)[0].split(" ", 1)[0])
+    if line[end : end + 1] == "{":
+        return "{}{{{},{}".format(line[:end], label, line[end + 1 :])
+    return "{}{{{}}}{}".format(line[:end], label, line[end:])
+
+
+def merge(texts, label):
+    """Combine the render() output of several registries, e.g. of different
+    processes, into one. The samples of the i-th text get the label 'label'
+    set to i, and each metric keeps a single HELP and TYPE."""
+    families = {}
+    for i, text in enumerate(texts):
+        value = _format_labels(((label, i),))[1:-1]
+        lines = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                headers, lines = families.setdefault(line.split(" ", 3)[2], ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line and lines is not None:
+                lines.append(_add_label(line, value))
+    return "".join(
+        "\n".join(headers + lines) + "\n" for headers, lines in families.values()
+    )
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "{} expects labels {}, got {}".format(
+                    self.name, self.labelnames, tuple(labels)
+                )
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of requests handled."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. the number of open collections."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Counts observed values, e.g. request durations, in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, **kw):
+        super().__init__(name, help, labelnames, **kw)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def value(self, **labels):
+        """Return the number of observations and their sum."""
+        with self._lock:
+            counts, total = self._values.get(self._key(labels), ((), 0))
+            return sum(counts), total
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(c), t)) for key, (c, t) in self._values.items())
+        for key, (counts, total) in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_value(bound)
+                yield self.name + "_bucket", labels + (("le", le),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+#
+# Metrics recorded by the sync server
+#
+
+REQUESTS = Counter(
+    "ankisyncd_requests_total",
+    "Requests handled, by operation and HTTP status.",
+    ["operation", "status"],
+)
+REQUEST_DURATION = Histogram(
+    "ankisyncd_request_duration_seconds",
+    "Time from receiving a request to having its response ready.",
+    ["operation"],
+)
+REQUEST_SIZE = Histogram(
+    "ankisyncd_request_size_bytes",
+    "Size of request bodies.",
+    ["operation"],
+    buckets=SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "ankisyncd_response_size_bytes",
+    "Size of response bodies.",
+    ["operation"],
+    buckets=SIZE_BUCKETS,
+)
+HANDLER_DURATION = Histogram(
+    "ankisyncd_handler_duration_seconds",
+    "Time spent running handlers on collection threads.",
+    ["operation"],
+)
+HANDLER_ERRORS = Counter(
+    "ankisyncd_handler_errors_total",
+    "Handlers that raised an exception.",
+    ["operation"],
+)
+# not labelled by collection, metrics_url is served to anyone and mustn't
+# tell who is syncing
+QUEUE_DEPTH = Gauge(
+    "ankisyncd_collection_queue_depth",
+    "Calls waiting to run on open collections, in all.",
+)
+MAX_QUEUE_DEPTH = Gauge(
+    "ankisyncd_collection_queue_depth_max",
+    "Calls waiting to run on the open collection with the most.",
+)
+COLLECTION_BUSY = Counter(
+    "ankisyncd_collection_busy_total",
+    "Calls turned away because a collection's queue was full or they timed out.",
+    ["reason"],
+)
+ADMISSION_WAIT = Histogram(
+    "ankisyncd_admission_wait_seconds",
+    "Time heavy operations waited for their share of the budget.",
+    ["operation"],
+)
+HEAVY_OPERATIONS_REJECTED = Counter(
+    "ankisyncd_heavy_operations_rejected_total",
+    "Heavy operations turned away after waiting too long for the budget.",
+    ["operation"],
+)
+HEAVY_OPERATIONS_WAITING = Gauge(
+    "ankisyncd_heavy_operations_waiting",
+    "Heavy operations waiting for their share of the budget.",
+)
+HEAVY_OPERATIONS_COST = Gauge(
+    "ankisyncd_heavy_operations_cost_bytes",
+    "Estimated cost of the heavy operations currently running.",
+)
+WORKER_THREADS = Gauge(
+    "ankisyncd_worker_threads",
+    "Threads in the pool running calls on collections.",
+)
+BUSY_WORKER_THREADS = Gauge(
+    "ankisyncd_busy_worker_threads",
+    "Worker threads currently running a call.",
+)
+COLLECTION_OPENS = Counter(
+    "ankisyncd_collection_opens_total",
+    "Collections opened to run a call.",
+)
+COLLECTION_CLOSES = Counter(
+    "ankisyncd_collection_closes_total",
+    "Collections closed because they were inactive or to stay within a limit.",
+    ["reason"],
+)
+COLLECTION_REOPENS = Counter(
+    "ankisyncd_collection_reopens_total",
+    "Collections opened again after being closed, by why they were closed.",
+    ["reason"],
+)
+COLLECTION_WARM_UPS = Counter(
+    "ankisyncd_collection_warm_ups_total",
+    "Collections opened in the background after their user logged in.",
+)
+META_DURATION = Histogram(
+    "ankisyncd_meta_duration_seconds",
+    "Time to answer meta requests, by whether the collection was already "
+    "open (warm) or not (cold) when the request arrived.",
+    ["collection"],
+)
+IDLE_OPEN_SECONDS = Counter(
+    "ankisyncd_collection_idle_open_seconds_total",
+    "Seconds collections stayed open between syncs, with the adaptive "
+    "keep-open window and as they would have with the fixed "
+    "monitor_inactivity. The difference in rates, times the memory of a "
+    "collection, is the memory saved.",
+    ["policy"],
+)
+IDLE_REOPENS = Counter(
+    "ankisyncd_collection_idle_reopens_total",
+    "Syncs that found their collection closed after it was idle, with the "
+    "adaptive keep-open window and as they would have with the fixed "
+    "monitor_inactivity.",
+    ["policy"],
+)
+OPEN_COLLECTIONS = Gauge(
+    "ankisyncd_open_collections",
+    "Collections currently open.",
+)
@@ -0,0 +1,196 @@
+import io
+import re
+import tempfile
+
+from ankisyncd.exceptions import BadRequestException, PayloadTooLargeException
+
+BLOCK_SIZE = 64 * 1024
+# file fields larger than this are moved from memory to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+MAX_LINE_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+NAME_RE = re.compile(rb'name="(.*?)"')
+
+
+class LimitedReader:
+    """Reads at most 'length' bytes from 'stream'. A WSGI server's input
+    blocks when reading past the end of the request body."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class ChunkedReader:
+    """Decodes a body sent with "Transfer-Encoding: chunked" from 'stream'.
+
+    Only the chunk size lines are buffered, the chunks themselves are passed
+    on as they are read, so memory use doesn't depend on the size or number
+    of chunks. Reading stops after the last chunk and its trailers. Bodies
+    larger than 'max_size' bytes are rejected before the chunk that would
+    take them past it is read."""
+
+    def __init__(self, stream, max_size=None):
+        self.stream = stream
+        self.max_size = max_size
+        self.remaining = 0
+        self.done = False
+        # decoded bytes read so far
+        self.size = 0
+
+    def _read_line(self):
+        line = self.stream.readline(MAX_LINE_SIZE + 1)
+        if len(line) > MAX_LINE_SIZE or not line.endswith(b"\n"):
+            raise BadRequestException("Malformed chunked body.")
+        return line.strip()
+
+    def _next_chunk(self):
+        try:
+            self.remaining = int(self._read_line().split(b";")[0], 16)
+        except ValueError:
+            raise BadRequestException("Malformed chunked body.")
+        if self.max_size is not None and self.size + self.remaining > self.max_size:
+            raise PayloadTooLargeException(
+                "Request body is larger than {} bytes.".format(self.max_size)
+            )
+        if self.remaining == 0:
+            while self._read_line():
+                pass  # ignore trailers
+            self.done = True
+
+    def read(self, size=-1):
+        if self.done:
+            return b""
+        if self.remaining == 0:
+            self._next_chunk()
+            if self.done:
+                return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        if not data:
+            raise BadRequestException("Unexpected end of chunked body.")
+        self.remaining -= len(data)
+        self.size += len(data)
+        if self.remaining == 0 and self.stream.read(2) != b"\r\n":
+            raise BadRequestException("Malformed chunked body.")
+        return data
+
+
+class MultipartParser:
+    """A streaming multipart/form-data parser.
+
+    The body is read from 'stream' in blocks of 'block_size' bytes, so only
+    about one block is held in memory at a time, however large the body. File
+    fields ('file_fields') are written to a SpooledTemporaryFile, which stays
+    in memory up to 'spool_max_size' bytes and then moves to 'spool_dir';
+    other fields are decoded to str. File fields larger than 'max_file_size'
+    bytes are rejected as soon as they grow past it.
+
+    Iterating over the parser yields (name, value) pairs.
+    """
+
+    def __init__(
+        self,
+        stream,
+        block_size=BLOCK_SIZE,
+        spool_max_size=SPOOL_MAX_SIZE,
+        spool_dir=None,
+        file_fields=("data",),
+        max_file_size=None,
+    ):
+        self.stream = stream
+        self.block_size = block_size
+        self.spool_max_size = spool_max_size
+        self.spool_dir = spool_dir
+        self.file_fields = file_fields
+        self.max_file_size = max_file_size
+        self._buf = bytearray()
+
+    def _fill(self):
+        block = self.stream.read(self.block_size)
+        self._buf += block
+        return bool(block)
+
+    def _read_line(self):
+        while True:
+            i = self._buf.find(b"\r\n")
+            if i >= 0:
+                line = bytes(self._buf[:i])
+                del self._buf[: i + 2]
+                return line
+            if len(self._buf) > MAX_LINE_SIZE:
+                raise BadRequestException("Line too long in multipart body.")
+            if not self._fill():
+                line = bytes(self._buf)
+                self._buf.clear()
+                return line
+
+    def _read_part(self, sink, limit=None, error=BadRequestException):
+        """Copy the current part to 'sink', up to the next delimiter. 'error'
+        is raised if the part is larger than 'limit' bytes."""
+        marker = b"\r\n" + self._delimiter
+        keep = len(marker) - 1
+        size = 0
+        while True:
+            i = self._buf.find(marker)
+            end = i if i >= 0 else len(self._buf) - keep
+            if limit is not None and size + max(end, 0) > limit:
+                raise error("Multipart field is larger than {} bytes.".format(limit))
+            if i >= 0:
+                sink.write(self._buf[:i])
+                del self._buf[: i + len(marker)]
+                return
+            if end > 0:
+                sink.write(self._buf[:end])
+                size += end
+                del self._buf[:end]
+            if not self._fill():
+                raise BadRequestException("Unexpected end of multipart body.")
+
+    def __iter__(self):
+        delimiter = self._read_line().strip()
+        if not delimiter.startswith(b"--"):
+            raise BadRequestException("Malformed multipart body.")
+        self._delimiter = delimiter
+
+        while True:
+            headers = []
+            while True:
+                line = self._read_line()
+                if not line:
+                    break
+                headers.append(line)
+            name = NAME_RE.search(b"\r\n".join(headers))
+            name = name.group(1).decode("utf-8") if name else None
+
+            if name in self.file_fields:
+                value = tempfile.SpooledTemporaryFile(
+                    max_size=self.spool_max_size, dir=self.spool_dir
+                )
+                try:
+                    self._read_part(value, self.max_file_size, PayloadTooLargeException)
+                except Exception:
+                    value.close()
+                    raise
+                value.seek(0)
+            else:
+                value = io.BytesIO()
+                self._read_part(value, MAX_FIELD_SIZE)
+                value = value.getvalue().decode("utf-8")
+            if name is not None:
+                yield name, value
+
+            # the delimiter is followed by "--" after the last part
+            while len(self._buf) < 2 and self._fill():
+                pass
+            if self._buf[:2] == b"--" or not self._buf:
+                return
+            self._read_line()
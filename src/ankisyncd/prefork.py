@@ -0,0 +1,449 @@
+import bisect
+import gzip
+import hashlib
+import http.client
+import io
+import logging
+import multiprocessing
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import reduction
+from wsgiref.simple_server import WSGIServer
+
+from ankisyncd import json_codec, metrics
+from ankisyncd.server import RequestHandler, ThreadPoolMixIn, _server_settings
+
+logger = logging.getLogger(__name__)
+
+# requests are buffered in memory up to this size, then in a temporary file
+BUFFER_MAX_SIZE = 1024 * 1024
+MAX_HEAD_SIZE = 65536
+# 'k' (host key) or 'sk' (media session key) form fields
+ROUTING_FIELD_RE = re.compile(rb'name="(k|sk)"\r\n\r\n([^\r\n]*)\r\n')
+
+
+class HashRing:
+    """A consistent hash ring.
+
+    Each node is placed on the ring 'replicas' times, a key belongs to the
+    first node at or after its own position. Adding or removing a node only
+    moves the keys of its neighbours."""
+
+    def __init__(self, nodes, replicas=64):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash("{}-{}".format(node, i)), node))
+        self._ring.sort()
+        self._positions = [position for position, node in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key):
+        index = bisect.bisect(self._positions, self._hash(key))
+        return self._ring[index % len(self._ring)][1]
+
+
+class _ChainReader(io.RawIOBase):
+    """Reads from several file-like objects, one after the other."""
+
+    def __init__(self, *files):
+        self._files = list(files)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+        super().close()
+
+    def readinto(self, b):
+        while self._files:
+            n = self._files[0].readinto(b)
+            if n:
+                return n
+            self._files.pop(0).close()
+        return 0
+
+
+class _HandoffSocket(socket.socket):
+    """A connection received from the router, along with whatever the router
+    already read from it."""
+
+    buffered = None
+
+
+class HandoffRequestHandler(RequestHandler):
+    def setup(self):
+        super().setup()
+        buffered = self.connection.buffered
+        if buffered is not None:
+            self.rfile = io.BufferedReader(_ChainReader(buffered, self.rfile))
+
+
+class HandoffWSGIServer(ThreadPoolMixIn, WSGIServer):
+    """A WSGIServer for connections accepted by another process."""
+
+    def __init__(self, server_address, app, **kw):
+        super().__init__(
+            server_address, HandoffRequestHandler, bind_and_activate=False, **kw
+        )
+        self.server_name = socket.getfqdn(server_address[0])
+        self.server_port = server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+
+
+def _send_connection(pipe, addr, conn, buffered):
+    """Send a connection and what was read from it so far to a worker."""
+    fds = [conn.fileno()]
+    if isinstance(buffered, bytes):
+        pipe.send((addr, buffered))
+    else:
+        pipe.send((addr, None))
+        fds.append(buffered.fileno())
+    with socket.fromfd(pipe.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        reduction.sendfds(s, fds)
+
+
+def _recv_connection(pipe):
+    addr, buffered = pipe.recv()
+    with socket.fromfd(pipe.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        fds = reduction.recvfds(s, 1 if buffered is not None else 2)
+    conn = _HandoffSocket(fileno=fds[0])
+    if buffered is not None:
+        conn.buffered = io.BytesIO(buffered)
+    else:
+        conn.buffered = os.fdopen(fds[1], "rb", buffering=0)
+        conn.buffered.seek(0)
+    return conn, addr
+
+
+def _worker_main(index, config, address, pipe, settings):
+    from ankisyncd.sync_app import SyncApp
+    from ankisyncd.thread import shutdown
+
+    logger.info("Worker %d (pid %d) starting...", index, os.getpid())
+    httpd = HandoffWSGIServer(
+        address,
+        SyncApp(config),
+        pool_size=settings["pool_size"],
+        request_timeout=settings["request_timeout"],
+    )
+    try:
+        while True:
+            try:
+                conn, addr = _recv_connection(pipe)
+            except (EOFError, OSError, KeyboardInterrupt):
+                break
+            httpd.process_request(conn, addr)
+    finally:
+        httpd.server_close()
+        shutdown()
+        logger.info("Worker %d stopped", index)
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.pipe = None
+        self.lock = threading.Lock()
+
+
+class PreforkServer:
+    """Runs SyncApp in several worker processes.
+
+    The master process accepts connections and reads each request until it
+    knows which user it belongs to (from the host key or media session key,
+    or from the username for hostKey itself). The connection, along with what
+    was read so far, is then passed on to the worker that user is pinned to by
+    consistent hashing of their userdir. A collection is thus only ever opened
+    by a single process.
+
+    Sessions have to be shared between processes, so session_db_path (or a
+    session_manager storing sessions outside of the process) is required.
+
+    Requests for metrics_url are passed on to every worker instead, and their
+    metrics combined, each labelled with the index of its worker.
+    """
+
+    def __init__(self, config, host, port, workers=None):
+        from ankisyncd.sessions import get_session_manager, SimpleSessionManager
+        from ankisyncd.users import get_user_manager
+
+        self.config = dict(config)
+        self.settings = _server_settings(self.config)
+        self.session_manager = get_session_manager(self.config)
+        if type(self.session_manager) is SimpleSessionManager:
+            raise ValueError("server_mode = prefork requires session_db_path")
+        self.user_manager = get_user_manager(self.config)
+        self.metrics_url = self.config.get("metrics_url") or None
+
+        self.socket = socket.create_server(
+            (host or "", port), backlog=self.settings["backlog"]
+        )
+        self.server_address = self.socket.getsockname()[:2]
+
+        count = workers or int(self.config.get("server_workers") or os.cpu_count())
+        self.workers = [_Worker(i) for i in range(count)]
+        self.ring = HashRing(range(count))
+        self._context = multiprocessing.get_context("spawn")
+        self._slots = threading.BoundedSemaphore(self.settings["pool_size"])
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.settings["pool_size"], thread_name_prefix="ankisyncd.route"
+        )
+        self._running = False
+
+    def _start_worker(self, worker):
+        pipe, child_pipe = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(
+                worker.index,
+                self.config,
+                self.server_address,
+                child_pipe,
+                self.settings,
+            ),
+            name="ankisyncd-worker-{}".format(worker.index),
+            daemon=True,
+        )
+        process.start()
+        child_pipe.close()
+        worker.process, worker.pipe = process, pipe
+
+    def _monitor_workers(self):
+        while self._running:
+            for worker in self.workers:
+                with worker.lock:
+                    if self._running and not worker.process.is_alive():
+                        logger.error(
+                            "Worker %d exited with %s, restarting",
+                            worker.index,
+                            worker.process.exitcode,
+                        )
+                        worker.pipe.close()
+                        self._start_worker(worker)
+            time.sleep(1)
+
+    def serve_forever(self):
+        self._running = True
+        for worker in self.workers:
+            self._start_worker(worker)
+        threading.Thread(target=self._monitor_workers, daemon=True).start()
+
+        while self._running:
+            try:
+                conn, addr = self.socket.accept()
+            except OSError:
+                if not self._running:
+                    break
+                raise
+            self._slots.acquire()
+            self._pool.submit(self._route, conn, addr)
+
+    def shutdown(self):
+        self._running = False
+        self.socket.close()
+
+    def server_close(self):
+        self._running = False
+        self.socket.close()
+        self._pool.shutdown(wait=True)
+        for worker in self.workers:
+            # workers exit once their pipe is closed
+            worker.pipe.close()
+        for worker in self.workers:
+            worker.process.join(10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def _route(self, conn, addr):
+        buffered = None
+        try:
+            conn.settimeout(self.settings["request_timeout"])
+            key, buffered = self._read_routing_key(conn)
+            if key is None:
+                self._serve_metrics(conn, addr, buffered)
+                return
+            worker = self.workers[self.ring.get(key)]
+            conn.settimeout(None)
+            with worker.lock:
+                _send_connection(worker.pipe, addr, conn, buffered)
+        except Exception:
+            logger.exception("Unable to route request from %s", addr[0])
+        finally:
+            conn.close()
+            if buffered is not None and not isinstance(buffered, bytes):
+                buffered.close()
+            self._slots.release()
+
+    def _read_routing_key(self, conn):
+        """Read the request from 'conn' until its routing key is known.
+
+        Returns the key and everything read so far, either as bytes or, for
+        large requests, as a temporary file. The key is None for requests for
+        metrics_url, which don't belong to any user."""
+        buf = bytearray()
+        while b"\r\n\r\n" not in buf and len(buf) < MAX_HEAD_SIZE:
+            data = conn.recv(65536)
+            if not data:
+                return "", bytes(buf)
+            buf += data
+        head = bytes(buf).partition(b"\r\n\r\n")[0]
+        request_line, _, header_lines = head.partition(b"\r\n")
+        path = (request_line.split(b" ") + [b""])[1].decode("latin-1")
+        headers = http.client.parse_headers(io.BytesIO(header_lines + b"\r\n\r\n"))
+        if self.metrics_url and path.partition("?")[0] == self.metrics_url:
+            return None, bytes(buf)
+        chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+        end = len(head) + 4 + int(headers.get("Content-Length") or 0)
+        # logins have to be read completely, for everything else stop reading
+        # as soon as the session key shows up
+        login = path.endswith("hostKey")
+
+        spool = None
+        size = len(buf)
+        match = None if login else ROUTING_FIELD_RE.search(bytes(buf))
+        while match is None:
+            if buf.endswith(b"0\r\n\r\n") if chunked else size >= end:
+                break
+            data = conn.recv(65536)
+            if not data:
+                break
+            size += len(data)
+            buf += data
+            if spool is None and size > BUFFER_MAX_SIZE:
+                spool = tempfile.TemporaryFile(dir=self.config.get("data_root"))
+                spool.write(buf)
+            elif spool is not None:
+                spool.write(data)
+            if not login:
+                # search a copy, buf is about to be trimmed
+                tail = bytes(buf[max(0, len(buf) - len(data) - 256) :])
+                match = ROUTING_FIELD_RE.search(tail)
+            if spool is not None:
+                # only keep enough to find a field split between two reads
+                del buf[:-MAX_HEAD_SIZE]
+
+        if match is not None:
+            key = self._key_for_session(match.group(1), match.group(2))
+        elif spool is None:
+            key = self._key_for_body(path, headers, io.BytesIO(buf[len(head) + 4 :]))
+        else:
+            spool.seek(len(head) + 4)
+            key = self._key_for_body(path, headers, spool)
+        return key, bytes(buf) if spool is None else spool
+
+    def _serve_metrics(self, conn, addr, request):
+        """Pass the metrics request 'request' on to every worker, over a
+        socketpair, and answer 'conn' with their combined metrics."""
+        texts = []
+        for worker in self.workers:
+            ours, theirs = socket.socketpair()
+            try:
+                ours.settimeout(self.settings["request_timeout"])
+                with worker.lock:
+                    _send_connection(worker.pipe, addr, theirs, request)
+                theirs.close()
+                response = http.client.HTTPResponse(ours)
+                response.begin()
+                body = response.read()
+                if response.status != 200:
+                    raise ValueError("status {}".format(response.status))
+                if response.getheader("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                texts.append(body.decode("utf-8"))
+            except Exception:
+                logger.exception("Unable to get metrics of worker %d", worker.index)
+                texts.append("")
+            finally:
+                theirs.close()
+                ours.close()
+
+        body = metrics.merge(texts, "worker").encode("utf-8")
+        conn.sendall(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body)
+        )
+
+    def _key_for_session(self, field, value):
+        def factory(name, path):
+            return types.SimpleNamespace(name=name, path=path, skey=None)
+
+        value = value.decode("utf-8", "replace")
+        if field == b"k":
+            session = self.session_manager.load(value, factory)
+        else:
+            session = self.session_manager.load_from_skey(value, factory)
+        if session is None:
+            return value
+        return os.path.basename(session.path)
+
+    def _key_for_body(self, path, headers, body):
+        """Parse the form in the request body to find its routing key. Only
+        needed for logins, or when the session key couldn't be spotted in the
+        raw body."""
+        from ankisyncd.sync_app import Requests
+
+        chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+        environ = {
+            "QUERY_STRING": "",
+            "CONTENT_LENGTH": "" if chunked else headers.get("Content-Length", ""),
+            "HTTP_TRANSFER_ENCODING": "chunked" if chunked else "0",
+            "wsgi.input": body,
+        }
+        try:
+            params = Requests(environ).parse
+        except Exception:
+            return ""
+        try:
+            return self._key_for_params(path, params)
+        finally:
+            if hasattr(params.get("data"), "close"):
+                params["data"].close()
+
+    def _key_for_params(self, path, params):
+        if not path.endswith("hostKey"):
+            for field in ("k", "sk"):
+                if params.get(field):
+                    return self._key_for_session(field.encode(), params[field].encode())
+            return ""
+
+        try:
+            data = params["data"]
+            data = data if isinstance(data, bytes) else data.read()
+            if int(params.get("c", 0)):
+                data = gzip.decompress(data)
+            username = json_codec.loads(data)["u"]
+        except (KeyError, TypeError, ValueError, OSError):
+            return ""
+        return self.user_manager.userdir(username) or ""
+
+
+def run_prefork_server(config, host: str = None, port: int = None):
+    httpd = PreforkServer(config, host, port)
+    try:
+        logger.info(
+            "Serving HTTP on {} port {} (prefork mode, {} workers)...".format(
+                *httpd.server_address, len(httpd.workers)
+            )
+        )
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Exiting...")
+    finally:
+        httpd.server_close()
@@ -0,0 +1,75 @@
+import os
+
+from webob import Response
+from webob.static import FileIter
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class FileResponse(Response):
+    """A response with the contents of an open file as body.
+
+    When the server provides wsgi.file_wrapper the file is handed to it, so
+    that it can be sent with os.sendfile(), without ever being read into
+    memory. Otherwise it is sent in blocks of 'block_size' bytes. The file is
+    closed once it has been sent."""
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE, **kw):
+        kw.setdefault("content_type", "application/octet-stream")
+        super().__init__(
+            app_iter=FileIter(fileobj),
+            content_length=os.fstat(fileobj.fileno()).st_size,
+            **kw
+        )
+        self.fileobj = fileobj
+        self.block_size = block_size
+
+    def __call__(self, environ, start_response):
+        content_length = self.content_length
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None:
+            self.app_iter = file_wrapper(self.fileobj, self.block_size)
+        else:
+            self.app_iter = self.app_iter.app_iter_range(block_size=self.block_size)
+        # setting app_iter resets it
+        self.content_length = content_length
+        return super().__call__(environ, start_response)
+
+
+class _ClosingList(list):
+    """A list body that can have a close() method, as servers send lists
+    faster than other iterables."""
+
+
+class _ClosingIterator:
+    def __init__(self, app_iter, close):
+        self.app_iter = app_iter
+        self.close = close
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+
+def call_on_close(app_iter, callback):
+    """Return 'app_iter', the result of a WSGI application, with its close()
+    also calling 'callback', i.e. once the server has sent the response or
+    given up on it."""
+    close = getattr(app_iter, "close", None)
+
+    def close_and_call():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+
+    if isinstance(app_iter, (list, tuple)):
+        app_iter = _ClosingList(app_iter)
+    try:
+        # rather than wrapping it, so that servers still recognize a
+        # wsgi.file_wrapper
+        app_iter.close = close_and_call
+    except AttributeError:
+        # e.g. a generator
+        app_iter = _ClosingIterator(app_iter, close_and_call)
+    return app_iter
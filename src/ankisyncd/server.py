@@ -1,15 +1,76 @@
+import io
 import logging
+import threading
 
-from wsgiref.simple_server import make_server, WSGIRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import (
+    make_server,
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer,
+)
 
+from ankisyncd.async_server import AsyncWSGIServer
 from ankisyncd.thread import shutdown
 
 logger = logging.getLogger(__name__)
 
+SERVER_MODES = ("simple", "threaded", "asyncio", "prefork")
+
+
+class SendfileServerHandler(ServerHandler):
+    def sendfile(self):
+        """Send a wsgi.file_wrapper response with socket.sendfile(), which
+        copies the file to the connection in the kernel (os.sendfile) where
+        possible."""
+        try:
+            self.result.filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self.bytes_sent += self.request_handler.connection.sendfile(
+            self.result.filelike
+        )
+        return True
+
 
 class RequestHandler(WSGIRequestHandler):
     logger = logging.getLogger("ankisyncd.http")
 
+    def setup(self):
+        # StreamRequestHandler applies self.timeout to the connection socket
+        self.timeout = getattr(self.server, "request_timeout", None)
+        super().setup()
+
+    def handle(self):
+        """Handle a single HTTP request.
+
+        Same as WSGIRequestHandler.handle(), except that wsgi.multithread is
+        taken from the server and files are sent with sendfile()."""
+
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=getattr(self.server, "multithread", False),
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
     def log_error(self, format, *args):
         self.logger.error("%s %s", self.address_string(), format % args)
 
@@ -17,13 +78,125 @@ class RequestHandler(WSGIRequestHandler):
         self.logger.info("%s %s", self.address_string(), format % args)
 
 
-def run_server(app, host: str = None, port: int = None):
-    httpd = make_server(host, port, app, handler_class=RequestHandler)
+class ThreadPoolMixIn:
+    """Handles requests on a bounded pool of threads.
+
+    Unlike socketserver.ThreadingMixIn, which starts a new thread for every
+    connection, at most 'pool_size' requests are handled at once. Once every
+    thread is busy the server stops accepting, and further connections wait in
+    the listen backlog ('backlog') until a thread is free again."""
+
+    multithread = True
+
+    def __init__(self, *args, pool_size=16, backlog=64, request_timeout=None, **kw):
+        self.pool_size = pool_size
+        self.request_queue_size = backlog
+        self.request_timeout = request_timeout
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._pool = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="ankisyncd.http"
+        )
+        super().__init__(*args, **kw)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._pool.submit(self.process_request_thread, request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    pass
+
+
+def make_threaded_server(
+    host, port, app, pool_size=16, backlog=64, request_timeout=None
+):
+    """Create a ThreadPoolWSGIServer serving 'app' on host:port."""
+    httpd = ThreadPoolWSGIServer(
+        (host, port),
+        RequestHandler,
+        pool_size=pool_size,
+        backlog=backlog,
+        request_timeout=request_timeout,
+    )
+    httpd.set_app(app)
+    return httpd
+
+
+def _server_settings(config):
+    timeout = config.get("server_timeout", "90")
+    return {
+        "mode": config.get("server_mode", "simple"),
+        "pool_size": int(config.get("server_threads", 16)),
+        "backlog": int(config.get("server_backlog", 64)),
+        "request_timeout": float(timeout) if timeout else None,
+        "max_body_size": int(config.get("max_payload_size", 512)) * 1024 * 1024,
+    }
+
+
+def run_server(app, host: str = None, port: int = None, config=None):
+    settings = _server_settings(config or {})
+    mode = settings["mode"]
+
+    if mode == "simple":
+        httpd = make_server(host, port, app, handler_class=RequestHandler)
+        httpd.request_timeout = settings["request_timeout"]
+    elif mode == "threaded":
+        httpd = make_threaded_server(
+            host,
+            port,
+            app,
+            pool_size=settings["pool_size"],
+            backlog=settings["backlog"],
+            request_timeout=settings["request_timeout"],
+        )
+    elif mode == "asyncio":
+        httpd = AsyncWSGIServer(
+            host,
+            port,
+            app,
+            pool_size=settings["pool_size"],
+            backlog=settings["backlog"],
+            request_timeout=settings["request_timeout"],
+            max_body_size=settings["max_body_size"],
+        )
+    elif mode == "prefork":
+        raise ValueError(
+            "server_mode = prefork runs one SyncApp per worker, "
+            "use ankisyncd.prefork.run_prefork_server() instead"
+        )
+    else:
+        raise ValueError(
+            "Unknown server_mode {!r}, expected one of: {}".format(
+                mode, ", ".join(SERVER_MODES)
+            )
+        )
 
     try:
-        logger.info("Serving HTTP on {} port {}...".format(*httpd.server_address))
+        logger.info(
+            "Serving HTTP on {} port {} ({} mode)...".format(
+                *httpd.server_address, mode
+            )
+        )
         httpd.serve_forever()
     except KeyboardInterrupt:
         logger.info("Exiting...")
     finally:
+        httpd.server_close()
         shutdown()
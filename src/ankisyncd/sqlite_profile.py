@@ -0,0 +1,60 @@
+"""sqlite settings for collections and their media databases.
+
+A profile is a set of pragmas applied whenever a collection or its media
+database is opened. 'sqlite_profile' picks one of PROFILES, and
+'sqlite_pragmas' overrides single pragmas, e.g. "mmap_size: 0, cache_size:
+-2000". Larger caches and memory-mapped I/O mostly speed up the read-heavy
+parts of a sync on large collections, at the cost of memory per open
+collection."""
+import re
+
+PROFILES = {
+    # whatever anki and sqlite set
+    "anki": {},
+    "fast": {
+        "journal_mode": "wal",
+        "temp_store": "memory",
+        # in KiB when negative
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+    "large": {
+        "journal_mode": "wal",
+        "temp_store": "memory",
+        "cache_size": -256 * 1024,
+        "mmap_size": 2048 * 1024 * 1024,
+    },
+}
+DEFAULT_PROFILE = "anki"
+
+_PRAGMA_RE = re.compile(r"^\s*(\w+)\s*:\s*(-?\w+)\s*$")
+
+
+def parse_pragmas(value):
+    """Parse "name: value, ..." into a dict of pragmas."""
+    pragmas = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        match = _PRAGMA_RE.match(item)
+        if match is None:
+            raise ValueError("invalid pragma: {!r}".format(item))
+        pragmas[match.group(1)] = match.group(2)
+    return pragmas
+
+
+def get_pragmas(config):
+    """The (name, value) pragmas configured for collections."""
+    name = config.get("sqlite_profile", DEFAULT_PROFILE)
+    try:
+        pragmas = dict(PROFILES[name])
+    except KeyError:
+        raise ValueError("unknown sqlite_profile: {!r}".format(name))
+    pragmas.update(parse_pragmas(config.get("sqlite_pragmas", "")))
+    return list(pragmas.items())
+
+
+def apply_pragmas(db, pragmas):
+    """Set 'pragmas' on 'db', which mustn't be in a transaction."""
+    for name, value in pragmas:
+        db.execute("pragma {} = {}".format(name, value))
@@ -4,12 +4,14 @@
 
 # Taken from https://github.com/ankitects/anki/blob/cca3fcb2418880d0430a5c5c2e6b81ba260065b7/anki/sync.py
 
+import contextlib
 import io
 import gzip
 import random
 import requests
 import json
 import os
+import time
 from typing import List, Tuple
 
 from anki.db import DB, DBError
@@ -27,6 +29,19 @@ SYNC_VER = 10
 SYNC_ZIP_SIZE = int(2.5 * 1024 * 1024)
 # https://github.com/ankitects/anki/blob/cca3fcb2418880d0430a5c5c2e6b81ba260065b7/anki/consts.py#L51
 SYNC_ZIP_COUNT = 25
+# revlog entries, cards and notes sent per 'chunk' response
+CHUNK_ROWS = 1000
+# what 'chunk' sends of each table, with the usn (the ?) set to maxUsn
+CHUNK_COLUMNS = {
+    "revlog": "id, cid, ?, ease, ivl, lastIvl, factor, time, type",
+    "cards": "id, nid, did, ord, mod, ?, type, queue, due, ivl, factor, reps, "
+    "lapses, left, odue, odid, flags, data",
+    "notes": "id, guid, mid, mod, ?, tags, flds, '', '', flags, data",
+}
+# pragmas while applying an incoming sync, which is committed only once
+APPLY_PRAGMAS = (("journal_mode", "wal"), ("synchronous", "normal"))
+# seconds without a step after which an incoming sync is taken as abandoned
+APPLY_TIMEOUT = 300
 
 # syncing vars
 HTTP_TIMEOUT = 90
@@ -37,10 +52,30 @@ HTTP_BUF_SIZE = 64 * 1024
 ##########################################################################
 
 
+class IncomingSync:
+    """An incoming sync being applied to a collection, between
+    Syncer.beginApply() and endApply(). It belongs to the collection rather
+    than to a session, and is kept on its CollectionWrapper."""
+
+    def __init__(self, owner, saved_pragmas):
+        self.owner = owner
+        self.saved_pragmas = saved_pragmas
+        self.touch()
+
+    def touch(self):
+        """Note that a step of the sync just ran."""
+        self.last_step = time.monotonic()
+
+    def abandoned(self, timeout=APPLY_TIMEOUT):
+        """Whether the sync has had no step for 'timeout' seconds."""
+        return time.monotonic() - self.last_step > timeout
+
+
 class Syncer(object):
-    def __init__(self, col, server=None):
+    def __init__(self, col, server=None, chunk_rows=CHUNK_ROWS):
         self.col = col
         self.server = server
+        self.chunkRows = chunk_rows
 
     # new added functions related to Syncer:
     #  these are removed from latest anki module
@@ -169,48 +204,112 @@ select id from notes where mid = ?) limit 1"""
         # even though that now is None will not happen,have to match a gurad case
         return None
 
+    # Applying an incoming sync
+    ##########################################################################
+
+    def beginApply(self, owner=None):
+        """Start applying an incoming sync from 'owner'. Until endApply(),
+        changes go into a single transaction, written with APPLY_PRAGMAS.
+        Returns the IncomingSync to pass to endApply()."""
+        db = self.col.db
+        self.col.save(trx=False)
+        saved = [(name, db.scalar("pragma %s" % name)) for name, _ in APPLY_PRAGMAS]
+        for name, value in APPLY_PRAGMAS:
+            db.execute("pragma %s = %s" % (name, value))
+        db.begin()
+        return IncomingSync(owner, saved)
+
+    def endApply(self, incoming):
+        """Commit the 'incoming' sync and restore the pragmas."""
+        db = self.col.db
+        self.col.save(trx=False)
+        for name, value in incoming.saved_pragmas:
+            db.execute("pragma %s = %s" % (name, value))
+        # the commit wasn't synced to disk, the checkpoint is
+        db.execute("pragma wal_checkpoint")
+        db.begin()
+
+    @contextlib.contextmanager
+    def savepoint(self):
+        """Undo the changes made in the block if it raises, leaving the
+        transaction open."""
+        db = self.col.db
+        db.execute("savepoint sync_step")
+        try:
+            yield
+        except Exception:
+            db.execute("rollback to sync_step")
+            raise
+        finally:
+            db.execute("release sync_step")
+
     # Chunked syncing
     ##########################################################################
 
     def prepareToChunk(self):
         self.tablesLeft = ["revlog", "cards", "notes"]
+        # (usn, id) of the last row sent from tablesLeft[-1]
         self.cursor = None
 
-    def queryTable(self, table):
-        lim = self.usnLim()
-        if table == "revlog":
-            return self.col.db.execute(
-                """
-select id, cid, ?, ease, ivl, lastIvl, factor, time, type
-from revlog where %s"""
-                % lim,
-                self.maxUsn,
-            )
-        elif table == "cards":
-            return self.col.db.execute(
-                """
-select id, nid, did, ord, mod, ?, type, queue, due, ivl, factor, reps,
-lapses, left, odue, odid, flags, data from cards where %s"""
-                % lim,
-                self.maxUsn,
-            )
+    def queryTable(self, table, after=None, limit=-1):
+        """Up to 'limit' rows of 'table' to send, starting after the (usn, id)
+        cursor 'after'. Rows are sent by usn and id, but with the rows of usn
+        -1 last, as marking them sent moves them to maxUsn."""
+        if after is None:
+            after = (0, -1)
+        # a query per range, each of which searches the usn index, where
+        # '(usn, id) > (?, ?)' would only be bounded by the usn
+        if after[0] == -1:
+            ranges = ["usn = -1 and id > %d" % after[1]]
         else:
-            return self.col.db.execute(
-                """
-select id, guid, mid, mod, ?, tags, flds, '', '', flags, data
-from notes where %s"""
-                % lim,
+            ranges = ["usn = %d and id > %d" % after, "usn > %d" % after[0], "usn = -1"]
+        rows = []
+        for lim in ranges:
+            rows += self.col.db.execute(
+                "select %s from %s where %s and %s order by usn, id limit ?"
+                % (CHUNK_COLUMNS[table], table, self.usnLim(), lim),
                 self.maxUsn,
+                limit - len(rows) if limit >= 0 else -1,
             )
+            if len(rows) == limit:
+                break
+        return rows
+
+    def markSent(self, table, after, upto):
+        """Set the usn of the rows of usn -1 sent from after the (usn, id)
+        cursor 'after' up to and including 'upto', or to the end if None."""
+        if upto is not None and upto[0] > -1:
+            # not up to the rows of usn -1 yet
+            return
+        lim = "usn = -1 and %s" % self.usnLim()
+        if after is not None and after[0] == -1:
+            lim += " and id > %d" % after[1]
+        if upto is not None:
+            lim += " and id <= %d" % upto[1]
+        self.col.db.execute("update %s set usn=? where %s" % (table, lim), self.maxUsn)
 
     def chunk(self):
+        """The next chunkRows rows to send, picking up after the last row
+        sent by the previous call."""
         buf = dict(done=False)
-        while self.tablesLeft:
-            curTable = self.tablesLeft.pop()
-            buf[curTable] = self.queryTable(curTable)
-            self.col.db.execute(
-                f"update {curTable} set usn=? where usn=-1", self.maxUsn
-            )
+        left = self.chunkRows
+        while self.tablesLeft and left > 0:
+            curTable = self.tablesLeft[-1]
+            rows = self.queryTable(curTable, self.cursor, left)
+            buf[curTable] = rows
+            if len(rows) < left:
+                self.tablesLeft.pop()
+                upto = None
+            else:
+                id = rows[-1][0]
+                usn = self.col.db.scalar(
+                    "select usn from %s where id = ?" % curTable, id
+                )
+                upto = (usn, id)
+            if rows:
+                self.markSent(curTable, self.cursor, upto)
+            self.cursor = upto
+            left -= len(rows)
         if not self.tablesLeft:
             buf["done"] = True
         return buf
@@ -323,20 +422,28 @@ from notes where %s"""
         )
 
     def newerRows(self, data, table, modIdx):
-        ids = (r[0] for r in data)
-        lmods = {}
-        for id, mod in self.col.db.execute(
-            "select id, mod from %s where id in %s and %s"
-            % (table, ids2str(ids), self.usnLim())
-        ):
-            lmods[id] = mod
-        update = []
-        for r in data:
-            if r[0] not in lmods or lmods[r[0]] < r[modIdx]:
-                update.append(r)
-        # replace col.log by just using print
-        print(table, data)
-        return update
+        """The rows in 'data' that are missing locally or newer than ours."""
+        # load the incoming ids and mods into a temp table and join it with
+        # 'table' on its primary key, rather than sending a huge 'id in (...)'
+        db = self.col.db
+        db.execute("create temp table if not exists sync_rows (rid int, rmod int)")
+        # as one JSON parameter: executemany() crosses into the backend for
+        # every row
+        db.execute(
+            "insert into sync_rows select cast(key as int), value from json_each(?)",
+            json.dumps({r[0]: r[modIdx] for r in data}),
+        )
+        try:
+            # the rows to skip, which are usually few
+            not_newer = set(
+                db.list(
+                    "select rid from sync_rows join %s on id = rid and %s "
+                    "where mod >= rmod" % (table, self.usnLim())
+                )
+            )
+        finally:
+            db.execute("delete from sync_rows")
+        return [r for r in data if r[0] not in not_newer]
 
     def mergeCards(self, cards):
         self.col.db.executemany(
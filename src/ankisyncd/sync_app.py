@@ -14,19 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
 import gzip
 import io
-import json
 import logging
 import os
 import random
 import re
 import sys
+import tempfile
 import time
 import unicodedata
 import zipfile
+import zlib
 import types
 from webob import Response
+from webob.acceptparse import create_accept_encoding_header
 from webob.exc import *
 import urllib.parse
 from functools import wraps
@@ -34,9 +37,30 @@ from anki.collection import Collection
 import anki.db
 import anki.utils
 from anki.consts import REM_CARD, REM_NOTE
+from ankisyncd.exceptions import (
+    BadRequestException,
+    CollectionBusyException,
+    PayloadTooLargeException,
+    ServerBusyException,
+)
+from ankisyncd import json_codec, metrics
+from ankisyncd.admission import WeightedSemaphore
 from ankisyncd.full_sync import get_full_sync_manager
+from ankisyncd.responses import call_on_close
+from ankisyncd.multipart import (
+    ChunkedReader,
+    LimitedReader,
+    MultipartParser,
+    SPOOL_MAX_SIZE,
+)
 from ankisyncd.sessions import get_session_manager
-from ankisyncd.sync import Syncer, SYNC_VER, SYNC_ZIP_SIZE, SYNC_ZIP_COUNT
+from ankisyncd.sync import (
+    CHUNK_ROWS,
+    Syncer,
+    SYNC_VER,
+    SYNC_ZIP_SIZE,
+    SYNC_ZIP_COUNT,
+)
 from ankisyncd.users import get_user_manager
 
 logger = logging.getLogger("ankisyncd")
@@ -54,11 +78,53 @@ class SyncCollectionHandler(Syncer):
         "finish",
     ]
 
-    def __init__(self, col, session):
+    def __init__(self, col, session, chunk_rows=CHUNK_ROWS):
         # So that 'server' (the 3rd argument) can't get set
-        super().__init__(col)
+        super().__init__(col, chunk_rows=chunk_rows)
         self.session = session
 
+    @contextlib.contextmanager
+    def step(self, operation):
+        """Run the handler for 'operation'. From start to finish, the whole
+        incoming sync is one transaction, committed by finish, and each
+        request runs in a savepoint. Other requests are committed on their
+        own, unless another session's incoming sync is open, which commits
+        them with its own.
+
+        The incoming sync belongs to the collection: while one is applied,
+        'start' from another session raises CollectionBusyException."""
+        wrapper = self.session.get_thread()
+        incoming = wrapper.applying
+        own = incoming is not None and incoming.owner == self.session.skey
+        if incoming is not None and (
+            incoming.abandoned() or (own and operation in ("meta", "start"))
+        ):
+            # the last sync never finished, keep what it applied
+            wrapper.applying = None
+            self.endApply(incoming)
+            incoming, own = None, False
+        if operation == "start":
+            if incoming is not None:
+                raise CollectionBusyException()
+            wrapper.applying = incoming = self.beginApply(self.session.skey)
+            own = True
+        if incoming is None:
+            yield
+            self.col.save()
+        elif not own:
+            with self.savepoint():
+                yield
+        elif operation == "finish":
+            try:
+                yield
+            finally:
+                wrapper.applying = None
+                self.endApply(incoming)
+        else:
+            incoming.touch()
+            with self.savepoint():
+                yield
+
     @staticmethod
     def _old_client(cv):
         if not cv:
@@ -219,6 +285,14 @@ class SyncMediaHandler:
         self.col = col
         self.session = session
 
+    @contextlib.contextmanager
+    def step(self, operation):
+        """Run the handler for 'operation' and commit its changes, unless an
+        incoming sync is being applied, which commits them with its own."""
+        yield
+        if self.session.get_thread().applying is None:
+            self.col.save()
+
     def begin(self, skey):
         return {
             "data": {
@@ -234,7 +308,9 @@ class SyncMediaHandler:
         yet ('dirty'), and info on files it has deleted from its own media dir.
         """
 
-        with zipfile.ZipFile(io.BytesIO(data), "r") as z:
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+        with zipfile.ZipFile(data, "r") as z:
             self._check_zip_data(z)
             processed_count = self._adopt_media_changes_from_zip(z)
 
@@ -268,7 +344,7 @@ class SyncMediaHandler:
         """
 
         # Get meta info first.
-        meta = json.loads(zip_file.read("_meta").decode())
+        meta = json_codec.loads(zip_file.read("_meta"))
 
         # Remove media files that were removed on the client.
         media_to_remove = []
@@ -361,7 +437,7 @@ class SyncMediaHandler:
                     break
                 cnt += 1
 
-            z.writestr("_meta", json.dumps(flist))
+            z.writestr("_meta", json_codec.dumps(flist))
 
         return f.getvalue()
 
@@ -392,12 +468,20 @@ class SyncMediaHandler:
 
 
 class SyncUserSession:
-    def __init__(self, name, path, collection_manager, setup_new_collection=None):
+    def __init__(
+        self,
+        name,
+        path,
+        collection_manager,
+        setup_new_collection=None,
+        chunk_rows=CHUNK_ROWS,
+    ):
         self.skey = self._generate_session_key()
         self.name = name
         self.path = path
         self.collection_manager = collection_manager
         self.setup_new_collection = setup_new_collection
+        self.chunk_rows = chunk_rows
         self.version = None
         self.client_version = None
         self.created = time.time()
@@ -422,13 +506,15 @@ class SyncUserSession:
     def get_handler_for_operation(self, operation, col):
         if operation in SyncCollectionHandler.operations:
             attr, handler_class = "collection_handler", SyncCollectionHandler
+            kw = {"chunk_rows": self.chunk_rows}
         elif operation in SyncMediaHandler.operations:
             attr, handler_class = "media_handler", SyncMediaHandler
+            kw = {}
         else:
             raise Exception("no handler for {}".format(operation))
 
         if getattr(self, attr) is None:
-            setattr(self, attr, handler_class(col, self))
+            setattr(self, attr, handler_class(col, self, **kw))
         handler = getattr(self, attr)
         # The col object may actually be new now! This happens when we close a collection
         # for inactivity and then later re-open it (creating a new Collection object).
@@ -437,8 +523,22 @@ class SyncUserSession:
 
 
 class Requests(object):
-    def __init__(self, environ: dict):
+    def __init__(
+        self,
+        environ: dict,
+        spool_max_size=SPOOL_MAX_SIZE,
+        spool_dir=None,
+        max_payload_size=None,
+    ):
         self.environ = environ
+        # file fields larger than spool_max_size are moved to spool_dir
+        self.spool_max_size = spool_max_size
+        self.spool_dir = spool_dir
+        # bodies larger than max_payload_size are rejected, before being read
+        # when their Content-Length is known
+        self.max_payload_size = max_payload_size
+        # set by parse
+        self.body_size = 0
 
     @property
     def params(self):
@@ -474,48 +574,20 @@ class Requests(object):
         content_len = env.get("CONTENT_LENGTH", "0")
         input = env.get("wsgi.input")
         length = 0 if content_len == "" else int(content_len)
-        body = b""
         request_items_dict = {}
         if length == 0:
             if input is None:
                 return request_items_dict
             if env.get("HTTP_TRANSFER_ENCODING", "0") == "chunked":
-                # readlines and read(no argument) will block
-                # convert byte str to number base 16
-                leng = int(input.readline(), 16)
-                c = 0
-                bdry = b""
-                data = []
-                data_other = []
-                while leng > 0:
-                    c += 1
-                    dt = input.read(leng + 2)
-                    if c == 1:
-                        bdry = dt
-                    elif c >= 3:
-                        # data
-                        data_other.append(dt)
-                    leng = int(input.readline(), 16)
-                data_other = [item for item in data_other if item != b"\r\n\r\n"]
-                for item in data_other:
-                    if bdry in item:
-                        break
-                    # only strip \r\n if there are extra \n
-                    # eg b'?V\xc1\x8f>\xf9\xb1\n\r\n'
-                    data.append(item[:-2])
-                request_items_dict["data"] = b"".join(data)
-                others = data_other[len(data) :]
-                boundary = others[0]
-                others = b"".join(others).split(boundary.strip())
-                others.pop()
-                others.pop(0)
-                for i in others:
-                    i = i.splitlines()
-                    key = re.findall(b'name="(.*?)"', i[2], flags=re.M)[0].decode(
-                        "utf-8"
-                    )
-                    v = i[-1].decode("utf-8")
-                    request_items_dict[key] = v
+                reader = ChunkedReader(input, self.max_payload_size)
+                parser = MultipartParser(
+                    reader,
+                    spool_max_size=self.spool_max_size,
+                    spool_dir=self.spool_dir,
+                    max_file_size=self.max_payload_size,
+                )
+                request_items_dict.update(parser)
+                self.body_size = reader.size
                 return request_items_dict
 
             if query_string != "":
@@ -526,47 +598,73 @@ class Requests(object):
                     request_items_dict[k] = "".join(v)
                 return request_items_dict
 
-        else:
-            body = env["wsgi.input"].read(length)
-
-        if body is None or body == b"":
             return request_items_dict
-            # process body to dict
-        repeat = body.splitlines()[0]
-        items = re.split(repeat, body)
-        # del first ,last item
-        items.pop()
-        items.pop(0)
-        for item in items:
-            if b'name="data"' in item:
-                data_field = None
-                # remove \r\n
-                if b"application/octet-stream" in item:
-                    # Ankidroid case
-                    item = re.sub(
-                        b'Content-Disposition: form-data; name="data"; filename="data"',
-                        b"",
-                        item,
-                    )
-                    item = re.sub(b"Content-Type: application/octet-stream", b"", item)
-                    data_field = item.strip()
-                else:
-                    # PKzip file stream and others
-                    item = re.sub(
-                        b'Content-Disposition: form-data; name="data"; filename="data"',
-                        b"",
-                        item,
-                    )
-                    data_field = item.strip()
-                request_items_dict["data"] = data_field
-                continue
-            item = re.sub(b"\r\n", b"", item, flags=re.MULTILINE)
-            key = re.findall(b'name="(.*?)"', item)[0].decode("utf-8")
-            v = item[item.rfind(b'"') + 1 :].decode("utf-8")
-            request_items_dict[key] = v
+
+        # process body to dict
+        self.body_size = length
+        if self.max_payload_size is not None and length > self.max_payload_size:
+            raise PayloadTooLargeException(
+                "Request body is larger than {} bytes.".format(self.max_payload_size)
+            )
+        parser = MultipartParser(
+            LimitedReader(input, length),
+            spool_max_size=self.spool_max_size,
+            spool_dir=self.spool_dir,
+            max_file_size=self.max_payload_size,
+        )
+        request_items_dict.update(parser)
         return request_items_dict
 
 
+def iter_payload(fileobj, compressed, max_size, block_size=65536):
+    """Read a request payload from 'fileobj' in blocks, gunzipping it if
+    'compressed'.
+
+    The payload is decompressed a block at a time and rejected as soon as it
+    grows past 'max_size' bytes, so a small gzip bomb can't expand into a
+    huge buffer first."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    size = 0
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            break
+        if decompressor is None:
+            size += len(block)
+            if size > max_size:
+                break
+            yield block
+            continue
+        try:
+            while block and size <= max_size:
+                data = decompressor.decompress(block, max_size + 1 - size)
+                size += len(data)
+                if size <= max_size:
+                    yield data
+                block = decompressor.unconsumed_tail
+        except zlib.error:
+            raise BadRequestException("Invalid gzip data.")
+        if size > max_size:
+            break
+    if size > max_size:
+        raise PayloadTooLargeException(
+            "Request payload is larger than {} bytes.".format(max_size)
+        )
+    if decompressor is not None and not decompressor.eof:
+        raise BadRequestException("Truncated gzip data.")
+
+
+# environ key of the functions to call once the response has been sent
+ON_CLOSE = "ankisyncd.on_close"
+# environ key set once a request holds its share of the heavy operations budget
+ADMITTED = "ankisyncd.admitted"
+
+
+def _call_all(callbacks):
+    for callback in callbacks:
+        callback()
+
+
 class chunked(object):
     """decorator"""
 
@@ -577,14 +675,42 @@ class chunked(object):
         clss = args[0]
         environ = args[1]
         start_response = args[2]
-        b = Requests(environ)
+        start = time.monotonic()
+        operation = clss.operation_for_path(environ.get("PATH_INFO", ""))
+        b = Requests(
+            environ, clss.spool_max_size, clss.data_root, clss.max_payload_size
+        )
         args = (
             clss,
             b,
         )
-        w = self.__wrapped__(*args, **kwargs)
-        resp = Response(w)
-        return resp(environ, start_response)
+        try:
+            w = self.__wrapped__(*args, **kwargs)
+        except HTTPException as e:
+            resp = e
+        except Exception:
+            metrics.REQUESTS.inc(operation=operation, status=500)
+            _call_all(environ.pop(ON_CLOSE, ()))
+            raise
+        else:
+            resp = w if isinstance(w, Response) else Response(w)
+            resp = clss.compress_response(environ, resp, operation)
+
+        metrics.REQUESTS.inc(operation=operation, status=resp.status_code)
+        metrics.REQUEST_DURATION.observe(time.monotonic() - start, operation=operation)
+        metrics.REQUEST_SIZE.observe(b.body_size, operation=operation)
+        if resp.content_length is not None:
+            metrics.RESPONSE_SIZE.observe(resp.content_length, operation=operation)
+
+        on_close = environ.pop(ON_CLOSE, ())
+        try:
+            result = resp(environ, start_response)
+        except Exception:
+            _call_all(on_close)
+            raise
+        for callback in on_close:
+            result = call_on_close(result, callback)
+        return result
 
     def __get__(self, instance, cls):
         if instance is None:
@@ -599,6 +725,14 @@ class SyncApp:
         + SyncMediaHandler.operations
         + ["hostKey", "upload", "download"]
     )
+    # operations that go through admission control, uploads before their body
+    # is read
+    upload_operations = ("upload", "uploadChanges")
+    heavy_operations = upload_operations + ("download", "downloadFiles")
+    # operations whose responses are compressed already (media zips) or
+    # binary, and aren't gzipped again
+    uncompressed_operations = ("download", "downloadFiles")
+    uncompressed_types = ("application/zip", "application/octet-stream")
 
     def __init__(self, config):
         from ankisyncd.thread import get_collection_manager
@@ -607,6 +741,28 @@ class SyncApp:
         self.base_url = config["base_url"]
         self.base_media_url = config["base_media_url"]
         self.setup_new_collection = None
+        self.max_payload_size = int(config.get("max_payload_size", 512)) * 1024 * 1024
+        self.spool_max_size = int(config.get("spool_max_size", 1024)) * 1024
+        self.response_gzip_level = int(config.get("response_gzip_level", 6))
+        self.response_gzip_min_size = int(config.get("response_gzip_min_size", 1024))
+        # disabled unless set
+        self.metrics_url = config.get("metrics_url") or None
+        self.admission = WeightedSemaphore(
+            int(config.get("heavy_operations_budget", 1024)) * 1024 * 1024
+        )
+        self.max_heavy_operations = int(config.get("max_heavy_operations", 4))
+        self.heavy_operations_timeout = (
+            float(config.get("heavy_operations_timeout", 300)) or None
+        )
+        # waiting holds a request thread, keep some for everything else
+        self.max_heavy_operations_waiting = int(
+            config.get(
+                "max_heavy_operations_waiting",
+                int(config.get("server_threads", 16)) // 2,
+            )
+        )
+        self.warm_up_collections = int(config.get("warm_up_collections", 1))
+        self.chunk_rows = int(config.get("sync_chunk_rows", CHUNK_ROWS))
 
         self.user_manager = get_user_manager(config)
         self.session_manager = get_session_manager(config)
@@ -637,20 +793,141 @@ class SyncApp:
 
     def create_session(self, username, user_path):
         return SyncUserSession(
-            username, user_path, self.collection_manager, self.setup_new_collection
+            username,
+            user_path,
+            self.collection_manager,
+            self.setup_new_collection,
+            self.chunk_rows,
         )
 
-    def _decode_data(self, data, compression=0):
-        if compression:
-            with gzip.GzipFile(mode="rb", fileobj=io.BytesIO(data)) as gz:
-                data = gz.read()
+    def operation_for_path(self, path):
+        """Name of the operation requested at 'path', for metrics."""
+        if path == self.metrics_url:
+            return "metrics"
+        for base_url in (self.base_url, self.base_media_url):
+            if path.startswith(base_url) and path[len(base_url) :] in self.valid_urls:
+                return path[len(base_url) :]
+        return "other"
+
+    def serve_metrics(self):
+        self.collection_manager.collect_metrics()
+        metrics.HEAVY_OPERATIONS_WAITING.set(self.admission.waiting)
+        metrics.HEAVY_OPERATIONS_COST.set(self.admission.in_use)
+        return Response(
+            metrics.REGISTRY.render(),
+            content_type="text/plain; version=0.0.4",
+            charset="utf-8",
+        )
+
+    def operation_cost(self, operation, session, environ):
+        """Estimate the memory and I/O (in bytes) a heavy operation will use.
+
+        Uploads are estimated by the size of their request body, as sent. Every
+        operation costs at least a max_heavy_operations share of the budget,
+        which caps how many of them run at once."""
+        if operation == "download":
+            try:
+                cost = os.path.getsize(session.get_collection_path())
+            except OSError:
+                cost = 0
+        elif operation == "downloadFiles":
+            cost = SYNC_ZIP_SIZE
+        else:
+            # unknown for chunked bodies
+            cost = int(environ.get("CONTENT_LENGTH") or 0)
+        return max(cost, self.admission.capacity // self.max_heavy_operations)
+
+    @contextlib.contextmanager
+    def admit(self, operation, session, environ):
+        """Hold the cost of 'operation' out of the heavy operations budget
+        until its response has been sent, or raise ServerBusyException if it
+        isn't available within heavy_operations_timeout, or if
+        max_heavy_operations_waiting requests are waiting for it already.
+        Other operations, and requests admitted already, are let through at
+        once."""
+        if operation not in self.heavy_operations or environ.get(ADMITTED):
+            yield
+            return
 
+        cost = self.operation_cost(operation, session, environ)
+        start = time.monotonic()
+        if not self.admission.acquire(
+            cost, self.heavy_operations_timeout, self.max_heavy_operations_waiting
+        ):
+            metrics.HEAVY_OPERATIONS_REJECTED.inc(operation=operation)
+            logger.warning("Too many heavy operations, rejecting %s", operation)
+            raise ServerBusyException()
+        metrics.ADMISSION_WAIT.observe(time.monotonic() - start, operation=operation)
+        environ[ADMITTED] = True
         try:
-            data = json.loads(data.decode())
-        except (ValueError, UnicodeDecodeError):
-            data = {"data": data}
+            yield
+        except BaseException:
+            self.admission.release(cost)
+            raise
+        # see chunked
+        environ.setdefault(ON_CLOSE, []).append(lambda: self.admission.release(cost))
+
+    def compress_response(self, environ, resp, operation=None):
+        """Gzip the body of 'resp' to 'operation' if the client accepts it and
+        it is at least response_gzip_min_size bytes long."""
+        if (
+            not self.response_gzip_level
+            or operation in self.uncompressed_operations
+            or resp.content_type in self.uncompressed_types
+            or resp.content_encoding
+            or not isinstance(resp.app_iter, list)
+            or resp.content_length < self.response_gzip_min_size
+        ):
+            return resp
+
+        resp.vary = (resp.vary or ()) + ("Accept-Encoding",)
+        accept = environ.get("HTTP_ACCEPT_ENCODING")
+        if accept and create_accept_encoding_header(accept).quality("gzip"):
+            resp.body = gzip.compress(resp.body, self.response_gzip_level)
+            resp.content_encoding = "gzip"
+        return resp
 
-        return data
+    def _decode_data(self, data, compression=0):
+        """Decode a request payload.
+
+        JSON payloads are objects and are decoded in memory. Anything else
+        (collections, media zips) is passed on as a file object in
+        {"data": ...}, and kept in a temporary file under data_root when it
+        is larger than spool_max_size."""
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+
+        if not compression and data.read(1) != b"{":
+            # already spooled by the request parser
+            if data.seek(0, io.SEEK_END) > self.max_payload_size:
+                raise PayloadTooLargeException(
+                    "Request payload is larger than {} bytes.".format(
+                        self.max_payload_size
+                    )
+                )
+            data.seek(0)
+            return {"data": data}
+        data.seek(0)
+
+        blocks = iter_payload(data, compression, self.max_payload_size)
+        first = next(blocks, b"")
+        if first[:1] == b"{":
+            payload = bytearray(first)
+            for block in blocks:
+                payload += block
+            try:
+                return json_codec.loads(payload)
+            except (ValueError, UnicodeDecodeError):
+                return {"data": io.BytesIO(payload)}
+
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_max_size, dir=self.data_root
+        )
+        spool.write(first)
+        for block in blocks:
+            spool.write(block)
+        spool.seek(0)
+        return {"data": spool}
 
     def operation_hostKey(self, username, password):
         if not self.user_manager.authenticate(username, password):
@@ -664,9 +941,25 @@ class SyncApp:
         user_path = os.path.join(self.data_root, dirname)
         session = self.create_session(username, user_path)
         self.session_manager.save(hkey, session)
+        if self.warm_up_collections:
+            self.warm_up(session)
 
         return {"key": hkey}
 
+    @staticmethod
+    def warm_up(session):
+        """Start opening the collection of a user who just logged in, so that
+        it is open by the time their first sync request arrives."""
+        thread = session.get_thread()
+        if thread.opened():
+            return
+        try:
+            thread.submit(_warm_up, operation="warmUp")
+        except CollectionBusyException:
+            # the queued calls will open it
+            return
+        metrics.COLLECTION_WARM_UPS.inc()
+
     def operation_upload(self, col, data, session):
         # Verify integrity of the received database file before replacing our
         # existing db.
@@ -680,11 +973,28 @@ class SyncApp:
 
     @chunked
     def __call__(self, req):
+        if req.path == self.metrics_url:
+            return self.serve_metrics()
+
+        # uploads are admitted before their body is read, so that turning one
+        # away doesn't cost reading, spooling and decoding it first
+        operation = self.operation_for_path(req.path)
+        if operation in self.upload_operations:
+            with self.admit(operation, None, req.environ):
+                return self.handle(req)
+        return self.handle(req)
+
+    def handle(self, req):
         # cgi file can only be read once,and will be blocked after being read once more
         # so i call Requests.parse only once,and bind its return result to properties
         # POST and params (set return result as property values)
         req.params = req.parse
         req.POST = req.params
+        # files, e.g. spooled uploads, are closed once the response is sent
+        on_close = req.environ.setdefault(ON_CLOSE, [])
+        for value in req.params.values():
+            if hasattr(value, "close"):
+                on_close.append(value.close)
         try:
             hkey = req.params["k"]
         except KeyError:
@@ -705,6 +1015,8 @@ class SyncApp:
         try:
             data = req.POST["data"]
             data = self._decode_data(data, compression)
+            if hasattr(data.get("data"), "close"):
+                on_close.append(data["data"].close)
         except KeyError:
             data = {}
 
@@ -716,7 +1028,7 @@ class SyncApp:
             if url == "hostKey":
                 result = self.operation_hostKey(data.get("u"), data.get("p"))
                 if result:
-                    return json.dumps(result)
+                    return json_codec.dumps(result)
                 else:
                     # TODO: do I have to pass 'null' for the client to receive None?
                     raise HTTPForbidden("null")
@@ -736,22 +1048,34 @@ class SyncApp:
 
                     self.session_manager.save(hkey, session)
                     session = self.session_manager.load(hkey, self.create_session)
-                thread = session.get_thread()
+                    warm = session.get_thread().opened()
+                    start = time.monotonic()
                 result = self._execute_handler_method_in_thread(url, data, session)
+                if url == "meta":
+                    metrics.META_DURATION.observe(
+                        time.monotonic() - start,
+                        collection="warm" if warm else "cold",
+                    )
                 # If it's a complex data type, we convert it to JSON
                 if type(result) not in (str, bytes, Response):
-                    result = json.dumps(result)
+                    result = json_codec.dumps(result)
 
                 return result
 
             elif url == "upload":
                 thread = session.get_thread()
-                result = thread.execute(self.operation_upload, [data["data"], session])
-                return result
+                return thread.execute(
+                    self.operation_upload,
+                    [data["data"], session],
+                    operation="upload",
+                )
 
             elif url == "download":
                 thread = session.get_thread()
-                result = thread.execute(self.operation_download, [session])
+                with self.admit(url, session, req.environ):
+                    result = thread.execute(
+                        self.operation_download, [session], operation="download"
+                    )
                 return result
 
             # This was one of our operations but it didn't get handled... Oops!
@@ -770,11 +1094,12 @@ class SyncApp:
             if url == "begin":
                 data["skey"] = session.skey
 
-            result = self._execute_handler_method_in_thread(url, data, session)
+            with self.admit(url, session, req.environ):
+                result = self._execute_handler_method_in_thread(url, data, session)
 
             # If it's a complex data type, we convert it to JSON
             if type(result) not in (str, bytes):
-                result = json.dumps(result)
+                result = json_codec.dumps(result)
 
             return result
 
@@ -789,13 +1114,21 @@ class SyncApp:
         """
 
         def run_func(col, **keyword_args):
-            # Retrieve the correct handler method.
-            handler = session.get_handler_for_operation(method_name, col)
-            handler_method = getattr(handler, method_name)
-
-            res = handler_method(**keyword_args)
-
-            col.save()
+            start = time.monotonic()
+            try:
+                # Retrieve the correct handler method.
+                handler = session.get_handler_for_operation(method_name, col)
+                handler_method = getattr(handler, method_name)
+
+                with handler.step(method_name):
+                    res = handler_method(**keyword_args)
+            except Exception:
+                metrics.HANDLER_ERRORS.inc(operation=method_name)
+                raise
+            finally:
+                metrics.HANDLER_DURATION.observe(
+                    time.monotonic() - start, operation=method_name
+                )
             return res
 
         run_func.__name__ = method_name  # More useful debugging messages.
@@ -807,5 +1140,9 @@ class SyncApp:
         return result
 
 
+def _warm_up(col):
+    """Nothing to do, the collection is opened before running this."""
+
+
 def make_app(global_conf, **local_conf):
     return SyncApp(**local_conf)
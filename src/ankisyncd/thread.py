@@ -1,9 +1,56 @@
+from ankisyncd import metrics
 from ankisyncd.collection import CollectionManager, get_collection_wrapper
-
-from threading import Thread
-from queue import Queue
-
-import time, logging
+from ankisyncd.exceptions import CollectionBusyException
+
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait as wait_futures
+from threading import Condition, Lock, Thread, current_thread
+from queue import Empty, Queue
+
+import heapq, itertools, math, time, logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Queued calls run in order of priority, lowest first. Cheap calls made while
+# a client waits come first, then the steps of a normal sync, then full
+# uploads/downloads and media transfers.
+PRIORITIES = {
+    "meta": 0,
+    "begin": 0,
+    "mediaChanges": 0,
+    "mediaSanity": 0,
+    "applyChanges": 1,
+    "start": 1,
+    "applyGraves": 1,
+    "chunk": 1,
+    "applyChunk": 1,
+    "sanityCheck2": 1,
+    "finish": 1,
+    "upload": 2,
+    "download": 2,
+    "uploadChanges": 2,
+    "downloadFiles": 2,
+}
+DEFAULT_PRIORITY = 1
+# internal calls (close, evict, stop) wait for all the others
+INTERNAL_PRIORITY = 3
+
+
+def parse_priorities(value):
+    """Parse a "name: priority, ..." setting into a dict."""
+    priorities = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, sep, priority = item.partition(":")
+        if not sep:
+            raise ValueError("expected 'name: priority', got {!r}".format(item))
+        priorities[name.strip()] = int(priority)
+    return priorities
 
 
 def short_repr(obj, logger=logging.getLogger(), maxlen=80):
@@ -30,19 +77,155 @@ def short_repr(obj, logger=logging.getLogger(), maxlen=80):
     return repr(o)
 
 
-class ThreadingCollectionWrapper:
-    """Provides the same interface as CollectionWrapper, but it creates a new Thread to
-    interact with the collection."""
+# seconds an idle worker waits for work before exiting
+WORKER_IDLE_TIMEOUT = 60
+# seconds between checks of the process' memory and file descriptor usage
+USAGE_CHECK_INTERVAL = 1
+# calls on a collection less than this many seconds apart belong to one sync
+SYNC_GAP = 10
+# weight of the latest gap between syncs in a collection's average
+SYNC_GAP_WEIGHT = 0.3
+# collections are kept open for this many times their average gap between
+# syncs, so that the next sync usually finds them open
+KEEP_OPEN_FACTOR = 1.5
+
+
+class WorkerPool:
+    """Up to 'size' threads that run the calls queued on any number of
+    ThreadingCollectionWrappers.
+
+    A wrapper with queued calls is scheduled on the pool once; a worker runs
+    one of its calls and schedules it again if more are queued. Calls for one
+    collection therefore never run at the same time, and collections take
+    turns on the workers. Workers are started when there is work and no idle
+    worker to take it, and exit after WORKER_IDLE_TIMEOUT idle seconds."""
+
+    def __init__(self, size, idle_timeout=WORKER_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._ready = Queue()
+        self._lock = Lock()
+        self._threads = set()
+        # workers waiting for work, and wrappers in _ready that no worker has
+        # taken yet, guarded by _lock
+        self._idle = 0
+        self._pending = 0
+
+    @property
+    def threads(self):
+        return len(self._threads)
+
+    @property
+    def busy(self):
+        with self._lock:
+            return len(self._threads) - self._idle
+
+    def schedule(self, wrapper):
+        """Have a worker call wrapper._run_one()."""
+        with self._lock:
+            self._ready.put(wrapper)
+            self._pending += 1
+            # one waiting worker for each pending wrapper, so that a wrapper
+            # scheduled before a waiting worker wakes up doesn't wait for the
+            # wrapper that worker is about to run
+            if self._pending > self._idle and len(self._threads) < self.size:
+                thread = Thread(target=self._work, daemon=True)
+                self._threads.add(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                wrapper = self._ready.get(True, self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    self._idle -= 1
+                    # something may have been scheduled since the timeout
+                    if self._ready.empty():
+                        self._threads.discard(current_thread())
+                        return
+                continue
+
+            with self._lock:
+                self._idle -= 1
+                self._pending -= 1
+            try:
+                wrapper._run_one()
+            finally:
+                self._ready.task_done()
+
+    def join(self):
+        """Wait until all scheduled calls have run."""
+        self._ready.join()
+
+
+def _func_name(func):
+    if hasattr(func, "__name__"):
+        return func.__name__
+    return func.__class__.__name__
+
 
-    def __init__(self, config, path, setup_new_collection=None):
+class ThreadingCollectionWrapper:
+    """Provides the same interface as CollectionWrapper, but interacts with
+    the collection on the threads of a WorkerPool, one call at a time. Without
+    a 'pool' the wrapper gets a pool of its own with a single thread. The
+    'listener', if any, has its collection_opened() and collection_closed()
+    called with the wrapper when the collection is opened or closed, and its
+    collection_resumed() with the wrapper and the idle time when it is used
+    after at least SYNC_GAP idle seconds.
+
+    submit() queues a call and returns a concurrent.futures.Future for its
+    result; execute() waits for that result.
+
+    Calls are ordered by the priority of their operation (see PRIORITIES and
+    'collection_priorities'), but every 'collection_priority_aging' seconds
+    spent waiting count as one priority level, so bulk calls aren't starved
+    by a steady stream of cheap ones.
+
+    At most 'collection_queue_size' calls may wait for the thread at once, and
+    execute() waits at most 'collection_timeout' seconds for a call to return.
+    Otherwise a CollectionBusyException is raised, so that a slow or stuck
+    collection only holds up requests for that one collection."""
+
+    def __init__(
+        self, config, path, setup_new_collection=None, pool=None, listener=None
+    ):
         self.path = path
+        self.pool = pool or WorkerPool(1)
+        self.listener = listener
         self.wrapper = get_collection_wrapper(config, path, setup_new_collection)
         self.logger = logging.getLogger("ankisyncd." + str(self))
 
-        self._queue = Queue()
-        self._thread = None
+        self.queue_size = int(config.get("collection_queue_size", 16))
+        self.timeout = float(config.get("collection_timeout", 300)) or None
+
+        self.priorities = dict(PRIORITIES)
+        self.priorities.update(
+            parse_priorities(config.get("collection_priorities", ""))
+        )
+        self.priority_aging = float(config.get("collection_priority_aging", 5))
+
+        # a heap of queued calls, and how many of them were submit()ted,
+        # guarded by _lock
+        self._queue = []
+        self._submitted = 0
+        self._counter = itertools.count()
+        # set while the wrapper is scheduled on the pool or being run
+        self._scheduled = False
+        self._lock = Lock()
+        self._worker = None
         self._running = False
+        # why the collection was last closed by evict(), if it was
+        self._closed_by = None
+        self.closing = False
+        # time of the last call, other than internal ones
         self.last_timestamp = time.time()
+        # average seconds between syncs, and how long to keep the collection
+        # open after its last use, set by the manager
+        self.sync_gap = None
+        self.keep_open = None
 
         self.start()
 
@@ -54,99 +237,228 @@ class ThreadingCollectionWrapper:
         return self._running
 
     def qempty(self):
-        return self._queue.empty()
+        return not self._queue
+
+    def qsize(self):
+        return len(self._queue)
 
     def current(self):
-        from threading import current_thread
+        return current_thread() == self._worker
+
+    def _put(self, func, args, kw, operation, bounded):
+        # with _lock held
+        if bounded:
+            priority = self.priorities.get(
+                operation or _func_name(func), DEFAULT_PRIORITY
+            )
+        else:
+            priority = INTERNAL_PRIORITY
+        # calls queued 'priority_aging' seconds earlier go first when their
+        # priority is one level lower
+        key = time.monotonic() + priority * self.priority_aging
+        future = Future()
+        heapq.heappush(
+            self._queue, (key, next(self._counter), future, func, args, kw, bounded)
+        )
+        if bounded:
+            self._submitted += 1
+        if not self._scheduled:
+            self._scheduled = True
+            self.pool.schedule(self)
+        return future
+
+    def submit(self, func, args=[], kw={}, operation=None):
+        """Queue a call of func(col, *args, **kw) on this thread and return a
+        Future for its result. 'operation' names the operation for picking
+        its priority, and defaults to the name of 'func'.
+
+        Raises CollectionBusyException if the queue is full. Cancelling the
+        Future before the call started means it never runs.
+        """
+        with self._lock:
+            if self._submitted < self.queue_size:
+                return self._put(func, args, kw, operation, True)
 
-        return current_thread() == self._thread
+        metrics.COLLECTION_BUSY.inc(reason="queue_full")
+        self.logger.warning("Queue is full, rejecting %s", _func_name(func))
+        raise CollectionBusyException()
 
-    def execute(self, func, args=[], kw={}, waitForReturn=True):
+    def execute(self, func, args=[], kw={}, waitForReturn=True, operation=None):
         """Executes a given function on this thread with the *args and **kw.
 
         If 'waitForReturn' is True, then it will block until the function has
         executed and return its return value.  If False, it will return None
         immediately and the function will be executed sometime later.
-        """
-
-        if waitForReturn:
-            return_queue = Queue()
-        else:
-            return_queue = None
-
-        self._queue.put((func, args, kw, return_queue))
 
-        if return_queue is not None:
-            ret = return_queue.get(True)
-            if isinstance(ret, Exception):
-                raise ret
-            return ret
+        Raises CollectionBusyException if 'waitForReturn' is True and either
+        the queue is full or the function doesn't return within the timeout.
+        Calls that time out before they started running are dropped.
+        """
 
-    def _run(self):
-        self.logger.info("Starting...")
+        if not waitForReturn:
+            # internal calls (close, stop) are never turned away
+            with self._lock:
+                self._put(func, args, kw, operation, False)
+            return
 
+        future = self.submit(func, args, kw, operation)
         try:
-            while self._running:
-                func, args, kw, return_queue = self._queue.get(True)
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            metrics.COLLECTION_BUSY.inc(reason="timeout")
+            self.logger.warning(
+                "%s didn't return within %ss", _func_name(func), self.timeout
+            )
+            raise CollectionBusyException()
+
+    def _run_one(self):
+        """Run the first queued call. Called by the pool's workers."""
+        with self._lock:
+            _, _, future, func, args, kw, bounded = heapq.heappop(self._queue)
+            if bounded:
+                self._submitted -= 1
 
-                if hasattr(func, "__name__"):
-                    func_name = func.__name__
+        try:
+            if not self._running:
+                # stopped, drop whatever was queued after that
+                future.cancel()
+            if future.set_running_or_notify_cancel():
+                self._worker = current_thread()
+                try:
+                    self._call(future, func, args, kw, bounded)
+                finally:
+                    self._worker = None
+        finally:
+            with self._lock:
+                if not self._queue:
+                    self._scheduled = False
                 else:
-                    func_name = func.__class__.__name__
+                    self.pool.schedule(self)
 
-                self.logger.info(
-                    "Running %s(*%s, **%s)",
-                    func_name,
-                    short_repr(args, self.logger),
-                    short_repr(kw, self.logger),
-                )
-                self.last_timestamp = time.time()
+    def _call(self, future, func, args, kw, bounded):
+        func_name = _func_name(func)
 
-                try:
-                    ret = self.wrapper.execute(func, args, kw, return_queue)
-                except Exception as e:
-                    self.logger.error(
-                        "Unable to %s(*%s, **%s): %s",
-                        func_name,
-                        repr(args),
-                        repr(kw),
-                        e,
-                        exc_info=True,
-                    )
-                    # we return the Exception which will be raise'd on the other end
-                    ret = e
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                "Running %s(*%s, **%s)",
+                func_name,
+                short_repr(args, self.logger),
+                short_repr(kw, self.logger),
+            )
 
-                if return_queue is not None:
-                    return_queue.put(ret)
+        try:
+            if bounded:
+                now = time.time()
+                gap = now - self.last_timestamp
+                self.last_timestamp = now
+                if gap >= SYNC_GAP and self.listener is not None:
+                    self.listener.collection_resumed(self, gap)
+
+                if self.wrapper.opened():
+                    ret = self.wrapper.execute(func, args, kw)
+                else:
+                    ret = self._open_and_execute(func, args, kw)
+            else:
+                # internal calls (close, stop) don't need the collection open
+                ret = func(None, *args, **kw)
         except Exception as e:
-            self.logger.error("Thread crashed! Exception: %s", e, exc_info=True)
-        finally:
-            self.wrapper.close()
-            # clean out old thread object
-            self._thread = None
-            # in case we got here via an exception
-            self._running = False
+            self.logger.error(
+                "Unable to %s(*%s, **%s): %s",
+                func_name,
+                repr(args),
+                repr(kw),
+                e,
+                exc_info=True,
+            )
+            # the Exception will be raise'd on the other end
+            future.set_exception(e)
+        else:
+            future.set_result(ret)
 
-            self.logger.info("Stopped!")
+    def _open_and_execute(self, func, args, kw):
+        metrics.COLLECTION_OPENS.inc()
+        if self._closed_by:
+            metrics.COLLECTION_REOPENS.inc(reason=self._closed_by)
+        self._closed_by = None
+        try:
+            return self.wrapper.execute(func, args, kw)
+        finally:
+            if self.listener is not None and self.wrapper.opened():
+                self.listener.collection_opened(self)
+
+    def _close_collection(self, reason=None):
+        if not self.wrapper.opened():
+            return
+        if reason is not None:
+            self.logger.info("Closing collection (%s)", reason)
+            self._closed_by = reason
+            metrics.COLLECTION_CLOSES.inc(reason=reason)
+        self.wrapper.close()
+        if self.listener is not None:
+            self.listener.collection_closed(self)
 
     def start(self):
         if not self._running:
             self._running = True
-            assert self._thread is None
-            self._thread = Thread(target=self._run)
-            self._thread.start()
+            self.logger.info("Starting...")
 
-    def stop(self):
+    def _stop(self):
         def _stop(col):
             self._running = False
+            self._close_collection()
+            self.logger.info("Stopped!")
+
+        with self._lock:
+            if not self._scheduled and not self.wrapper.opened():
+                # nothing to wait for
+                self._running = False
+                future = Future()
+                future.set_result(None)
+                return future
+            return self._put(_stop, [], {}, None, False)
 
-        self.execute(_stop, waitForReturn=False)
+    def stop(self):
+        self._stop()
+
+    def evict(self, reason):
+        """Close the collection, unless it is closed already, has calls queued
+        or running, or is applying an incoming sync. Returns whether the close
+        was queued; it is skipped if the collection is used before it runs.
+
+        'reason' labels the close, and later reopening, in the metrics."""
+
+        def _evict(col):
+            with self._lock:
+                # calls queued or run since, which would just reopen it
+                used = self._queue or self.last_timestamp != last_timestamp
+            used = used or self._applying()
+            if not used:
+                self._close_collection(reason)
+            elif self.listener is not None:
+                # still open, to be closed once idle again
+                self.listener.collection_opened(self)
+            self.closing = False
+
+        with self._lock:
+            if self._scheduled or not self._running or not self.wrapper.opened():
+                return False
+            if self._applying():
+                return False
+            self.closing = True
+            last_timestamp = self.last_timestamp
+            self._put(_evict, [], {}, None, False)
+        return True
+
+    def _applying(self):
+        """Whether an incoming sync is being applied, which closing the
+        collection would commit halfway."""
+        incoming = self.wrapper.applying
+        return incoming is not None and not incoming.abandoned()
 
     def stop_and_wait(self):
         """Tell the thread to stop and wait for it to happen."""
-        self.stop()
-        if self._thread is not None:
-            self._thread.join()
+        wait_futures([self._stop()])
 
     #
     # Mimic the CollectionWrapper interface
@@ -160,25 +472,70 @@ class ThreadingCollectionWrapper:
         """Closes the underlying collection without stopping the thread."""
 
         def _close(col):
-            self.wrapper.close()
+            self._close_collection()
 
         self.execute(_close, waitForReturn=False)
 
     def opened(self):
         return self.wrapper.opened()
 
+    def reopen(self, col):
+        """Reopens the collection closed by a call running on this thread."""
+        self.wrapper.reopen(col)
+
+    @property
+    def applying(self):
+        return self.wrapper.applying
+
+    @applying.setter
+    def applying(self, incoming):
+        self.wrapper.applying = incoming
+
 
 class ThreadingCollectionManager(CollectionManager):
-    """Manages a set of ThreadingCollectionWrapper objects."""
+    """Manages a set of ThreadingCollectionWrapper objects, which share a
+    WorkerPool of 'collection_workers' threads.
+
+    Collections are closed once idle for longer than their users usually go
+    between syncs, within 'monitor_inactivity_min' and
+    'monitor_inactivity_max' seconds ('monitor_inactivity' until a user has
+    synced twice). The monitor thread sleeps until the first collection in a
+    heap of deadlines is due, and looks at busy ones again
+    'monitor_frequency' seconds later.
 
-    collection_wrapper = ThreadingCollectionWrapper
+    When more than 'max_open_collections' are open, or the process uses more
+    than 'max_rss' MiB of memory or 'max_open_files' file descriptors (both
+    need psutil), the least recently used idle collections are closed right
+    away. Busy collections, and those applying a sync, are kept."""
 
     def __init__(self, config):
         super(ThreadingCollectionManager, self).__init__(config)
 
-        self.monitor_frequency = 15
-        self.monitor_inactivity = 90
+        self.pool = WorkerPool(int(config.get("collection_workers", 8)))
+        self.max_open_collections = int(config.get("max_open_collections", 0))
+        self.max_rss = int(config.get("max_rss", 0)) * 1024 * 1024
+        self.max_open_files = int(config.get("max_open_files", 0))
+        self._usage_checked = 0
+        self._evict_lock = Lock()
+
+        self.monitor_frequency = float(config.get("monitor_frequency", 15))
+        self.monitor_inactivity = float(config.get("monitor_inactivity", 90))
+        self.monitor_inactivity_min = float(config.get("monitor_inactivity_min", 30))
+        self.monitor_inactivity_max = float(config.get("monitor_inactivity_max", 600))
+        # open collections, and a heap of (deadline, id, thread) for closing
+        # them, guarded by _monitor_cond; ids that aren't in _deadline_ids
+        # any more belong to stale entries
+        self._open = set()
+        self._deadlines = []
+        self._deadline_ids = {}
+        self._deadline_counter = itertools.count()
+        self._monitor_cond = Condition()
         self.logger = logging.getLogger("ankisyncd.ThreadingCollectionManager")
+        if (self.max_rss or self.max_open_files) and psutil is None:
+            self.logger.warning(
+                "psutil isn't installed, ignoring max_rss and max_open_files"
+            )
+            self.max_rss = self.max_open_files = 0
 
         monitor = Thread(target=self._monitor_run)
         monitor.daemon = True
@@ -188,34 +545,180 @@ class ThreadingCollectionManager(CollectionManager):
     # TODO: we should raise some error if a collection is started on a manager that has already been shutdown!
     #       or maybe we could support being restarted?
 
-    # TODO: it would be awesome to have a safe way to stop inactive threads completely!
+    def collection_wrapper(self, config, path, setup_new_collection=None):
+        return ThreadingCollectionWrapper(
+            config, path, setup_new_collection, pool=self.pool, listener=self
+        )
+
+    def _schedule_close(self, thread, deadline):
+        # with _monitor_cond held
+        entry_id = next(self._deadline_counter)
+        self._deadline_ids[thread] = entry_id
+        heapq.heappush(self._deadlines, (deadline, entry_id, thread))
+        if self._deadlines[0][1] == entry_id:
+            # the monitor may be sleeping until a later deadline
+            self._monitor_cond.notify()
+
+    def collection_opened(self, thread):
+        with self._monitor_cond:
+            self._open.add(thread)
+            self._schedule_close(thread, thread.last_timestamp + self.keep_open(thread))
+
+    def keep_open(self, thread):
+        """Seconds to keep 'thread's collection open after its last use."""
+        if thread.keep_open is None:
+            return self.monitor_inactivity
+        return thread.keep_open
+
+    def collection_resumed(self, thread, gap):
+        """Learn from the 'gap' seconds between two of 'thread's syncs."""
+        # how that gap played out, compared with a fixed monitor_inactivity
+        for policy, keep_open in (
+            ("adaptive", self.keep_open(thread)),
+            ("fixed", self.monitor_inactivity),
+        ):
+            metrics.IDLE_OPEN_SECONDS.inc(min(gap, keep_open), policy=policy)
+            if gap > keep_open:
+                metrics.IDLE_REOPENS.inc(policy=policy)
+
+        if thread.sync_gap is None:
+            thread.sync_gap = gap
+        else:
+            thread.sync_gap += SYNC_GAP_WEIGHT * (gap - thread.sync_gap)
+        keep_open = thread.sync_gap * KEEP_OPEN_FACTOR
+        if keep_open > self.monitor_inactivity_max:
+            # won't be back soon, don't bother
+            keep_open = self.monitor_inactivity_min
+        thread.keep_open = max(keep_open, self.monitor_inactivity_min)
+
+    def collection_closed(self, thread):
+        with self._monitor_cond:
+            self._open.discard(thread)
+            self._deadline_ids.pop(thread, None)
+
+    def open_collections(self):
+        with self._monitor_cond:
+            return list(self._open)
+
+    def get_collection(self, path, setup_new_collection=None):
+        col = super().get_collection(path, setup_new_collection)
+        self.evict(keep=col)
+        return col
+
+    def _evictions_needed(self, open_count):
+        """How many collections to close to get back within the limits, and
+        which limit is exceeded the most."""
+        needed = [(0, None)]
+        if self.max_open_collections:
+            needed.append((open_count - self.max_open_collections, "max_open"))
+
+        now = time.monotonic()
+        if (
+            (self.max_rss or self.max_open_files)
+            and open_count
+            and now - self._usage_checked >= USAGE_CHECK_INTERVAL
+        ):
+            self._usage_checked = now
+            process = psutil.Process()
+            # assume everything is used by the open collections, evenly
+            for limit, usage, reason in (
+                (self.max_rss, process.memory_info().rss, "max_rss"),
+                (self.max_open_files, process.num_fds(), "max_open_files"),
+            ):
+                if limit and usage > limit:
+                    per_collection = usage / open_count
+                    needed.append((math.ceil((usage - limit) / per_collection), reason))
+        return max(needed, key=lambda item: item[0])
+
+    def evict(self, keep=None):
+        """Close least recently used idle collections, other than 'keep',
+        until the open collections are within the limits."""
+        if not (self.max_open_collections or self.max_rss or self.max_open_files):
+            return
+        # somebody else is on it
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            opened = [
+                thread for thread in self.open_collections() if not thread.closing
+            ]
+            open_count = len(opened)
+            if keep is not None and not keep.opened():
+                # make room for it before it is opened
+                open_count += 1
+            count, reason = self._evictions_needed(open_count)
+            if count <= 0:
+                return
+            opened.sort(key=lambda thread: thread.last_timestamp)
+            for thread in opened:
+                if count <= 0:
+                    break
+                if thread is not keep and thread.evict(reason):
+                    count -= 1
+        finally:
+            self._evict_lock.release()
+
+    def _due(self):
+        """Wait until collections are due to close and return them."""
+        limits = self.max_open_collections or self.max_rss or self.max_open_files
+        with self._monitor_cond:
+            while True:
+                now = time.time()
+                due = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, entry_id, thread = heapq.heappop(self._deadlines)
+                    if self._deadline_ids.get(thread) == entry_id:
+                        del self._deadline_ids[thread]
+                        due.append(thread)
+                if due:
+                    return due
+
+                timeout = self._deadlines[0][0] - now if self._deadlines else None
+                if limits:
+                    # check memory and file descriptor usage now and then
+                    timeout = min(
+                        timeout or self.monitor_frequency, self.monitor_frequency
+                    )
+                if not self._monitor_cond.wait(timeout) and limits:
+                    return due
+
     # TODO: we need a way to inform other code that the collection has been closed
     def _monitor_run(self):
-        """Monitors threads for inactivity and closes the collection on them
-        (leaves the thread itself running -- hopefully waiting peacefully with only a
-        small memory footprint!)"""
+        """Closes collections once they have been inactive for long enough.
+        Idle workers exit on their own."""
         while True:
-            cur = time.time()
-            for path, thread in self.collections.items():
-                if (
-                    thread.running
-                    and thread.wrapper.opened()
-                    and thread.qempty()
-                    and cur - thread.last_timestamp >= self.monitor_inactivity
-                ):
-                    self.logger.info(
-                        "Monitor is closing collection on inactive %s", thread
-                    )
-                    thread.close()
-            time.sleep(self.monitor_frequency)
+            for thread in self._due():
+                deadline = thread.last_timestamp + self.keep_open(thread)
+                if deadline <= time.time() and thread.evict("inactive"):
+                    continue
+                with self._monitor_cond:
+                    # still open, and either used since or busy right now
+                    if thread in self._open and thread not in self._deadline_ids:
+                        self._schedule_close(
+                            thread, max(deadline, time.time() + self.monitor_frequency)
+                        )
+            self.evict()
+
+    def collect_metrics(self):
+        """Update the gauges describing the collection threads."""
+        threads = self.open_collections()
+        depths = [thread.qsize() for thread in threads]
+        metrics.QUEUE_DEPTH.set(sum(depths))
+        metrics.MAX_QUEUE_DEPTH.set(max(depths, default=0))
+        metrics.WORKER_THREADS.set(self.pool.threads)
+        metrics.BUSY_WORKER_THREADS.set(self.pool.busy)
+        metrics.OPEN_COLLECTIONS.set(len(threads))
 
     def shutdown(self):
         # TODO: stop the monitor thread!
 
-        # stop all the threads
-        for path, col in list(self.collections.items()):
-            del self.collections[path]
+        # stop all the collections and wait for them to close
+        with self._lock:
+            collections = list(self.collections.values())
+            self.collections.clear()
+        for col in collections:
             col.stop()
+        self.pool.join()
 
         # let the parent do whatever else it might want to do...
         super(ThreadingCollectionManager, self).shutdown()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import getpass
 
 from ankisyncd import config as config_provider
+from ankisyncd.indexes import ReadOnlyDB, full_scans, query_plans
 from ankisyncd.users import get_user_manager
 
 
@@ -19,6 +21,7 @@ def usage():
     print("  deluser <username> - delete a user")
     print("  lsuser             - list users")
     print("  passwd <username>  - change password of a user")
+    print("  explain [<username>] - show query plans of the sync queries")
 
 
 def adduser(username):
@@ -63,6 +66,50 @@ def passwd(username):
         )
 
 
+def explain(username=None):
+    user_manager = get_user_manager(config)
+    usernames = user_manager.user_list() if username is None else [username]
+    # all of them, even if the first reads whole tables
+    scans = [username for username in usernames if not _explain(username)]
+    if scans:
+        print(
+            "Sync queries read whole tables for: {}; the server adds the "
+            "missing indexes when it next opens them".format(", ".join(scans)),
+            file=sys.stderr,
+        )
+        exit(1)
+
+
+def _explain(username):
+    """Print the query plans for the collection of 'username', and return
+    False if any of them reads a whole table."""
+    user_manager = get_user_manager(config)
+    path = os.path.join(
+        config["data_root"], user_manager.userdir(username), "collection.anki2"
+    )
+    if not os.path.exists(path):
+        print("User {} has no collection".format(username), file=sys.stderr)
+        return True
+
+    # read-only, as the server may have it open; the server adds any missing
+    # indexes when it next opens the collection
+    db = ReadOnlyDB(path)
+    try:
+        plans = query_plans(db)
+    finally:
+        db.close()
+
+    ok = True
+    print("{}:".format(username))
+    for description, sql, plan in plans:
+        print("  {}: {}".format(description, sql))
+        scans = full_scans(plan)
+        for step in plan:
+            print("    {}{}".format(step, "  <- full scan" if step in scans else ""))
+        ok = ok and not scans
+    return ok
+
+
 def main():
     argc = len(sys.argv)
 
@@ -71,6 +118,7 @@ def main():
         "deluser": deluser,
         "lsuser": lsuser,
         "passwd": passwd,
+        "explain": explain,
     }
 
     if argc < 2:
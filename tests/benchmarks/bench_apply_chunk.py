@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Measures Syncer.applyChunk() on cards chunks of increasing size.
+
+Half of the incoming cards exist in the collection already, half of those
+with an older mod time. 'in list' is how newerRows() used to find the rows
+to apply, with one 'id in (...)' query; 'temp table' is the join it does
+now. 'applyChunk' is the whole call, including writing the cards.
+
+    python tests/benchmarks/bench_apply_chunk.py --rows 10000 100000 1000000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import anki.storage
+from anki.utils import ids2str
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.sync import Syncer
+
+BASE_ID = 1600000000000
+
+
+def cards(rows, mod):
+    return [
+        [BASE_ID + i, BASE_ID + i, 1, 0, mod, -1, 2, 2, i % 3000]
+        + [i % 400, 2500, i % 50, 0, 0, 0, 0, 0, ""]
+        for i in range(rows)
+    ]
+
+
+def newer_rows_in_list(syncer, data, table, modIdx):
+    """The old newerRows()."""
+    ids = (r[0] for r in data)
+    lmods = {}
+    for id, mod in syncer.col.db.execute(
+        "select id, mod from %s where id in %s and %s"
+        % (table, ids2str(ids), syncer.usnLim())
+    ):
+        lmods[id] = mod
+    return [r for r in data if r[0] not in lmods or lmods[r[0]] < r[modIdx]]
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    ret = func(*args)
+    return time.perf_counter() - start, ret
+
+
+def run(path, rows):
+    """Time the three ways of applying a chunk of 'rows' cards to a new
+    collection at 'path'."""
+    col = CollectionWrapper({}, path)._get_collection()
+    try:
+        # the first half of the cards is on the server, a quarter older than
+        # the incoming ones
+        existing = cards(rows // 2, 200)
+        for row in existing[: rows // 4]:
+            row[4] = 100
+        col.db.executemany(
+            "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            existing,
+        )
+        syncer = Syncer(col)
+        syncer.maxUsn = 1
+        incoming = cards(rows, 150)
+
+        in_list, expected = measure(newer_rows_in_list, syncer, incoming, "cards", 4)
+        temp_table, newer = measure(syncer.newerRows, incoming, "cards", 4)
+        assert newer == expected
+        apply_chunk, _ = measure(syncer.applyChunk, {"cards": incoming})
+        return in_list, temp_table, apply_chunk
+    finally:
+        col.close(downgrade=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="cards per chunk (default: 10000 100000 1000000)",
+    )
+    args = parser.parse_args()
+
+    print(
+        "{:>10} {:>12} {:>12} {:>12}".format(
+            "rows", "in list", "temp table", "applyChunk"
+        )
+    )
+    for rows in args.rows:
+        dir = tempfile.mkdtemp(prefix="bench_apply_chunk")
+        try:
+            results = run(os.path.join(dir, "collection.anki2"), rows)
+        finally:
+            shutil.rmtree(dir)
+        print("{:>10} {:>11.3f}s {:>11.3f}s {:>11.3f}s".format(rows, *results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Measures gzip response compression on 'chunk'-like JSON responses.
+
+For each response size and gzip level, reports the bytes sent on the wire
+and the CPU time spent compressing a single response.
+
+    python tests/benchmarks/bench_compression.py --rows 100 1000 10000
+"""
+import argparse
+import gzip
+import json
+import random
+import string
+import time
+
+
+def words(rng, count):
+    return " ".join(
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        for _ in range(count)
+    )
+
+
+def chunk_data(rows, field_words=12, seed=0):
+    """The result of Syncer.chunk() with 'rows' revlog entries, cards and
+    notes, each note having a back field of 'field_words' words."""
+    rng = random.Random(seed)
+    base = 1600000000000
+    revlog, cards, notes = [], [], []
+    for i in range(rows):
+        nid, cid = base + i * 1000, base + i * 1000 + 1
+        revlog.append(
+            [cid + 7, cid, 0, rng.randint(1, 4), rng.randint(-600, 400)]
+            + [rng.randint(-600, 400), 2500, rng.randint(1000, 60000), 1]
+        )
+        cards.append(
+            [cid, nid, 1, 0, base // 1000, 0, 2, 2, rng.randint(0, 3000)]
+            + [rng.randint(1, 400), 2500, rng.randint(0, 50), 0, 0, 0, 0, 0, ""]
+        )
+        front, back = words(rng, 3), words(rng, field_words)
+        notes.append(
+            [nid, "".join(rng.choices(string.ascii_letters, k=10)), 1, base // 1000]
+            + [0, " vocab ", front + "\x1f" + back, front, rng.getrandbits(32), 0, ""]
+        )
+    return {"done": False, "revlog": revlog, "cards": cards, "notes": notes}
+
+
+def chunk_response(rows):
+    return json.dumps(chunk_data(rows)).encode()
+
+
+def measure(body, level, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        compressed = gzip.compress(body, level)
+    return len(compressed), (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="rows per table in the response (default: 10 100 1000 10000)",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=[1, 6, 9],
+        help="gzip levels to compare (default: 1 6 9)",
+    )
+    args = parser.parse_args()
+
+    print(
+        "{:>7} {:>11} {:>6} {:>11} {:>7} {:>10}".format(
+            "rows", "json", "level", "on wire", "ratio", "cpu"
+        )
+    )
+    for rows in args.rows:
+        body = chunk_response(rows)
+        repeat = max(1, 1000 // rows)
+        for level in args.levels:
+            size, cpu = measure(body, level, repeat)
+            print(
+                "{:>7} {:>10}B {:>6} {:>10}B {:>6.1f}x {:>8.2f}ms".format(
+                    rows, len(body), level, size, len(body) / size, cpu * 1000
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Compares JSON encoding and decoding of 'chunk' payloads.
+
+'stdlib' is what SyncApp did before json_codec: json.dumps() to str, encoded
+by webob, and json.loads() of the decoded body. 'json_codec' is whichever
+backend ankisyncd.json_codec picked (orjson when installed), and
+'json_codec (stdlib)' is its fallback.
+
+    python tests/benchmarks/bench_json.py --rows 100 1000 --field-words 12 400
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from ankisyncd import json_codec
+from bench_compression import chunk_data
+
+CODECS = {
+    "stdlib": (
+        lambda obj: json.dumps(obj).encode("utf-8"),
+        lambda data: json.loads(data.decode("utf-8")),
+    ),
+    "json_codec (stdlib)": (json_codec._json_dumps, json.loads),
+    "json_codec": (json_codec.dumps, json_codec.loads),
+}
+
+
+def best_time(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="rows per table in the payload (default: 100 1000 10000)",
+    )
+    parser.add_argument(
+        "--field-words",
+        type=int,
+        nargs="+",
+        default=[12, 400],
+        help="words in each note's back field (default: 12 400)",
+    )
+    args = parser.parse_args()
+
+    print("json_codec backend: {}".format("orjson" if json_codec.orjson else "json"))
+    print(
+        "{:>6} {:>6} {:>11} {:>20} {:>10} {:>10}".format(
+            "rows", "words", "size", "codec", "encode", "decode"
+        )
+    )
+    for rows in args.rows:
+        for field_words in args.field_words:
+            obj = chunk_data(rows, field_words)
+            number = max(1, 2000 // rows)
+            for name, (dumps, loads) in CODECS.items():
+                data = dumps(obj)
+                encode = best_time(dumps, obj, number)
+                decode = best_time(loads, data, number)
+                print(
+                    "{:>6} {:>6} {:>10}B {:>20} {:>8.2f}ms {:>8.2f}ms".format(
+                        rows, field_words, len(data), name, encode * 1000, decode * 1000
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Compares the old regex based multipart parsing of Requests.parse with the
+streaming MultipartParser, on uploads of increasing size.
+
+Reports the time taken and the peak memory allocated (as seen by tracemalloc)
+while parsing a single request.
+
+    python tests/benchmarks/bench_multipart.py --sizes 1 10 100
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from ankisyncd.multipart import LimitedReader, MultipartParser
+from test_multipart import build_body
+
+
+def regex_parse(input, length):
+    """Requests.parse before the streaming parser, for comparison."""
+    body = input.read(length)
+    request_items_dict = {}
+    repeat = body.splitlines()[0]
+    items = re.split(repeat, body)
+    items.pop()
+    items.pop(0)
+    for item in items:
+        if b'name="data"' in item:
+            item = re.sub(
+                b'Content-Disposition: form-data; name="data"; filename="data"',
+                b"",
+                item,
+            )
+            item = re.sub(b"Content-Type: application/octet-stream", b"", item)
+            request_items_dict["data"] = item.strip()
+            continue
+        item = re.sub(b"\r\n", b"", item, flags=re.MULTILINE)
+        key = re.findall(b'name="(.*?)"', item)[0].decode("utf-8")
+        v = item[item.rfind(b'"') + 1 :].decode("utf-8")
+        request_items_dict[key] = v
+    return request_items_dict
+
+
+def streaming_parse(input, length):
+    return dict(MultipartParser(LimitedReader(input, length)))
+
+
+def measure(parse, body):
+    """Return the time taken and the peak memory allocated by 'parse'.
+
+    The request body itself stands in for the socket and isn't counted."""
+    start = time.perf_counter()
+    parse(io.BytesIO(body), len(body))
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    input = io.BytesIO(body)
+    tracemalloc.reset_peak()
+    result = parse(input, len(body))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1, 10, 50],
+        help="upload sizes in MiB (default: 1 10 50)",
+    )
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>12}".format("size", "parser", "time", "peak"))
+    for size in args.sizes:
+        body = build_body(os.urandom(size * 1024 * 1024), k="0123456789abcdef")
+        for name, parse in (("regex", regex_parse), ("streaming", streaming_parse)):
+            elapsed, peak = measure(parse, body)
+            print(
+                "{:>6}MB {:>10} {:>9.3f}s {:>10.1f}MB".format(
+                    size, name, elapsed, peak / 1024 / 1024
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
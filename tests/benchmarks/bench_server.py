@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Load test comparing the 'simple', 'threaded' and 'asyncio' server modes.
+
+Many simulated clients log in and call 'meta' in a loop while a few others
+keep uploading large (invalid) collections over a throttled, mobile-like link,
+which is what used to stall everybody else on the single-threaded server.
+
+    python tests/benchmarks/bench_server.py --clients 32 --uploaders 2
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from wsgiref.simple_server import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from ankisyncd.async_server import AsyncWSGIServer
+from ankisyncd.server import RequestHandler, make_threaded_server
+from ankisyncd.sync import AnkiRequestsClient, HttpSyncer, SYNC_VER
+from ankisyncd.thread import shutdown
+from ankisyncd.users import SqliteUserManager
+import helpers.server_utils
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "assets",
+    "test.conf",
+)
+
+
+class RequestsClient(AnkiRequestsClient):
+    def _agentName(self):
+        return "ankisyncd-bench"
+
+
+class BenchClient(HttpSyncer):
+    def __init__(self, base_url):
+        super().__init__(client=RequestsClient())
+        self.base_url = base_url
+
+    def syncURL(self):
+        return self.base_url + self.prefix
+
+    def login(self, user):
+        self.postVars = {}
+        ret = self.req(
+            "hostKey",
+            io.BytesIO(json.dumps(dict(u=user, p="password")).encode()),
+        )
+        self.hkey = json.loads(ret.decode())["key"]
+
+    def meta(self):
+        self.postVars = dict(k=self.hkey, s=self.skey)
+        self.req(
+            "meta",
+            io.BytesIO(
+                json.dumps(dict(v=SYNC_VER, cv="ankidesktop,2.1.49,lin::")).encode()
+            ),
+        )
+
+    def upload(self, data, rate):
+        """Upload 'data' at roughly 'rate' bytes per second. The server rejects
+        it as corrupt, we only care about the load it creates."""
+        self.postVars = dict(k=self.hkey)
+        headers, body = self._buildPostData(io.BytesIO(data), 0)
+        host, port = self.base_url[len("http://") :].rstrip("/").split(":")
+        conn = http.client.HTTPConnection(host, int(port))
+        conn.putrequest("POST", "/" + self.prefix + "upload")
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders()
+        block = body.read(64 * 1024)
+        while block:
+            conn.send(block)
+            time.sleep(len(block) / rate)
+            block = body.read(64 * 1024)
+        conn.getresponse().read()
+        conn.close()
+
+
+def start_server(mode, threads, users):
+    server_paths = helpers.server_utils.create_server_paths()
+    user_manager = SqliteUserManager(
+        server_paths["auth_db_path"], server_paths["data_root"]
+    )
+    for user in users:
+        user_manager.add_user(user, "password")
+    app = helpers.server_utils.create_sync_app(server_paths, CONFIG_PATH)
+
+    if mode == "threaded":
+        httpd = make_threaded_server("127.0.0.1", 0, app, pool_size=threads)
+    elif mode == "asyncio":
+        httpd = AsyncWSGIServer("127.0.0.1", 0, app, pool_size=threads)
+    else:
+        httpd = make_server("127.0.0.1", 0, app, handler_class=RequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+def run(mode, args):
+    users = ["user%d" % i for i in range(args.clients + args.uploaders)]
+    httpd = start_server(mode, args.threads, users)
+    base_url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+    payload = os.urandom(args.upload_size * 1024 * 1024)
+    latencies = []
+    uploads = []
+    deadline = time.monotonic() + args.duration
+    lock = threading.Lock()
+
+    def meta_client(user):
+        client = BenchClient(base_url)
+        client.login(user)
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            client.meta()
+            with lock:
+                latencies.append(time.monotonic() - start)
+
+    def upload_client(user):
+        client = BenchClient(base_url)
+        client.login(user)
+        while time.monotonic() < deadline:
+            client.upload(payload, args.upload_rate * 1024 * 1024)
+            uploads.append(1)
+
+    workers = [
+        threading.Thread(target=meta_client, args=(u,)) for u in users[: args.clients]
+    ] + [
+        threading.Thread(target=upload_client, args=(u,)) for u in users[args.clients :]
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    httpd.shutdown()
+    httpd.server_close()
+    shutdown()
+
+    latencies.sort()
+    print(
+        "{:>8}: {:7.1f} meta/s  p50 {:7.1f} ms  p95 {:7.1f} ms  max {:7.1f} ms"
+        "  {} uploads".format(
+            mode,
+            len(latencies) / args.duration,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000,
+            len(uploads),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--uploaders", type=int, default=2)
+    parser.add_argument("--upload-size", type=int, default=10, help="in MiB")
+    parser.add_argument("--upload-rate", type=float, default=4, help="in MiB/s")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    for mode in ("simple", "threaded", "asyncio"):
+        run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
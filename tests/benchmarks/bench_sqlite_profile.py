@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Measures sync operations on a large collection under each sqlite profile.
+
+Builds a collection of '--notes' notes, each with a card and a few revlog
+entries, and for every profile in ankisyncd.sqlite_profile.PROFILES times:
+opening the collection, sending all of it with 'chunk' as a first sync
+would, 'sanityCheck2', and applying a chunk of changed cards. Each is the
+best of '--repeat' runs, with the collection file in the OS page cache.
+
+    python tests/benchmarks/bench_sqlite_profile.py --notes 200000
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import anki.storage
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.sqlite_profile import PROFILES
+from ankisyncd.sync_app import SyncCollectionHandler
+
+BASE_ID = 1600000000000
+
+
+def build(path, notes, seed=0):
+    rng = random.Random(seed)
+    col = CollectionWrapper({"sqlite_profile": "anki"}, path)._get_collection()
+    mid = col.models.all()[0]["id"]
+    col.db.executemany(
+        "insert into notes values (?,?,?,?,0,'',?,?,0,0,'')",
+        (
+            (BASE_ID + i, "g%d" % i, mid, i, "front %d\x1fback %d" % (i, i), i)
+            for i in range(notes)
+        ),
+    )
+    col.db.executemany(
+        "insert into cards values (?,?,1,0,?,0,2,2,?,?,2500,?,0,0,0,0,0,'')",
+        (
+            (BASE_ID + i, BASE_ID + i, i, rng.randint(0, 3000), 10, rng.randint(1, 50))
+            for i in range(notes)
+        ),
+    )
+    col.db.executemany(
+        "insert into revlog values (?,?,0,3,10,5,2500,5000,1)",
+        ((BASE_ID + i * 4 + j, BASE_ID + i) for i in range(notes) for j in range(4)),
+    )
+    col.close()
+
+
+def open_handler(path, profile):
+    wrapper = CollectionWrapper({"sqlite_profile": profile}, path)
+    col = wrapper._get_collection()
+    session = MagicMock()
+    session.get_thread.return_value = wrapper
+    handler = SyncCollectionHandler(col, session)
+    handler.maxUsn = col.usn()
+    handler.minUsn = 0
+    return handler
+
+
+def chunk_all(handler):
+    handler.prepareToChunk()
+    while not handler.chunk()["done"]:
+        pass
+
+
+def sanity_check(handler):
+    handler.sanityCheck2([[0, 0, 0]])
+
+
+def apply_chunk(handler, rows=10000):
+    cards = handler.col.db.all("select * from cards order by random() limit ?", rows)
+    for card in cards:
+        card[4] += 1
+    with handler.step("applyChunk"):
+        handler.applyChunk({"cards": cards})
+
+
+def best(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--notes",
+        type=int,
+        default=200000,
+        help="notes in the collection (default: 200000)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs of each operation (default: 3)",
+    )
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp(prefix="bench_sqlite_profile")
+    try:
+        path = os.path.join(dir, "collection.anki2")
+        build(path, args.notes)
+
+        ops = ("open", "chunk", "sanityCheck2", "applyChunk")
+        print(("{:>8}" + " {:>12}" * len(ops)).format("profile", *ops))
+        for profile in PROFILES:
+            opened = best(args.repeat, lambda: open_handler(path, profile).col.close())
+            handler = open_handler(path, profile)
+            try:
+                results = [
+                    best(args.repeat, chunk_all, handler),
+                    best(args.repeat, sanity_check, handler),
+                    best(args.repeat, apply_chunk, handler),
+                ]
+            finally:
+                handler.col.close()
+            print(
+                ("{:>8}" + " {:>11.3f}s" * len(ops)).format(profile, opened, *results)
+            )
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    main()
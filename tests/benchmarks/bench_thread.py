@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Measures the per-call overhead of running functions on a collection thread.
+
+'queue per call' and 'future per call' run calls on the same bare thread,
+returning results through a new Queue per call, as
+ThreadingCollectionWrapper.execute() used to, or through a Future, as it
+does now. 'execute' and 'submit' are ThreadingCollectionWrapper itself, with
+its priorities, queue bound and worker pool; 'submit' queues every call
+before waiting for the first result, as a batching or async front end
+could. The functions do nothing, so the numbers are pure dispatch overhead.
+Each is measured 'repeat' times, interleaved, and the best time is kept.
+
+A Future is cheaper than a Queue per call, but execute() spends that on
+what ThreadingCollectionWrapper does around each call, and costs about as
+much as the old thread did. Only submitting calls in batches is faster.
+
+    python tests/benchmarks/bench_thread.py --calls 20000
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.thread import ThreadingCollectionWrapper
+
+
+class NoopCollectionWrapper(CollectionWrapper):
+    def __init__(self, config, path, setup_new_collection=None):
+        self._CollectionWrapper__col = None
+        self.username = "bench"
+
+    def execute(self, func, args=[], kw={}, waitForReturn=True):
+        return func(None, *args, **kw)
+
+
+class QueuePerCallThread:
+    """The old execute(): a Queue per call for the return value."""
+
+    def __init__(self):
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, kw, return_queue = self._queue.get(True)
+            try:
+                ret = func(None, *args, **kw)
+            except Exception as e:
+                ret = e
+            return_queue.put(ret)
+
+    def execute(self, func, args=[], kw={}):
+        return_queue = Queue()
+        self._queue.put((func, args, kw, return_queue))
+        ret = return_queue.get(True)
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+
+class FuturePerCallThread(QueuePerCallThread):
+    """QueuePerCallThread, with a Future per call for the return value."""
+
+    def _run(self):
+        while True:
+            func, args, kw, future = self._queue.get(True)
+            try:
+                future.set_result(func(None, *args, **kw))
+            except Exception as e:
+                future.set_exception(e)
+
+    def execute(self, func, args=[], kw={}):
+        future = Future()
+        self._queue.put((func, args, kw, future))
+        return future.result()
+
+
+def noop(col):
+    return col
+
+
+def run_execute(thread, calls):
+    for _ in range(calls):
+        thread.execute(noop)
+
+
+def run_submit(thread, calls, batch):
+    for _ in range(calls // batch):
+        futures = [thread.submit(noop) for _ in range(batch)]
+        for future in futures:
+            future.result()
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=20000,
+        help="calls per measurement (default: 20000)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=16,
+        help="calls submitted before waiting for results (default: 16)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="measurements of each, the best is shown (default: 5)",
+    )
+    args = parser.parse_args()
+    # the thread logs every call
+    logging.disable(logging.INFO)
+
+    config = {
+        "collection_wrapper": "bench_thread.NoopCollectionWrapper",
+        "collection_queue_size": args.batch,
+    }
+    thread = ThreadingCollectionWrapper(config, "/bench/collection.anki2")
+    runs = [
+        ("queue per call", run_execute, QueuePerCallThread()),
+        ("future per call", run_execute, FuturePerCallThread()),
+        ("execute", run_execute, thread),
+        ("submit x{}".format(args.batch), run_submit, thread, args.batch),
+    ]
+    best = {}
+    for _ in range(args.repeat):
+        for name, func, *func_args in runs:
+            elapsed = measure(func, func_args[0], args.calls, *func_args[1:])
+            best[name] = min(best.get(name, elapsed), elapsed)
+    results = [(name, best[name]) for name, *_ in runs]
+    thread.stop_and_wait()
+
+    print("{:>16} {:>12} {:>12}".format("api", "per call", "calls/s"))
+    for name, elapsed in results:
+        print(
+            "{:>16} {:>10.1f}us {:>12.0f}".format(
+                name, elapsed / args.calls * 1e6, args.calls / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
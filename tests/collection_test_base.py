@@ -14,12 +14,15 @@ from ankisyncd.collection import CollectionManager
 class CollectionTestBase(unittest.TestCase):
     """Parent class for tests that need a collection set up and torn down."""
 
+    # the config of the collection's CollectionManager
+    config = {}
+
     def setUp(self):
         self.temp_dir = tempfile.mkdtemp()
         self.collection_path = os.path.join(self.temp_dir, "collection.anki2")
-        cm = CollectionManager({})
-        collectionWrapper = cm.get_collection(self.collection_path)
-        self.collection = collectionWrapper._get_collection()
+        cm = CollectionManager(self.config)
+        self.collection_wrapper = cm.get_collection(self.collection_path)
+        self.collection = self.collection_wrapper._get_collection()
         self.mock_app = MagicMock()
 
     def tearDown(self):
@@ -51,9 +51,9 @@ def get_col_wrapper_for_hkey(server, hkey):
 
 
 def get_col_for_hkey(server, hkey):
-    col_wrapper = get_col_wrapper_for_hkey(server, hkey)
-    col_wrapper.open()  # Make sure the col is opened.
-    return col_wrapper._CollectionWrapper__col
+    thread = get_thread_for_hkey(server, hkey)
+    # Open the col on its thread, which may be opening it already.
+    return thread.execute(lambda col: col)
 
 
 def get_col_db_path_for_hkey(server, hkey):
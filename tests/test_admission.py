@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from ankisyncd.admission import WeightedSemaphore
+
+
+class WeightedSemaphoreTest(unittest.TestCase):
+    def acquire_later(self, sem, weight, acquired):
+        """Acquire 'weight' on another thread, appending it to 'acquired'
+        once done. Returns after the thread started waiting."""
+        waiting = sem.waiting
+        thread = threading.Thread(
+            target=lambda: sem.acquire(weight, 5) and acquired.append(weight)
+        )
+        thread.start()
+        while sem.waiting == waiting:
+            thread.join(0.001)
+        self.addCleanup(thread.join, 5)
+        return thread
+
+    def test_acquire_release(self):
+        sem = WeightedSemaphore(10)
+        self.assertTrue(sem.acquire(4))
+        self.assertTrue(sem.acquire(6))
+        self.assertEqual(sem.in_use, 10)
+        self.assertFalse(sem.acquire(1, timeout=0.01))
+        self.assertEqual(sem.waiting, 0)
+        sem.release(4)
+        self.assertTrue(sem.acquire(3))
+        self.assertEqual(sem.available, 1)
+
+    def test_oversized_weight_runs_alone(self):
+        sem = WeightedSemaphore(10)
+        self.assertTrue(sem.acquire(100))
+        self.assertEqual(sem.available, 0)
+        sem.release(100)
+        self.assertEqual(sem.available, 10)
+
+    def test_fifo(self):
+        sem = WeightedSemaphore(10)
+        sem.acquire(8)
+        acquired = []
+        big = self.acquire_later(sem, 5, acquired)
+        # fits, but has to wait behind the bigger waiter
+        small = self.acquire_later(sem, 1, acquired)
+        self.assertEqual(acquired, [])
+
+        sem.release(8)
+        big.join(5)
+        small.join(5)
+        self.assertEqual(sorted(acquired), [1, 5])
+        self.assertEqual(sem.available, 4)
+
+    def test_timeout_wakes_waiters_behind(self):
+        sem = WeightedSemaphore(10)
+        sem.acquire(8)
+        acquired = []
+        self.assertFalse(sem.acquire(5, timeout=0.01))
+        self.assertEqual(sem.waiting, 0)
+
+        # a waiter behind a waiter that gives up gets in
+        head = threading.Thread(target=lambda: sem.acquire(5, 0.05))
+        head.start()
+        while not sem.waiting:
+            head.join(0.001)
+        small = self.acquire_later(sem, 2, acquired)
+        head.join(5)
+        small.join(5)
+        self.assertEqual(acquired, [2])
+        self.assertEqual(sem.waiting, 0)
+
+    def test_max_waiting(self):
+        sem = WeightedSemaphore(10)
+        sem.acquire(10)
+        acquired = []
+        self.acquire_later(sem, 1, acquired)
+        # turned away at once
+        self.assertFalse(sem.acquire(1, timeout=5, max_waiting=1))
+        self.assertEqual(sem.waiting, 1)
+        sem.release(10)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import http.client
+import socket
+import threading
+import time
+import unittest
+
+from ankisyncd.async_server import AsyncWSGIServer
+
+
+def echo_app(environ, start_response):
+    body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+    start_response("200 OK", [("Content-Type", "application/octet-stream")])
+    return [body]
+
+
+class AsyncWSGIServerTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = AsyncWSGIServer("127.0.0.1", 0, echo_app, pool_size=2)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def _post(self, body, headers={}, encode_chunked=False):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.request(
+            "POST",
+            "/sync/meta",
+            body=body,
+            headers=headers,
+            encode_chunked=encode_chunked,
+        )
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp.status, data
+
+    def test_content_length_body(self):
+        self.assertEqual(self._post(b"x" * 100000), (200, b"x" * 100000))
+
+    def test_chunked_body_is_decoded(self):
+        status, data = self._post(
+            iter([b"first ", b"second"]),
+            headers={"Transfer-Encoding": "chunked"},
+            encode_chunked=True,
+        )
+        self.assertEqual((status, data), (200, b"first second"))
+
+    def test_body_too_large(self):
+        self.httpd.max_body_size = 1000
+        self.assertEqual(self._post(b"x" * 1000), (200, b"x" * 1000))
+        self.assertEqual(self._post(b"x" * 1001)[0], 413)
+
+        status, _ = self._post(
+            iter([b"x" * 600, b"x" * 401]),
+            headers={"Transfer-Encoding": "chunked"},
+            encode_chunked=True,
+        )
+        self.assertEqual(status, 413)
+
+    def test_malformed_chunked_body(self):
+        sock = socket.create_connection(self.httpd.server_address)
+        self.addCleanup(sock.close)
+        sock.sendall(
+            b"POST /sync/meta HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"zz\r\nhello\r\n0\r\n\r\n"
+        )
+        sock.settimeout(10)
+        self.assertTrue(sock.recv(1024).startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+
+    def test_slow_clients_do_not_block(self):
+        # many more stalled connections than there are threads in the pool
+        stalled = []
+        for _ in range(20):
+            sock = socket.create_connection(self.httpd.server_address)
+            sock.sendall(b"POST /sync/upload HTTP/1.1\r\nContent-Length: 100\r\n\r\n")
+            stalled.append(sock)
+
+        start = time.monotonic()
+        self.assertEqual(self._post(b"hello"), (200, b"hello"))
+        self.assertLess(time.monotonic() - start, 1)
+
+        for sock in stalled:
+            sock.close()
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sqlite3
+import tempfile
 import unittest
 import configparser
+from unittest.mock import MagicMock, patch
 
 from ankisyncd.full_sync import FullSyncManager, get_full_sync_manager
 
 import helpers.server_utils
+from collection_test_base import CollectionTestBase
 
 
 class FakeFullSyncManager(FullSyncManager):
@@ -48,3 +52,67 @@ class FullSyncManagerFactoryTest(unittest.TestCase):
         config.set("sync_app", "full_sync_manager", "test_full_sync.BadFullSyncManager")
         with self.assertRaises(TypeError):
             pm = get_full_sync_manager(config["sync_app"])
+
+
+class FullSyncManagerTest(CollectionTestBase):
+    config = {"sqlite_profile": "fast"}
+
+    def make_session(self):
+        session = MagicMock()
+        session.get_collection_path.return_value = self.collection_path
+        session.get_thread.return_value = self.collection_wrapper
+        return session
+
+    def test_reopened_with_sqlite_profile(self):
+        db = self.collection.db
+        db.execute("pragma cache_size = -1234")
+        FullSyncManager().download(self.collection, self.make_session()).fileobj.close()
+
+        db = self.collection.db
+        self.assertEqual(db.scalar("pragma cache_size"), -64 * 1024)
+        self.assertEqual(db.scalar("pragma temp_store"), 2)
+        # back in a transaction
+        db.execute("update col set crt=1")
+        self.collection.save()
+
+    def test_uploaded_collection_gets_indexes(self):
+        session = self.make_session()
+        resp = FullSyncManager().download(self.collection, session)
+        with tempfile.NamedTemporaryFile(suffix=".anki2") as f:
+            for block in resp.app_iter:
+                f.write(block)
+            f.flush()
+            db = sqlite3.connect(f.name)
+            db.execute("drop index ix_cards_usn")
+            db.commit()
+            db.close()
+
+            f.seek(0)
+            manager = FullSyncManager()
+            # it can't use the "unicase" collation anki's collections use
+            with patch.object(manager, "test_db"):
+                self.assertEqual(manager.upload(self.collection, f, session), "OK")
+
+        self.assertIn(
+            "ix_cards_usn",
+            self.collection.db.list(
+                "select name from sqlite_master where type='index'"
+            ),
+        )
+
+    def test_download_sends_a_snapshot(self):
+        self.add_default_note()
+        resp = FullSyncManager().download(self.collection, self.make_session())
+
+        # the collection is usable again before the response is sent
+        self.add_default_note()
+        self.assertEqual(self.collection.noteCount(), 2)
+
+        with tempfile.NamedTemporaryFile(suffix=".anki2") as f:
+            for block in resp.app_iter:
+                f.write(block)
+            f.flush()
+            self.assertEqual(os.path.getsize(f.name), resp.content_length)
+            db = sqlite3.connect(f.name)
+            self.assertEqual(db.execute("select count() from notes").fetchone(), (1,))
+            db.close()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.indexes import ReadOnlyDB, ensure_indexes, full_scans, query_plans
+
+
+class IndexesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = os.path.join(self.temp_dir, "collection.anki2")
+
+    def open(self):
+        col = CollectionWrapper({}, self.path)._get_collection()
+        self.addCleanup(col.close)
+        return col
+
+    def test_ensure_indexes(self):
+        col = self.open()
+        col.save(trx=False)
+        self.assertEqual(ensure_indexes(col.db), [])
+        # anki adds it back itself when opening the collection
+        col.db.execute("drop index idx_graves_pending")
+        self.assertEqual(ensure_indexes(col.db), ["ix_graves_usn"])
+        self.assertEqual(ensure_indexes(col.db), [])
+        col.db.begin()
+
+    def test_no_full_scans(self):
+        col = self.open()
+        plans = query_plans(col.db)
+        self.assertTrue(plans)
+        for description, sql, plan in plans:
+            self.assertEqual(full_scans(plan), [], sql)
+
+    def test_read_only(self):
+        self.open().close(downgrade=False)
+        db = ReadOnlyDB(self.path)
+        self.addCleanup(db.close)
+        for description, sql, plan in query_plans(db):
+            self.assertEqual(full_scans(plan), [], sql)
+        with self.assertRaises(sqlite3.OperationalError):
+            db.execute("drop index ix_cards_usn")
+
+    def test_full_scans(self):
+        self.assertEqual(
+            full_scans(["SCAN TABLE sync_rows", "SCAN cards USING INDEX ix_cards_nid"]),
+            ["SCAN cards USING INDEX ix_cards_nid"],
+        )
+        self.assertEqual(
+            full_scans(["SEARCH TABLE cards USING INDEX ix_cards_usn (usn>?)"]), []
+        )
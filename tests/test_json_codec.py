@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from ankisyncd import json_codec
+
+PAYLOAD = {
+    "done": False,
+    "notes": [
+        [1600000000000, "f]K9<tn#h?", 1, 1600000000, -1, " tag ", "前\x1fback"],
+        [1600000001000, 'q"\\/', 1, 1600000001, 5, "", "<b>émoji 🙂</b>\n\t"],
+    ],
+    "revlog": [[1600000000001, 1600000000000, 5, 3, -600, 0, 2500, 6000, 1]],
+    "float": 1.5,
+    "null": None,
+    1: "integer key",
+}
+
+
+class JsonCodecTest(unittest.TestCase):
+    def test_compact_utf8(self):
+        self.assertEqual(
+            json_codec.dumps({"a": [1, "é"]}), '{"a":[1,"é"]}'.encode("utf-8")
+        )
+
+    def test_round_trip(self):
+        data = json_codec.dumps(PAYLOAD)
+        expected = json.loads(json.dumps(PAYLOAD))
+        for value in (data, bytearray(data), data.decode("utf-8")):
+            self.assertEqual(json_codec.loads(value), expected)
+
+    @unittest.skipIf(json_codec.orjson is None, "orjson is not installed")
+    def test_same_output_as_stdlib(self):
+        self.assertEqual(json_codec.dumps(PAYLOAD), json_codec._json_dumps(PAYLOAD))
+
+    def test_floats(self):
+        values = [1e16, 1.5e-7, -2.5e-300, 0.1]
+        self.assertEqual(json_codec.loads(json_codec.dumps(values)), values)
+
+    @unittest.skipIf(json_codec.orjson is None, "orjson is not installed")
+    def test_non_finite_floats(self):
+        values = [float("nan"), float("inf"), -float("inf")]
+        self.assertEqual(json_codec.dumps(values), b"[null,null,null]")
+
+    def test_big_integers(self):
+        self.assertEqual(json_codec.dumps([2**70]), b"[1180591620717411303424]")
+
+    def test_invalid(self):
+        for data in (b"{", b"\xff", b""):
+            with self.assertRaises(ValueError):
+                json_codec.loads(data)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from ankisyncd.metrics import Counter, Gauge, Histogram, Registry, merge
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter(
+            "requests_total", "Requests.", ["operation"], registry=self.registry
+        )
+        counter.inc(operation="meta")
+        counter.inc(2, operation="meta")
+        counter.inc(operation='a"b')
+        self.assertEqual(counter.value(operation="meta"), 3)
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{operation="a\\"b"} 1\n'
+            'requests_total{operation="meta"} 3\n',
+        )
+
+    def test_labels_are_checked(self):
+        counter = Counter("c", "C.", ["operation"], registry=self.registry)
+        with self.assertRaises(ValueError):
+            counter.inc()
+        with self.assertRaises(ValueError):
+            counter.inc(operation="meta", status=200)
+
+    def test_gauge(self):
+        gauge = Gauge("open", "Open.", registry=self.registry)
+        gauge.set(3)
+        gauge.set(2)
+        self.assertIn("\nopen 2\n", self.registry.render())
+        gauge.clear()
+        self.assertNotIn("\nopen ", self.registry.render())
+
+    def test_histogram(self):
+        histogram = Histogram(
+            "duration_seconds",
+            "Duration.",
+            ["operation"],
+            buckets=(0.1, 1),
+            registry=self.registry,
+        )
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value, operation="chunk")
+        self.assertEqual(histogram.value(operation="chunk"), (4, 5.65))
+        self.assertEqual(
+            self.registry.render().splitlines()[2:],
+            [
+                'duration_seconds_bucket{operation="chunk",le="0.1"} 2',
+                'duration_seconds_bucket{operation="chunk",le="1"} 3',
+                'duration_seconds_bucket{operation="chunk",le="+Inf"} 4',
+                'duration_seconds_sum{operation="chunk"} 5.65',
+                'duration_seconds_count{operation="chunk"} 4',
+            ],
+        )
+
+    def test_merge(self):
+        counter = Counter("requests", "Requests.", ["op"], registry=self.registry)
+        gauge = Gauge("open", "Open.", registry=self.registry)
+        counter.inc(op="meta")
+        gauge.set(1)
+        first = self.registry.render()
+        counter.inc(op="chunk")
+        gauge.set(2)
+        self.assertEqual(
+            merge([first, self.registry.render()], "worker").splitlines(),
+            [
+                "# HELP requests Requests.",
+                "# TYPE requests counter",
+                'requests{worker="0",op="meta"} 1',
+                'requests{worker="1",op="chunk"} 1',
+                'requests{worker="1",op="meta"} 1',
+                "# HELP open Open.",
+                "# TYPE open gauge",
+                'open{worker="0"} 1',
+                'open{worker="1"} 2',
+            ],
+        )
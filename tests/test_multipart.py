@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import os
+import unittest
+
+from ankisyncd.exceptions import BadRequestException, PayloadTooLargeException
+from ankisyncd.multipart import ChunkedReader, LimitedReader, MultipartParser
+
+
+def build_body(data, comp=0, **fields):
+    """Build a request body the way the Anki client does."""
+    bdry = b"--Anki-sync-boundary"
+    fields["c"] = 1 if comp else 0
+    body = b""
+    for key, value in fields.items():
+        body += bdry + b"\r\n"
+        body += 'Content-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            key, value
+        ).encode()
+    body += bdry + b"\r\n"
+    body += b'Content-Disposition: form-data; name="data"; filename="data"\r\n'
+    body += b"Content-Type: application/octet-stream\r\n\r\n"
+    body += gzip.compress(data, comp) if comp else data
+    return body + b"\r\n" + bdry + b"--\r\n"
+
+
+def encode_chunked(body, chunk_size):
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+    encoded = b"".join(b"%x\r\n%s\r\n" % (len(c), c) for c in chunks)
+    return encoded + b"0\r\n\r\n"
+
+
+class MultipartParserTest(unittest.TestCase):
+    def parse(self, body, **kw):
+        params = dict(MultipartParser(io.BytesIO(body), **kw))
+        if "data" in params:
+            self.addCleanup(params["data"].close)
+        return params
+
+    def test_fields_and_data(self):
+        data = os.urandom(100000)
+        params = self.parse(build_body(data, comp=6, k="hkey", s="skey"))
+        self.assertEqual(params["k"], "hkey")
+        self.assertEqual(params["s"], "skey")
+        self.assertEqual(params["c"], "1")
+        self.assertEqual(gzip.decompress(params["data"].read()), data)
+
+    def test_delimiter_split_across_blocks(self):
+        # data containing most of the delimiter, read a few bytes at a time
+        data = b" \r\n--Anki-sync-boundar\r\n"
+        for block_size in (1, 3, 7, 64):
+            params = self.parse(build_body(data, k="hkey"), block_size=block_size)
+            self.assertEqual(params["data"].read(), data)
+            self.assertEqual(params["k"], "hkey")
+
+    def test_large_data_is_spooled_to_disk(self):
+        data = os.urandom(200000)
+        params = self.parse(build_body(data), spool_max_size=1024)
+        self.assertTrue(params["data"]._rolled)
+        self.assertEqual(params["data"].read(), data)
+
+    def test_data_too_large(self):
+        data = os.urandom(10000)
+        for block_size in (1, 7, 64 * 1024):
+            params = self.parse(
+                build_body(data), block_size=block_size, max_file_size=10000
+            )
+            self.assertEqual(params["data"].read(), data)
+            with self.assertRaises(PayloadTooLargeException):
+                self.parse(build_body(data), block_size=block_size, max_file_size=9999)
+
+    def test_reads_no_further_than_content_length(self):
+        body = build_body(b"data")
+        stream = io.BytesIO(body + b"next request")
+        dict(MultipartParser(LimitedReader(stream, len(body))))["data"].close()
+        self.assertEqual(stream.read(), b"next request")
+
+    def test_malformed_body(self):
+        with self.assertRaises(BadRequestException):
+            self.parse(b"not multipart")
+        with self.assertRaises(BadRequestException):
+            self.parse(build_body(b"data")[:-30])
+
+
+class ChunkedReaderTest(unittest.TestCase):
+    def test_decode(self):
+        body = os.urandom(10000)
+        for chunk_size in (1, 100, 4096, 20000):
+            reader = ChunkedReader(io.BytesIO(encode_chunked(body, chunk_size)))
+            self.assertEqual(b"".join(iter(lambda: reader.read(333), b"")), body)
+
+    def test_chunk_extensions_and_trailers(self):
+        stream = io.BytesIO(
+            b"5;name=value\r\nhello\r\n0\r\nX-Trailer: 1\r\n\r\nnext request"
+        )
+        reader = ChunkedReader(stream)
+        self.assertEqual(reader.read(), b"hello")
+        self.assertEqual(reader.read(), b"")
+        self.assertEqual(stream.read(), b"next request")
+
+    def test_multipart_body(self):
+        data = os.urandom(100000)
+        body = encode_chunked(build_body(data, k="hkey"), 4096)
+        params = dict(MultipartParser(ChunkedReader(io.BytesIO(body))))
+        self.addCleanup(params["data"].close)
+        self.assertEqual(params["k"], "hkey")
+        self.assertEqual(params["data"].read(), data)
+
+    def test_body_too_large(self):
+        body = encode_chunked(os.urandom(10000), 4096)
+        reader = ChunkedReader(io.BytesIO(body), max_size=10000)
+        self.assertEqual(len(b"".join(iter(reader.read, b""))), 10000)
+
+        stream = io.BytesIO(body)
+        reader = ChunkedReader(stream, max_size=9999)
+        with self.assertRaises(PayloadTooLargeException):
+            while reader.read():
+                pass
+        # the last chunk, which is too large, isn't read
+        self.assertEqual(reader.size, 8192)
+
+    def test_malformed_body(self):
+        for body in (b"zz\r\nhello\r\n", b"5\r\nhel", b"5\r\nhelloXX0\r\n\r\n"):
+            with self.assertRaises(BadRequestException):
+                reader = ChunkedReader(io.BytesIO(body))
+                while reader.read():
+                    pass
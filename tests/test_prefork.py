@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import configparser
+import io
+import json
+import os
+import socket
+import threading
+import unittest
+
+from unittest.mock import patch
+
+from ankisyncd.metrics import Gauge, Registry
+from ankisyncd.prefork import (
+    HandoffWSGIServer,
+    HashRing,
+    PreforkServer,
+    _HandoffSocket,
+)
+from ankisyncd.sync import HttpSyncer
+from ankisyncd.sync_app import SyncUserSession
+
+import helpers.server_utils
+
+
+def build_body(data, comp=0, **fields):
+    syncer = HttpSyncer()
+    syncer.postVars = fields
+    return syncer._buildPostData(io.BytesIO(data), comp)[1].getvalue()
+
+
+def build_request(method, body):
+    head = (
+        "POST /sync/{} HTTP/1.0\r\n"
+        "Content-Type: multipart/form-data; boundary=Anki-sync-boundary\r\n"
+        "Content-Length: {}\r\n\r\n".format(method, len(body))
+    )
+    return head.encode() + body
+
+
+class HashRingTest(unittest.TestCase):
+    def test_keys_stick_to_a_node(self):
+        ring = HashRing(range(4))
+        for user in ("alice", "bob", "carol"):
+            self.assertEqual(ring.get(user), HashRing(range(4)).get(user))
+
+    def test_keys_are_spread(self):
+        ring = HashRing(range(4))
+        nodes = [ring.get("user{}".format(i)) for i in range(1000)]
+        for node in range(4):
+            self.assertGreater(nodes.count(node), 100)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(range(4))
+        after = HashRing([0, 1, 2])
+        for i in range(1000):
+            key = "user{}".format(i)
+            if before.get(key) != 3:
+                self.assertEqual(before.get(key), after.get(key))
+
+
+class PreforkRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.server_paths = helpers.server_utils.create_server_paths()
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        config = configparser.ConfigParser()
+        config.read(os.path.join(script_dir, "assets", "test.conf"))
+        config["sync_app"].update(self.server_paths)
+        config["sync_app"]["port"] = "0"
+        self.server = PreforkServer(config["sync_app"], "127.0.0.1", 0, workers=2)
+
+        session = SyncUserSession(
+            "alice", os.path.join(self.server_paths["data_root"], "alice"), None
+        )
+        self.server.session_manager.save("hkey", session)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def _route(self, request):
+        client, conn = socket.socketpair()
+
+        def send():
+            try:
+                client.sendall(request)
+                client.shutdown(socket.SHUT_WR)
+            except BrokenPipeError:
+                pass  # the router stopped reading early
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        key, buffered = self.server._read_routing_key(conn)
+        conn.shutdown(socket.SHUT_RD)
+        sender.join()
+        if not isinstance(buffered, bytes):
+            with buffered:
+                buffered.seek(0)
+                buffered = buffered.read()
+        client.close()
+        conn.close()
+        return key, buffered
+
+    def test_login_is_routed_by_username(self):
+        body = build_body(json.dumps({"u": "bob", "p": "pw"}).encode(), comp=6)
+        request = build_request("hostKey", body)
+        self.assertEqual(self._route(request), ("bob", request))
+
+    def test_session_key_before_data(self):
+        body = build_body(os.urandom(3 * 1024 * 1024), k="hkey")
+        request = build_request("upload", body)
+        key, buffered = self._route(request)
+        self.assertEqual(key, "alice")
+        # reading stops as soon as the key is known
+        self.assertTrue(request.startswith(buffered))
+        self.assertLess(len(buffered), len(request))
+
+    def test_session_key_after_data(self):
+        body = build_body(os.urandom(3 * 1024 * 1024)).replace(
+            b"--Anki-sync-boundary--",
+            b'--Anki-sync-boundary\r\nContent-Disposition: form-data; name="k"'
+            b"\r\n\r\nhkey\r\n--Anki-sync-boundary--",
+        )
+        request = build_request("upload", body)
+        self.assertEqual(self._route(request), ("alice", request))
+
+    def test_metrics_of_every_worker(self):
+        def metrics_app(worker):
+            registry = Registry()
+            Gauge("open", "Open.", registry=registry).set(worker)
+
+            def app(environ, start_response):
+                start_response("200 OK", [("Content-Type", "text/plain")])
+                return [registry.render().encode()]
+
+            return app
+
+        def send_connection(httpd, addr, conn, buffered):
+            # what the worker does with a connection it receives
+            sock = _HandoffSocket(fileno=conn.detach())
+            sock.buffered = io.BytesIO(buffered)
+            httpd.process_request(sock, addr)
+
+        for worker in self.server.workers:
+            worker.pipe = HandoffWSGIServer(
+                ("127.0.0.1", 0), metrics_app(worker.index), pool_size=1
+            )
+            self.addCleanup(worker.pipe.server_close)
+        self.server.metrics_url = "/metrics"
+
+        client, conn = socket.socketpair()
+        client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        self.server._slots.acquire()
+        with patch("ankisyncd.prefork._send_connection", send_connection):
+            self.server._route(conn, ("127.0.0.1", 0))
+        response = client.makefile("rb").read()
+        client.close()
+
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertEqual(
+            response.partition(b"\r\n\r\n")[2].decode().splitlines(),
+            [
+                "# HELP open Open.",
+                "# TYPE open gauge",
+                'open{worker="0"} 0',
+                'open{worker="1"} 1',
+            ],
+        )
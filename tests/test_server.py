@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import http.client
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from ankisyncd.async_server import AsyncWSGIServer
+from ankisyncd.responses import FileResponse
+from ankisyncd.server import make_threaded_server
+
+FILE_DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+
+def slow_app(environ, start_response):
+    time.sleep(0.2)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"multithread" if environ["wsgi.multithread"] else b"single"]
+
+
+def file_app(environ, start_response):
+    f = tempfile.TemporaryFile()
+    f.write(FILE_DATA)
+    f.seek(0)
+    return FileResponse(f)(environ, start_response)
+
+
+class ThreadedServerTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = make_threaded_server("127.0.0.1", 0, slow_app, pool_size=4)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def _get(self, results):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=10)
+        conn.request("GET", "/")
+        results.append(conn.getresponse().read())
+        conn.close()
+
+    def _run_clients(self, count):
+        results = []
+        clients = [
+            threading.Thread(target=self._get, args=(results,)) for _ in range(count)
+        ]
+        start = time.monotonic()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return results, time.monotonic() - start
+
+    def test_requests_run_in_parallel(self):
+        results, elapsed = self._run_clients(4)
+
+        self.assertEqual(results, [b"multithread"] * 4)
+        # served one at a time this would take at least 0.8s
+        self.assertLess(elapsed, 0.6)
+
+    def test_pool_is_bounded(self):
+        results, elapsed = self._run_clients(8)
+
+        self.assertEqual(len(results), 8)
+        # 8 requests on 4 threads need at least two rounds
+        self.assertGreaterEqual(elapsed, 0.4)
+
+
+class FileResponseTest(unittest.TestCase):
+    def _serve(self, httpd):
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(*httpd.server_address, timeout=10)
+            conn.request("GET", "/")
+            resp = conn.getresponse()
+            self.assertEqual(int(resp.getheader("Content-Length")), len(FILE_DATA))
+            self.assertEqual(resp.read(), FILE_DATA)
+            conn.close()
+        finally:
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+
+    def test_threaded_server(self):
+        self._serve(make_threaded_server("127.0.0.1", 0, file_app))
+
+    def test_async_server(self):
+        self._serve(AsyncWSGIServer("127.0.0.1", 0, file_app))
+
+    def test_without_file_wrapper(self):
+        environ = {"REQUEST_METHOD": "GET"}
+        body = b"".join(file_app(environ, lambda status, headers: None))
+        self.assertEqual(body, FILE_DATA)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.sqlite_profile import get_pragmas, parse_pragmas
+
+
+class SqliteProfileTest(unittest.TestCase):
+    def test_parse_pragmas(self):
+        self.assertEqual(parse_pragmas(""), {})
+        self.assertEqual(
+            parse_pragmas("mmap_size: 0, cache_size:-2000,"),
+            {"mmap_size": "0", "cache_size": "-2000"},
+        )
+        for value in ("mmap_size", "mmap_size: 0; drop table cards"):
+            with self.assertRaises(ValueError):
+                parse_pragmas(value)
+
+    def test_get_pragmas(self):
+        # anki's own by default
+        self.assertEqual(get_pragmas({}), [])
+        config = {"sqlite_profile": "fast", "sqlite_pragmas": "mmap_size: 0"}
+        pragmas = dict(get_pragmas(config))
+        self.assertEqual(pragmas["mmap_size"], "0")
+        self.assertEqual(pragmas["temp_store"], "memory")
+        with self.assertRaises(ValueError):
+            get_pragmas({"sqlite_profile": "unknown"})
+
+    def test_applied_on_open(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        config = {"sqlite_profile": "fast", "sqlite_pragmas": "cache_size: -1234"}
+        wrapper = CollectionWrapper(config, os.path.join(temp_dir, "collection.anki2"))
+        col = wrapper._get_collection()
+        self.addCleanup(col.close)
+
+        self.assertEqual(col.db.scalar("pragma cache_size"), -1234)
+        self.assertEqual(col.db.scalar("pragma temp_store"), 2)
+        self.assertEqual(col.media._db.scalar("pragma cache_size"), -1234)
+        self.assertEqual(col.media._db.scalar("pragma journal_mode"), "wal")
+        # the collection is back in a transaction
+        col.db.execute("update col set crt=1")
+        col.save()
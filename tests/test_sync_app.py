@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
+import gzip
+import io
 import os
 import sqlite3
 import tempfile
 import unittest
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
+from ankisyncd.exceptions import (
+    BadRequestException,
+    CollectionBusyException,
+    PayloadTooLargeException,
+)
 from ankisyncd.sync import SYNC_VER
 from ankisyncd.sync_app import SyncCollectionHandler
 from ankisyncd.sync_app import SyncUserSession
+from ankisyncd.sync_app import iter_payload
 
 from collection_test_base import CollectionTestBase
 
@@ -15,12 +23,18 @@ from collection_test_base import CollectionTestBase
 class SyncCollectionHandlerTest(CollectionTestBase):
     def setUp(self):
         super().setUp()
-        self.session = MagicMock()
-        self.session.name = "test"
+        self.session = self.make_session("test")
         self.syncCollectionHandler = SyncCollectionHandler(
             self.collection, self.session
         )
 
+    def make_session(self, name):
+        session = MagicMock()
+        session.name = name
+        session.skey = name
+        session.get_thread.return_value = self.collection_wrapper
+        return session
+
     def tearDown(self):
         CollectionTestBase.tearDown(self)
         self.syncCollectionHandler = None
@@ -70,6 +84,175 @@ class SyncCollectionHandlerTest(CollectionTestBase):
         self.assertEqual(meta["msg"], "")
         self.assertEqual(meta["cont"], True)
 
+    def test_chunk(self):
+        self.add_default_note(5)
+        db = self.collection.db
+        for table in ("revlog", "cards", "notes"):
+            db.execute("update %s set usn=-1" % table)
+        db.execute(
+            "insert into revlog values (?,?,-1,3,1,0,2500,1000,0)",
+            1,
+            db.scalar("select min(id) from cards"),
+        )
+
+        handler = self.syncCollectionHandler
+        handler.chunkRows = 3
+        handler.maxUsn = 10
+        handler.minUsn = -1
+        handler.prepareToChunk()
+        chunks = []
+        while not chunks or not chunks[-1]["done"]:
+            chunks.append(handler.chunk())
+            sent = sum(len(chunks[-1].get(t, [])) for t in ("revlog", "cards", "notes"))
+            self.assertLessEqual(sent, 3)
+            if len(chunks) == 1:
+                # only the rows sent are marked as sent
+                self.assertEqual(db.scalar("select count() from notes where usn=10"), 3)
+
+        self.assertEqual(len(chunks), 4)
+        for table, count in (("revlog", 1), ("cards", 5), ("notes", 5)):
+            ids = [row[0] for chunk in chunks for row in chunk.get(table, [])]
+            self.assertEqual(len(ids), count)
+            self.assertEqual(ids, sorted(set(ids)))
+            self.assertEqual(
+                db.scalar("select count() from %s where usn=10" % table), count
+            )
+
+    def test_chunk_usn_order(self):
+        self.add_default_note(4)
+        db = self.collection.db
+        a, b, c, d = db.list("select id from notes order by id")
+        db.execute("update notes set usn=5")
+        db.execute("update notes set usn=3 where id=?", c)
+        db.execute("update notes set usn=-1 where id in (?, ?)", a, d)
+
+        handler = self.syncCollectionHandler
+        handler.chunkRows = 1
+        handler.maxUsn = 10
+        handler.minUsn = -1
+        handler.tablesLeft = ["notes"]
+        handler.cursor = None
+        ids = []
+        while True:
+            chunk = handler.chunk()
+            ids += [row[0] for row in chunk.get("notes", [])]
+            if chunk["done"]:
+                break
+        # by usn, with the pending rows, which are only then marked sent, last
+        self.assertEqual(ids, [c, b, a, d])
+        self.assertEqual(db.scalar("select count() from notes where usn=10"), 2)
+
+    def test_newer_rows(self):
+        self.add_default_note(3)
+        db = self.collection.db
+        a, b, c = db.list("select id from cards order by id")
+        db.execute("update cards set mod=100")
+        handler = self.syncCollectionHandler
+        handler.minUsn = 0
+
+        rows = [[a, 99], [b, 101], [c + 1, 1]]
+        self.assertEqual(handler.newerRows(rows, "cards", 1), rows[1:])
+        # rows at or above minUsn only
+        db.execute("update cards set usn=-1 where id=?", a)
+        self.assertEqual(handler.newerRows(rows, "cards", 1), rows)
+
+    def test_steps(self):
+        handler = self.syncCollectionHandler
+        db = self.collection.db
+        self.assertEqual(db.scalar("pragma synchronous"), 2)
+
+        with handler.step("start"):
+            self.assertEqual(db.scalar("pragma synchronous"), 1)
+            db.execute("update col set crt=1")
+        with self.assertRaises(ValueError):
+            with handler.step("applyChunk"):
+                db.execute("update col set crt=2")
+                raise ValueError
+        # only the failed step is undone
+        self.assertEqual(db.scalar("select crt from col"), 1)
+        self.assertIsNotNone(self.collection_wrapper.applying)
+
+        with handler.step("finish"):
+            pass
+        self.assertIsNone(self.collection_wrapper.applying)
+        self.assertEqual(db.scalar("pragma synchronous"), 2)
+        self.assertEqual(db.scalar("select crt from col"), 1)
+
+    def test_steps_of_other_sessions(self):
+        handler = self.syncCollectionHandler
+        other = SyncCollectionHandler(self.collection, self.make_session("other"))
+        db = self.collection.db
+
+        with handler.step("start"):
+            pass
+        # one incoming sync at a time
+        with self.assertRaises(CollectionBusyException):
+            with other.step("start"):
+                pass
+        # and the other session's steps don't commit it halfway
+        with patch.object(self.collection, "save") as save:
+            with other.step("meta"):
+                pass
+        save.assert_not_called()
+        self.assertIsNotNone(self.collection_wrapper.applying)
+
+        with handler.step("finish"):
+            pass
+        self.assertEqual(db.scalar("pragma synchronous"), 2)
+        with other.step("start"):
+            pass
+        with other.step("finish"):
+            pass
+        self.assertEqual(db.scalar("pragma synchronous"), 2)
+
+    def test_abandoned_sync(self):
+        handler = self.syncCollectionHandler
+        other = SyncCollectionHandler(self.collection, self.make_session("other"))
+        with handler.step("start"):
+            self.collection.db.execute("update col set crt=1")
+        self.collection_wrapper.applying.last_step -= 3600
+
+        # what it applied is kept
+        with other.step("start"):
+            pass
+        self.assertEqual(self.collection_wrapper.applying.owner, "other")
+        self.assertEqual(self.collection.db.scalar("select crt from col"), 1)
+        with other.step("finish"):
+            pass
+
 
 class SyncAppTest(unittest.TestCase):
     pass
+
+
+class IterPayloadTest(unittest.TestCase):
+    def test_gzip(self):
+        data = os.urandom(100000)
+        payload = b"".join(iter_payload(io.BytesIO(gzip.compress(data)), 1, len(data)))
+        self.assertEqual(payload, data)
+
+    def test_uncompressed_too_large(self):
+        with self.assertRaises(PayloadTooLargeException):
+            b"".join(iter_payload(io.BytesIO(b"x" * 1001), 0, 1000))
+
+    def test_gzip_bomb(self):
+        bomb = gzip.compress(b"\0" * 100 * 1024 * 1024)
+
+        class Input(io.BytesIO):
+            read_size = 0
+
+            def read(self, size):
+                data = super().read(size)
+                self.read_size += len(data)
+                return data
+
+        input = Input(bomb)
+        with self.assertRaises(PayloadTooLargeException):
+            b"".join(iter_payload(input, 1, 1024 * 1024, block_size=1024))
+        # rejected without reading the whole body
+        self.assertLess(input.read_size, len(bomb))
+
+    def test_invalid_gzip(self):
+        for data in (b"not gzip", gzip.compress(b"data")[:-4]):
+            with self.assertRaises(BadRequestException):
+                b"".join(iter_payload(io.BytesIO(data), 1, 1000))
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from webob import Request
+
+from ankisyncd import metrics
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.exceptions import CollectionBusyException
+from ankisyncd.sync import IncomingSync
+from ankisyncd.thread import (
+    ThreadingCollectionManager,
+    ThreadingCollectionWrapper,
+    WorkerPool,
+    parse_priorities,
+)
+
+
+class FakeCollectionWrapper(CollectionWrapper):
+    """Runs functions on a placeholder instead of a collection."""
+
+    def __init__(self, config, path, setup_new_collection=None):
+        self.col = None
+        self.username = "fake"
+        self.applying = None
+
+    def open(self):
+        if self.col is None:
+            self.col = object()
+
+    def close(self):
+        self.col = None
+
+    def opened(self):
+        return self.col is not None
+
+    def execute(self, func, args=[], kw={}, waitForReturn=True):
+        self.open()
+        return func(self.col, *args, **kw)
+
+
+class ThreadTestMixin:
+    """Helpers for tests of ThreadingCollectionWrappers."""
+
+    def make_thread(self, pool=None, path="/fake/collection.anki2", **config):
+        config["collection_wrapper"] = "test_thread.FakeCollectionWrapper"
+        thread = ThreadingCollectionWrapper(config, path, pool=pool)
+        self.addCleanup(thread.stop_and_wait)
+        return thread
+
+    def block(self, thread):
+        """Occupy 'thread' until the returned event is set."""
+        started, release = threading.Event(), threading.Event()
+
+        def blocker(col):
+            started.set()
+            release.wait(5)
+
+        self.addCleanup(release.set)
+        thread.execute(blocker, waitForReturn=False)
+        self.assertTrue(started.wait(5))
+        return release
+
+
+class ThreadingCollectionWrapperTest(ThreadTestMixin, unittest.TestCase):
+    def test_execute(self):
+        thread = self.make_thread()
+        self.assertEqual(thread.execute(lambda col, a, b=0: a + b, [1], {"b": 2}), 3)
+        with self.assertRaises(ValueError):
+            thread.execute(lambda col: int("x"))
+
+    def test_submit(self):
+        thread = self.make_thread()
+        future = thread.submit(lambda col, a: a * 2, [21])
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual(future.result(5), 42)
+        self.assertEqual(done, [future])
+
+        future = thread.submit(lambda col: int("x"))
+        self.assertIsInstance(future.exception(5), ValueError)
+
+    def test_cancel(self):
+        thread = self.make_thread()
+        release = self.block(thread)
+        ran = []
+        future = thread.submit(lambda col: ran.append(True))
+        self.assertTrue(future.cancel())
+        release.set()
+        self.assertEqual(thread.execute(lambda col: "done"), "done")
+        self.assertEqual(ran, [])
+
+    def run_in_order(self, thread, operations, delay=0):
+        """Queue a call for each operation while the thread is busy, and
+        return the order they ran in."""
+        release = self.block(thread)
+        ran = []
+        futures = []
+        for operation in operations:
+            futures.append(
+                thread.submit(
+                    lambda col, op: ran.append(op), [operation], operation=operation
+                )
+            )
+            time.sleep(delay)
+        release.set()
+        for future in futures:
+            future.result(5)
+        return ran
+
+    def test_priorities(self):
+        thread = self.make_thread()
+        self.assertEqual(
+            self.run_in_order(thread, ["download", "chunk", "meta", "mediaSanity"]),
+            ["meta", "mediaSanity", "chunk", "download"],
+        )
+
+    def test_configured_priorities(self):
+        thread = self.make_thread(collection_priorities="meta: 3, unknown: -1")
+        self.assertEqual(
+            self.run_in_order(thread, ["meta", "download", "unknown", "other"]),
+            ["unknown", "other", "download", "meta"],
+        )
+
+    def test_aging(self):
+        thread = self.make_thread(collection_priority_aging="0.01")
+        self.assertEqual(
+            self.run_in_order(thread, ["download", "meta"], delay=0.05),
+            ["download", "meta"],
+        )
+
+    def test_parse_priorities(self):
+        self.assertEqual(parse_priorities(""), {})
+        self.assertEqual(
+            parse_priorities("meta: 0, download:3,"), {"meta": 0, "download": 3}
+        )
+        with self.assertRaises(ValueError):
+            parse_priorities("meta")
+
+    def test_queue_full(self):
+        thread = self.make_thread(collection_queue_size="1")
+        release = self.block(thread)
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(thread.execute(lambda col: "queued"))
+        )
+        waiter.start()
+        while thread.qempty():
+            waiter.join(0.01)
+
+        busy = metrics.COLLECTION_BUSY.value(reason="queue_full")
+        with self.assertRaises(CollectionBusyException):
+            thread.execute(lambda col: "rejected")
+        self.assertEqual(metrics.COLLECTION_BUSY.value(reason="queue_full"), busy + 1)
+
+        release.set()
+        waiter.join(5)
+        self.assertEqual(results, ["queued"])
+        # the slot is free again
+        self.assertEqual(thread.execute(lambda col: "accepted"), "accepted")
+
+    def test_timeout(self):
+        thread = self.make_thread(collection_timeout="0.05")
+        release = self.block(thread)
+        ran = []
+
+        busy = metrics.COLLECTION_BUSY.value(reason="timeout")
+        with self.assertRaises(CollectionBusyException):
+            thread.execute(lambda col: ran.append(True))
+        self.assertEqual(metrics.COLLECTION_BUSY.value(reason="timeout"), busy + 1)
+
+        release.set()
+        self.assertEqual(thread.execute(lambda col: "done"), "done")
+        # calls that timed out before they started are never run
+        self.assertEqual(ran, [])
+
+
+class WorkerPoolTest(ThreadTestMixin, unittest.TestCase):
+    def test_shared_workers(self):
+        pool = WorkerPool(3)
+        threads = [self.make_thread(pool, "/fake/{}".format(i)) for i in range(20)]
+        lock = threading.Lock()
+        running = {thread: 0 for thread in threads}
+        overlapping = []
+        workers = set()
+
+        def call(col, thread):
+            with lock:
+                running[thread] += 1
+                overlapping.append(running[thread] > 1)
+                workers.add(threading.current_thread())
+            time.sleep(0.001)
+            with lock:
+                running[thread] -= 1
+
+        futures = [
+            thread.submit(call, [thread]) for _ in range(5) for thread in threads
+        ]
+        for future in futures:
+            future.result(5)
+        pool.join()
+
+        # calls on one collection never overlap, and they ran on at most
+        # 3 threads in all
+        self.assertEqual(len(overlapping), 100)
+        self.assertFalse(any(overlapping))
+        self.assertLessEqual(len(workers), 3)
+        self.assertLessEqual(pool.threads, 3)
+
+    def test_collections_run_in_parallel(self):
+        class GatedQueue(queue.Queue):
+            """Keeps workers from waking up until 'gate' is set."""
+
+            gate = threading.Event()
+
+            def get(self, *args, **kw):
+                item = super().get(*args, **kw)
+                self.gate.wait(5)
+                return item
+
+        pool = WorkerPool(4)
+        pool._ready = GatedQueue()
+        a, b, c = [self.make_thread(pool, "/fake/{}".format(i)) for i in "abc"]
+        # leave one idle worker
+        GatedQueue.gate.set()
+        a.execute(lambda col: None)
+        pool.join()
+        self.assertEqual(pool.threads, 1)
+
+        # both scheduled before that worker wakes up
+        GatedQueue.gate.clear()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        blocked = b.submit(lambda col: release.wait(5))
+        future = c.submit(lambda col: "done")
+        GatedQueue.gate.set()
+        # c doesn't wait for b
+        self.assertEqual(future.result(1), "done")
+        self.assertFalse(blocked.done())
+        release.set()
+        self.assertTrue(blocked.result(5))
+
+    def test_idle_workers_exit(self):
+        pool = WorkerPool(2, idle_timeout=0.01)
+        thread = self.make_thread(pool)
+        self.assertEqual(thread.execute(lambda col: "done"), "done")
+        self.assertEqual(pool.threads, 1)
+        deadline = time.monotonic() + 5
+        while pool.threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.threads, 0)
+        # and are started again when there is work
+        self.assertEqual(thread.execute(lambda col: "again"), "again")
+
+    def test_idle_workers_exit_after_a_burst(self):
+        pool = WorkerPool(2, idle_timeout=0.1)
+        threads = [
+            self.make_thread(pool, "/fake/{}".format(i), collection_timeout=5)
+            for i in range(4)
+        ]
+        # more collections with work than there are workers
+        releases = [self.block(thread) for thread in threads[:2]]
+        futures = [thread.submit(lambda col: "done") for thread in threads[2:]]
+        for release in releases:
+            release.set()
+        for future in futures:
+            self.assertEqual(future.result(5), "done")
+        pool.join()
+        self.assertEqual(pool.threads, 2)
+
+        deadline = time.monotonic() + 5
+        while pool.threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.threads, 0)
+        self.assertEqual(pool.busy, 0)
+        # a worker is started for the next call
+        self.assertEqual(threads[0].execute(lambda col: "again"), "again")
+
+    def test_stop(self):
+        thread = self.make_thread()
+        thread.stop_and_wait()
+        self.assertFalse(thread.running)
+        future = thread.submit(lambda col: "dropped")
+        thread.pool.join()
+        self.assertTrue(future.cancelled())
+
+
+class ThreadingCollectionManagerTest(ThreadTestMixin, unittest.TestCase):
+    def make_manager(self, **config):
+        config["collection_wrapper"] = "test_thread.FakeCollectionWrapper"
+        manager = ThreadingCollectionManager(config)
+        self.addCleanup(manager.shutdown)
+        return manager
+
+    def open(self, manager, *names):
+        """Open the collections called 'names', in that order."""
+        threads = []
+        for name in names:
+            thread = manager.get_collection("/fake/{}/collection.anki2".format(name))
+            thread.execute(lambda col: None)
+            # make sure the last use times differ
+            time.sleep(0.001)
+            threads.append(thread)
+        manager.pool.join()
+        return threads
+
+    def wait_closed(self, manager, timeout=5):
+        deadline = time.monotonic() + timeout
+        while manager.open_collections() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return not manager.open_collections()
+
+    def test_inactive_collections_are_closed(self):
+        manager = self.make_manager(monitor_inactivity="0.05")
+        closes = metrics.COLLECTION_CLOSES.value(reason="inactive")
+        a, b = self.open(manager, "a", "b")
+        self.assertEqual(set(manager.open_collections()), {a, b})
+
+        self.assertTrue(self.wait_closed(manager))
+        self.assertFalse(a.opened() or b.opened())
+        self.assertEqual(metrics.COLLECTION_CLOSES.value(reason="inactive"), closes + 2)
+
+    def test_busy_collections_are_closed_later(self):
+        manager = self.make_manager(monitor_inactivity="0.02", monitor_frequency="0.02")
+        a = self.open(manager, "a")[0]
+        release = self.block(a)
+        time.sleep(0.1)
+        self.assertTrue(a.opened())
+        release.set()
+        self.assertTrue(self.wait_closed(manager))
+
+    def test_adaptive_inactivity(self):
+        manager = self.make_manager(
+            monitor_inactivity="90",
+            monitor_inactivity_min="30",
+            monitor_inactivity_max="600",
+        )
+        a = manager.get_collection("/fake/a/collection.anki2")
+        self.assertEqual(manager.keep_open(a), 90)
+
+        # synced every two minutes: kept open until the next sync
+        reopens = metrics.IDLE_REOPENS.value(policy="fixed")
+        manager.collection_resumed(a, 120)
+        self.assertEqual(manager.keep_open(a), 180)
+        self.assertEqual(metrics.IDLE_REOPENS.value(policy="fixed"), reopens + 1)
+        reopens = metrics.IDLE_REOPENS.value(policy="adaptive")
+        manager.collection_resumed(a, 120)
+        self.assertEqual(metrics.IDLE_REOPENS.value(policy="adaptive"), reopens)
+
+        # synced every few seconds, but no less than the minimum
+        for _ in range(20):
+            manager.collection_resumed(a, 10)
+        self.assertEqual(manager.keep_open(a), 30)
+
+        # synced once a day: closed early
+        def saved():
+            fixed = metrics.IDLE_OPEN_SECONDS.value(policy="fixed")
+            return fixed - metrics.IDLE_OPEN_SECONDS.value(policy="adaptive")
+
+        before = saved()
+        for _ in range(5):
+            manager.collection_resumed(a, 86400)
+        self.assertEqual(manager.keep_open(a), 30)
+        # 60 idle seconds less than the fixed 90 each time
+        self.assertEqual(saved() - before, 60 * 5)
+
+    def test_adaptive_inactivity_learnt_from_calls(self):
+        manager = self.make_manager()
+        a = self.open(manager, "a")[0]
+        a.last_timestamp -= 60
+        a.execute(lambda col: None)
+        self.assertEqual(a.sync_gap // 1, 60)
+        # calls within one sync don't count
+        a.execute(lambda col: None)
+        self.assertEqual(a.sync_gap // 1, 60)
+        self.assertEqual(manager.keep_open(a) // 1, 90)
+
+    def test_many_collections(self):
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        manager = self.make_manager(monitor_inactivity="0.2")
+        for i in range(100000):
+            manager.get_collection("/fake/{}/collection.anki2".format(i))
+        self.assertEqual(len(manager.collections), 100000)
+
+        opened = self.open(manager, *range(0, 100000, 10000))
+        self.assertEqual(len(manager.open_collections()), 10)
+        # only open collections are tracked by the monitor
+        self.assertLessEqual(len(manager._deadlines), 10)
+        self.assertTrue(self.wait_closed(manager))
+        self.assertFalse(any(thread.opened() for thread in opened))
+        self.assertEqual(manager._deadlines, [])
+
+    def test_max_open_collections(self):
+        manager = self.make_manager(max_open_collections="2")
+        closes = metrics.COLLECTION_CLOSES.value(reason="max_open")
+        reopens = metrics.COLLECTION_REOPENS.value(reason="max_open")
+
+        a, b, c = self.open(manager, "a", "b", "c")
+        self.assertEqual([thread.opened() for thread in (a, b, c)], [False, True, True])
+        self.assertEqual(metrics.COLLECTION_CLOSES.value(reason="max_open"), closes + 1)
+
+        # a is reopened and b, now the least recently used, is closed
+        self.open(manager, "a")
+        self.assertEqual([thread.opened() for thread in (a, b, c)], [True, False, True])
+        self.assertEqual(
+            metrics.COLLECTION_REOPENS.value(reason="max_open"), reopens + 1
+        )
+
+    def test_busy_collections_are_kept(self):
+        manager = self.make_manager(max_open_collections="1")
+        a = self.open(manager, "a")[0]
+        release = self.block(a)
+        b = manager.get_collection("/fake/b/collection.anki2")
+        b.execute(lambda col: None)
+        self.assertTrue(a.opened())
+
+        # a is the least recently used, but busy
+        manager.evict()
+        deadline = time.monotonic() + 5
+        while b.opened() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertFalse(b.opened())
+        self.assertTrue(a.opened())
+        release.set()
+
+    def test_collections_used_since_eviction_are_kept(self):
+        manager = self.make_manager(collection_workers="1")
+        a, b = self.open(manager, "a", "b")
+        closes = metrics.COLLECTION_CLOSES.value(reason="max_open")
+        reopens = metrics.COLLECTION_REOPENS.value(reason="max_open")
+
+        # the eviction is queued, but a call gets in before it runs
+        release = self.block(b)
+        self.assertTrue(a.evict("max_open"))
+        future = a.submit(lambda col: "applied", operation="applyChunk")
+        release.set()
+        self.assertEqual(future.result(5), "applied")
+        manager.pool.join()
+
+        self.assertTrue(a.opened())
+        self.assertIn(a, manager.open_collections())
+        self.assertEqual(metrics.COLLECTION_CLOSES.value(reason="max_open"), closes)
+        self.assertEqual(metrics.COLLECTION_REOPENS.value(reason="max_open"), reopens)
+
+    def test_collections_applying_a_sync_are_kept(self):
+        manager = self.make_manager(max_open_collections="1")
+        a = self.open(manager, "a")[0]
+        a.applying = IncomingSync("skey", [])
+        self.assertFalse(a.evict("max_open"))
+        self.open(manager, "b")
+        self.assertTrue(a.opened())
+
+        # unless abandoned
+        a.applying.last_step -= 3600
+        self.assertTrue(a.evict("max_open"))
+        manager.pool.join()
+        self.assertFalse(a.opened())
+
+    def test_max_rss(self):
+        manager = self.make_manager(max_rss="10")
+        with patch("ankisyncd.thread.psutil") as psutil:
+            psutil.Process().memory_info().rss = 0
+            threads = self.open(manager, "a", "b", "c", "d")
+
+            psutil.Process().memory_info().rss = 12 * 1024 * 1024
+            manager._usage_checked = 0
+            manager.evict()
+            manager.pool.join()
+        # each collection is taken to use 3 MiB
+        self.assertEqual(
+            [thread.opened() for thread in threads], [False, True, True, True]
+        )
+
+
+class CollectionBusyExceptionTest(unittest.TestCase):
+    def test_response(self):
+        resp = Request.blank("/sync/meta").get_response(CollectionBusyException(10))
+        self.assertEqual(resp.status_int, 503)
+        self.assertEqual(resp.headers["Retry-After"], "10")
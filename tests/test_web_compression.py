@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import json
+
+from webob import Request, Response
+
+from sync_app_functional_test_base import SyncAppFunctionalTestBase
+
+
+class SyncAppFunctionalCompressionTest(SyncAppFunctionalTestBase):
+    def setUp(self):
+        SyncAppFunctionalTestBase.setUp(self)
+        self.server = self.mock_remote_server
+
+    def tearDown(self):
+        self.server = None
+        SyncAppFunctionalTestBase.tearDown(self)
+
+    def _hostKey(self, **headers):
+        self.server.postVars = {}
+        data = json.dumps({"u": "testuser", "p": "testpassword"}).encode()
+        post_headers, body = self.server._buildPostData(io.BytesIO(data), 6)
+        post_headers.update(headers)
+        # webtest would decode the response, go around it
+        req = Request.blank("/sync/hostKey", method="POST", headers=post_headers)
+        req.body = body.getvalue()
+        resp = req.get_response(self.server_app)
+        # as the server does once the response is sent
+        if hasattr(resp.app_iter, "close"):
+            self.addCleanup(resp.app_iter.close)
+        return resp
+
+    def test_compressed_when_accepted(self):
+        self.server_app.response_gzip_min_size = 0
+        r = self._hostKey(**{"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(r.headers["Content-Encoding"], "gzip")
+        self.assertEqual(r.headers["Vary"], "Accept-Encoding")
+        self.assertIn("key", json.loads(gzip.decompress(r.body)))
+
+    def test_not_compressed_unless_accepted(self):
+        self.server_app.response_gzip_min_size = 0
+        for headers in ({}, {"Accept-Encoding": "gzip;q=0, identity"}):
+            r = self._hostKey(**headers)
+            self.assertNotIn("Content-Encoding", r.headers)
+            self.assertIn("key", json.loads(r.body))
+
+    def test_small_responses_not_compressed(self):
+        r = self._hostKey(**{"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", r.headers)
+        self.assertIn("key", json.loads(r.body))
+
+    def test_zips_not_compressed(self):
+        self.server_app.response_gzip_min_size = 0
+        environ = {"HTTP_ACCEPT_ENCODING": "gzip"}
+        compress = self.server_app.compress_response
+        resp = compress(environ, Response(b"PK" * 1000), "downloadFiles")
+        self.assertIsNone(resp.content_encoding)
+        resp = Response(b"PK" * 1000, content_type="application/zip")
+        self.assertIsNone(compress(environ, resp, "other").content_encoding)
+        resp = compress(environ, Response(b"{}" * 1000), "chunk")
+        self.assertEqual(resp.content_encoding, "gzip")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import helpers.server_utils
+from ankisyncd import metrics
+
+from sync_app_functional_test_base import SyncAppFunctionalTestBase
+
+
+class SyncAppFunctionalMetricsTest(SyncAppFunctionalTestBase):
+    def setUp(self):
+        SyncAppFunctionalTestBase.setUp(self)
+        self.server = self.mock_remote_server
+        self.server_app.metrics_url = "/metrics"
+
+    def tearDown(self):
+        self.server = None
+        SyncAppFunctionalTestBase.tearDown(self)
+
+    def test_requests_are_counted(self):
+        ok = metrics.REQUESTS.value(operation="hostKey", status=200)
+        forbidden = metrics.REQUESTS.value(operation="hostKey", status=403)
+        count, _ = metrics.REQUEST_DURATION.value(operation="hostKey")
+
+        self.assertIsNotNone(self.server.hostKey("testuser", "testpassword"))
+        self.assertIsNone(self.server.hostKey("testuser", "wrongpassword"))
+
+        self.assertEqual(
+            metrics.REQUESTS.value(operation="hostKey", status=200), ok + 1
+        )
+        self.assertEqual(
+            metrics.REQUESTS.value(operation="hostKey", status=403), forbidden + 1
+        )
+        self.assertEqual(
+            metrics.REQUEST_DURATION.value(operation="hostKey")[0], count + 2
+        )
+
+    def test_handlers_and_collections(self):
+        count, _ = metrics.HANDLER_DURATION.value(operation="meta")
+        self.server.hostKey("testuser", "testpassword")
+        self.server.meta()
+        self.assertEqual(metrics.HANDLER_DURATION.value(operation="meta")[0], count + 1)
+
+        r = self.server_test_app.get("/metrics")
+        self.assertTrue(r.content_type.startswith("text/plain"))
+        self.assertIn("ankisyncd_collection_queue_depth 0", r.text)
+        self.assertIn("ankisyncd_collection_queue_depth_max 0", r.text)
+        # users aren't named
+        self.assertNotIn("testuser", r.text)
+        self.assertIn("ankisyncd_open_collections ", r.text)
+        self.assertIn('ankisyncd_requests_total{operation="meta",status="200"}', r.text)
+
+    def test_warm_up(self):
+        warm_ups = metrics.COLLECTION_WARM_UPS.value()
+        warm, _ = metrics.META_DURATION.value(collection="warm")
+        hkey = self.server.hostKey("testuser", "testpassword")
+        self.assertEqual(metrics.COLLECTION_WARM_UPS.value(), warm_ups + 1)
+
+        # the collection is opened in the background
+        thread = helpers.server_utils.get_thread_for_hkey(self.server_app, hkey)
+        thread.pool.join()
+        self.assertTrue(thread.opened())
+        self.server.meta()
+        self.assertEqual(metrics.META_DURATION.value(collection="warm")[0], warm + 1)
+
+    def test_warm_up_disabled(self):
+        self.server_app.warm_up_collections = 0
+        cold, _ = metrics.META_DURATION.value(collection="cold")
+        hkey = self.server.hostKey("testuser", "testpassword")
+        thread = helpers.server_utils.get_thread_for_hkey(self.server_app, hkey)
+        self.assertFalse(thread.opened())
+        self.server.meta()
+        self.assertEqual(metrics.META_DURATION.value(collection="cold")[0], cold + 1)
+
+    def test_disabled_by_default(self):
+        self.server_app.metrics_url = None
+        r = self.server_test_app.get("/metrics")
+        self.assertNotIn("ankisyncd_requests_total", r.text)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import io
+import tempfile
+import time
+from unittest.mock import patch
+
+from webob import Request
+
+from sync_app_functional_test_base import SyncAppFunctionalTestBase
+import helpers.server_utils
+
+
+class Unreadable(io.BytesIO):
+    def read(self, *args):
+        raise AssertionError("body read")
+
+    readline = read
+
+
+class SyncAppFunctionalUploadTest(SyncAppFunctionalTestBase):
+    def setUp(self):
+        SyncAppFunctionalTestBase.setUp(self)
+        self.server = self.mock_remote_server
+        self.hkey = self.server.hostKey("testuser", "testpassword")
+        self.server.postVars = {"k": self.hkey}
+        # the integrity check can't use the "unicase" collation of collections
+        # created by this version of anki, skip it
+        patcher = patch.object(self.server_app.full_sync_manager, "test_db")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        col = self.colutils.create_empty_col()
+        note = col.newNote()
+        note["Front"] = "front"
+        col.addNote(note)
+        col.close()
+        with open(col.path, "rb") as f:
+            self.col_data = f.read()
+
+    def tearDown(self):
+        self.server = None
+        SyncAppFunctionalTestBase.tearDown(self)
+
+    def _upload(self, comp):
+        return self.server.req("upload", io.BytesIO(self.col_data), comp=comp)
+
+    def _server_note_count(self):
+        col = helpers.server_utils.get_col_for_hkey(self.server_app, self.hkey)
+        return col.noteCount()
+
+    def test_upload(self):
+        for comp in (0, 6):
+            self.assertEqual(self._upload(comp), b"OK")
+            self.assertEqual(self._server_note_count(), 1)
+
+    def test_upload_spooled_to_disk(self):
+        self.server_app.spool_max_size = 1024
+        for comp in (0, 6):
+            self.assertEqual(self._upload(comp), b"OK")
+            self.assertEqual(self._server_note_count(), 1)
+
+    def test_upload_files_are_closed(self):
+        files = []
+        spooled_file = tempfile.SpooledTemporaryFile
+
+        def make_file(*args, **kw):
+            files.append(spooled_file(*args, **kw))
+            return files[-1]
+
+        with patch("tempfile.SpooledTemporaryFile", make_file):
+            for comp in (0, 6):
+                self.assertEqual(self._upload(comp), b"OK")
+        self.assertGreaterEqual(len(files), 3)
+        self.assertTrue(all(f.closed for f in files))
+
+    def test_upload_too_large(self):
+        self.server_app.max_payload_size = len(self.col_data) - 1
+        for comp in (0, 6):
+            with self.assertRaises(Exception) as cm:
+                self._upload(comp)
+            self.assertIn("413", str(cm.exception))
+
+    def _status_without_reading(self, path, length):
+        """Status of a request for 'path' answered without reading its body."""
+        environ = Request.blank(path, content_type="multipart/form-data").environ
+        environ.update(CONTENT_LENGTH=str(length), **{"wsgi.input": Unreadable()})
+        statuses = []
+        self.server_app(environ, lambda status, headers: statuses.append(status))
+        return int(statuses[0].split()[0])
+
+    def test_upload_too_large_is_not_read(self):
+        self.server_app.max_payload_size = 1000
+        self.assertEqual(self._status_without_reading("/sync/upload", 1001), 413)
+
+    def test_upload_rejected_before_being_read(self):
+        admission = self.server_app.admission
+        self.server_app.heavy_operations_timeout = 0.01
+        self.assertTrue(admission.acquire(admission.capacity))
+        self.addCleanup(admission.release, admission.capacity)
+        for path in ("/sync/upload", "/msync/uploadChanges"):
+            self.assertEqual(self._status_without_reading(path, 1000), 503)
+
+    def test_upload_waits_for_budget(self):
+        admission = self.server_app.admission
+        self.server_app.heavy_operations_timeout = 0.01
+        self.assertTrue(admission.acquire(admission.capacity))
+        with self.assertRaises(Exception) as cm:
+            self._upload(0)
+        self.assertIn("503", str(cm.exception))
+        # cheap operations aren't held back
+        self.assertIsNotNone(self.server.hostKey("testuser", "testpassword"))
+        self.server.postVars = {"k": self.hkey}
+
+        admission.release(admission.capacity)
+        self.assertEqual(self._upload(0), b"OK")
+        self.assertEqual(admission.in_use, 0)
+
+    def test_too_many_waiting(self):
+        admission = self.server_app.admission
+        self.server_app.heavy_operations_timeout = 60
+        self.server_app.max_heavy_operations_waiting = 0
+        self.assertTrue(admission.acquire(admission.capacity))
+        self.addCleanup(admission.release, admission.capacity)
+        start = time.monotonic()
+        with self.assertRaises(Exception) as cm:
+            self._upload(0)
+        self.assertIn("503", str(cm.exception))
+        # without waiting for the timeout
+        self.assertLess(time.monotonic() - start, 30)
+
+    def test_download_holds_budget_until_sent(self):
+        self.assertEqual(self._upload(0), b"OK")
+        admission = self.server_app.admission
+        environ = Request.blank(
+            "/sync/download",
+            POST={"k": self.hkey},
+            content_type="multipart/form-data",
+        ).environ
+        result = self.server_app(environ, lambda status, headers: None)
+        # the snapshot is still to be sent
+        self.assertGreater(admission.in_use, 0)
+        body = b"".join(result)
+        self.assertGreater(len(body), 0)
+        result.close()
+        self.assertEqual(admission.in_use, 0)